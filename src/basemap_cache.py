@@ -0,0 +1,202 @@
+"""Size bounded disk cache of basemap tiles, shared by the gpd and bokeh plots."""
+import math
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+import mercantile
+import numpy as np
+import requests
+from definitions import TILE_CACHE_PATH, logger_f
+import metrics
+from PIL import Image
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from xyzservices import TileProvider
+
+# circumference of the earth in web mercator (EPSG:3857)
+WORLD_SIZE = 2 * math.pi * 6378137
+
+TIMEOUT = 10
+
+_session = None
+_session_lock = threading.Lock()
+
+
+def _get_session():
+    """Get the session shared by all tile downloads."""
+    global _session
+    with _session_lock:
+        if _session is None:
+            _session = requests.Session()
+            # tile servers ask clients to identify themselves, see e.g. https://operations.osmfoundation.org/policies/tiles/
+            _session.headers["User-Agent"] = "mapping_tool"
+            retries = Retry(total=3, backoff_factor=0.5, status_forcelist=(429, 500, 502, 503, 504))
+            _session.mount("https://", HTTPAdapter(max_retries=retries, pool_maxsize=16))
+            _session.mount("http://", HTTPAdapter(max_retries=retries, pool_maxsize=16))
+        return _session
+
+
+def tile_path(provider, tile):
+    """Get the cache path of a tile.
+
+    Args:
+        provider (TileProvider): xyzservices provider
+        tile (mercantile.Tile): tile
+
+    Returns:
+        Path: path of the tile image, independent of whether it is cached
+    """
+    return TILE_CACHE_PATH / provider["name"] / str(tile.z) / str(tile.x) / f"{tile.y}.png"
+
+
+def get_tile(provider, tile, offline=False):
+    """Get a tile image from the cache, download it if it is not cached yet.
+
+    Args:
+        provider (TileProvider): xyzservices provider
+        tile (mercantile.Tile): tile
+        offline (Boolean): True: only use cached tiles, never connect to the tile server
+
+    Returns:
+        bytes: tile image, None if offline and the tile is not cached
+    """
+    path = tile_path(provider, tile)
+    if path.is_file():
+        # the modification time is the last access -> least recently used tiles are evicted first
+        os.utime(path)
+        metrics.inc("mapping_tool_basemap_tiles_total", source="cache")
+        return path.read_bytes()
+    if offline:
+        metrics.inc("mapping_tool_basemap_tiles_total", source="missing")
+        return None
+
+    response = _get_session().get(provider.build_url(x=tile.x, y=tile.y, z=tile.z), timeout=TIMEOUT)
+    response.raise_for_status()
+    metrics.inc("mapping_tool_basemap_tiles_total", source="download")
+    metrics.inc("mapping_tool_basemap_received_bytes_total", len(response.content))
+
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = path.with_name(f"{path.name}.{threading.get_ident()}.tmp")
+    tmp_path.write_bytes(response.content)
+    os.replace(tmp_path, path)
+    return response.content
+
+
+def prefetch(provider, bounds, min_zoom, max_zoom, jobs=4):
+    """Download all tiles of a provider covering the bounds into the cache.
+
+    Args:
+        provider (TileProvider): xyzservices provider
+        bounds (tuple): west, south, east, north in EPSG:4326
+        min_zoom (Integer): lowest zoom level
+        max_zoom (Integer): highest zoom level, limited to the highest zoom level of the provider
+        jobs (Integer): number of parallel downloads
+
+    Returns:
+        Integer: number of tiles now available in the cache
+    """
+    max_zoom = min(max_zoom, provider.get("max_zoom", max_zoom))
+    tiles = list(mercantile.tiles(*bounds, zooms=list(range(min_zoom, max_zoom + 1))))
+    logger_f.info(f"prefetch {len(tiles)} tiles of {provider['name']} (zoom {min_zoom}-{max_zoom})")
+
+    available = 0
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        for tile, future in [(tile, executor.submit(get_tile, provider, tile)) for tile in tiles]:
+            try:
+                future.result()
+                available += 1
+            except requests.RequestException as err:
+                logger_f.warning("tile %s of %s could not be downloaded: %s", tile, provider["name"], err)
+    return available
+
+
+def evict(max_size):
+    """Remove least recently used tiles until the cache is not larger than max_size bytes.
+
+    Args:
+        max_size (Integer): maximum size of the tile cache in bytes
+    """
+    tiles = [(path, path.stat()) for path in TILE_CACHE_PATH.glob("*/*/*/*.png")]
+    total = sum(stat.st_size for path, stat in tiles)
+    for path, stat in sorted(tiles, key=lambda x: x[1].st_mtime):
+        if total <= max_size:
+            break
+        path.unlink(missing_ok=True)
+        total -= stat.st_size
+    logger_f.info(f"tile cache size: {total / 1e6:.1f} MB")
+
+
+def zoom_for(bounds, pixels, provider):
+    """Get the zoom level whose tiles have about the resolution of the plot.
+
+    Args:
+        bounds (tuple): minx, miny, maxx, maxy in EPSG:3857
+        pixels (Integer): size of the longer side of the plot in pixels
+        provider (TileProvider): xyzservices provider
+
+    Returns:
+        Integer: zoom level, limited to the zoom levels of the provider
+    """
+    extent = max(bounds[2] - bounds[0], bounds[3] - bounds[1], 1)
+    zoom = math.ceil(math.log2(WORLD_SIZE * pixels / (256 * extent)))
+    return int(min(max(zoom, provider.get("min_zoom", 0)), provider.get("max_zoom", 19)))
+
+
+def mosaic(provider, bounds, zoom, offline=False):
+    """Stitch the tiles covering the bounds to one image.
+
+    In offline mode lower zoom levels are used if the tiles of the given zoom level are not all cached.
+
+    Args:
+        provider (TileProvider): xyzservices provider
+        bounds (tuple): minx, miny, maxx, maxy in EPSG:3857
+        zoom (Integer): zoom level of the tiles
+        offline (Boolean): True: only use cached tiles, never connect to the tile server
+
+    Returns:
+        tuple: image (numpy array, RGBA) and its extent (minx, maxx, miny, maxy) in EPSG:3857, None if tiles are missing
+    """
+    west, south = mercantile.lnglat(bounds[0], bounds[1])
+    east, north = mercantile.lnglat(bounds[2], bounds[3])
+
+    for z in range(zoom, -1, -1):
+        tiles = list(mercantile.tiles(west, south, east, north, zooms=z))
+        if offline and not all(tile_path(provider, tile).is_file() for tile in tiles):
+            continue
+        images = {tile: Image.open(BytesIO(get_tile(provider, tile, offline))).convert("RGBA") for tile in tiles}
+        break
+    else:
+        return None
+
+    xs = sorted({tile.x for tile in tiles})
+    ys = sorted({tile.y for tile in tiles})
+    size = next(iter(images.values())).size[0]
+    image = Image.new("RGBA", (len(xs) * size, len(ys) * size))
+    for tile, tile_image in images.items():
+        image.paste(tile_image.resize((size, size)), ((tile.x - xs[0]) * size, (tile.y - ys[0]) * size))
+
+    upper_left = mercantile.xy_bounds(xs[0], ys[0], z)
+    lower_right = mercantile.xy_bounds(xs[-1], ys[-1], z)
+    return np.asarray(image), (upper_left.left, lower_right.right, lower_right.bottom, upper_left.top)
+
+
+def local_provider(provider, cache_url=None):
+    """Get a provider loading the tiles of the given provider from the cache instead of the tile server.
+
+    Args:
+        provider (TileProvider): xyzservices provider
+        cache_url (String): url the tile cache is served at, e.g. by the bokeh server. None: file url of the cache
+
+    Returns:
+        TileProvider: provider with a url of the cache
+    """
+    if cache_url is None:
+        cache_url = TILE_CACHE_PATH.resolve().as_uri()
+    url = f"{cache_url.rstrip('/')}/{provider['name']}/{{z}}/{{x}}/{{y}}.png"
+    return TileProvider(
+        name=provider["name"],
+        url=url,
+        attribution=provider.get("attribution", ""),
+        max_zoom=provider.get("max_zoom", 19),
+    )
@@ -0,0 +1,212 @@
+"""Renders one map per area of interest (AOI) of a batch in a pool of worker processes.
+
+The layers are downloaded once for all AOIs. Their geometries are copied as WKB into shared memory, the workers only
+receive the positions of the features of their AOI and decode these, no GeoDataFrames are pickled.
+"""
+import re
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from multiprocessing.shared_memory import SharedMemory
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+from definitions import logger_f, stop_async_logging
+import profiling
+
+try:
+    # shapely >= 2.0 converts all geometries at once
+    from shapely import from_wkb, to_wkb
+except ImportError:
+    from_wkb = None
+    from shapely import wkb
+
+# suffixes of the AOI files of a directory
+AOI_SUFFIXES = (".geojson", ".gpkg")
+
+# layers shared with the worker process, set by _init_worker
+_shared_layers = None
+
+
+def read_aois(path, name_column=None):
+    """Read the areas of interest of a batch.
+
+    Args:
+        path (Path): polygon file with one AOI per feature or directory with one AOI per .geojson/.gpkg file
+        name_column (String): column with the names of the AOIs (polygon file only).
+            None: the column name if it exists, otherwise the number of the feature
+
+    Returns:
+        GeoDataFrame: one row per AOI with the columns name and geometry in EPSG:4326
+    """
+    import inputOutput
+
+    if path.is_dir():
+        files = sorted(file for file in path.iterdir() if file.suffix.lower() in AOI_SUFFIXES)
+        names = [file.stem for file in files]
+        # all features of a file form one AOI
+        geometries = [inputOutput.read_file(file, driver="gpd").to_crs(epsg=4326).unary_union for file in files]
+    else:
+        data = inputOutput.read_file(path, driver="gpd").to_crs(epsg=4326)
+        if name_column is None and "name" in data.columns:
+            name_column = "name"
+        if name_column is not None and name_column not in data.columns:
+            raise ValueError(f"column {name_column} not found in {path.name}")
+        names = data[name_column].astype(str) if name_column else [str(i) for i in range(len(data))]
+        geometries = list(data.geometry)
+
+    # the names are part of the file names of the maps
+    names = [re.sub(r"[^\w.-]+", "_", name) for name in names]
+    if len(set(names)) < len(names):
+        raise ValueError("the names of the areas of interest are not unique")
+    if not names:
+        raise ValueError(f"no areas of interest found in {path}")
+    return gpd.GeoDataFrame({"name": names}, geometry=geometries, crs="EPSG:4326")
+
+
+def share_layer(layer):
+    """Copy the geometries of a layer as WKB into shared memory.
+
+    The block starts with the offsets of the geometries (n + 1 int64), followed by the concatenated WKB.
+
+    Args:
+        layer (GeoDataFrame): layer to be shared
+
+    Returns:
+        SharedMemory: block with the geometries, it has to be closed and unlinked by the caller
+    """
+    geometries = np.asarray(layer.geometry)
+    wkbs = list(to_wkb(geometries)) if from_wkb else [geometry.wkb for geometry in geometries]
+    offsets = np.zeros(len(wkbs) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum([len(data) for data in wkbs])
+
+    header = offsets.nbytes
+    shm = SharedMemory(create=True, size=header + int(offsets[-1]))
+    shm.buf[:header] = offsets.tobytes()
+    shm.buf[header:header + int(offsets[-1])] = b"".join(wkbs)
+    return shm
+
+
+def load_geometries(shm_name, n_features, positions):
+    """Decode the geometries at the given positions of a layer in shared memory, see share_layer.
+
+    Args:
+        shm_name (String): name of the shared memory block
+        n_features (Integer): number of geometries of the layer
+        positions (numpy array): positions of the geometries to be decoded
+
+    Returns:
+        list: shapely geometries
+    """
+    shm = SharedMemory(name=shm_name)
+    try:
+        header = (n_features + 1) * 8
+        offsets = np.frombuffer(shm.buf[:header], dtype=np.int64).copy()
+        wkbs = [bytes(shm.buf[header + offsets[i]:header + offsets[i + 1]]) for i in positions]
+    finally:
+        shm.close()
+    if from_wkb:
+        return list(from_wkb(wkbs))
+    return [wkb.loads(data) for data in wkbs]
+
+
+def _init_worker(shared_layers):
+    """Remember the shared layers in the worker process, the maps are only saved and never shown."""
+    global _shared_layers
+    import matplotlib
+
+    # the listener thread of --async_log only runs in the parent process
+    stop_async_logging()
+
+    matplotlib.use("Agg")
+    _shared_layers = shared_layers
+
+
+def _render_aoi(name, aoi_wkb, selections, options):
+    """Clip the layers to one AOI and save its map, runs in a worker process.
+
+    Returns:
+        String: saved, or skipped if there are no features inside of the AOI
+    """
+    from mapping import map_gpd, plot_pixels, simplify_layers
+
+    aoi = from_wkb(aoi_wkb) if from_wkb else wkb.loads(aoi_wkb)
+    rows = []
+    for shared, positions in zip(_shared_layers, selections):
+        if not len(positions):
+            continue
+        geometries = load_geometries(shared["shm_name"], shared["n_features"], positions)
+        layer = gpd.GeoDataFrame(geometry=geometries, crs=f"EPSG:{options['crs_epsg']}")
+        layer = gpd.clip(layer, aoi).reset_index(drop=True)
+        if not layer.empty:
+            rows.append((shared["name"], shared["color"], layer))
+    if not rows:
+        logger_f.warning("no features inside of the area of interest %s. Skip map.", name)
+        return "skipped"
+
+    map_layer = pd.DataFrame(rows, columns=["Name", "Color", "Layers"])
+    if options["lod"]:
+        map_layer = simplify_layers(map_layer, pixels=plot_pixels("gpd"))
+
+    # the last layer is plotted first, see run_plotting
+    reverse_map = map_layer.iloc[::-1].reset_index(drop=True)
+    title = f"{options['title']} {name}"
+    map_gpd(
+        reverse_map,
+        options["crs_epsg"],
+        options["basemap"],
+        title,
+        save_plot=True,
+        render_mode=options["render_mode"],
+        offline=options["offline"],
+        show_plot=False,
+    )
+    return "saved"
+
+
+@profiling.traced()
+def render_batch(map_layer, aois, workers=4, **options):
+    """Render one map per AOI in a pool of worker processes.
+
+    Args:
+        map_layer (DataFrame): with the columns Name, Color and last column GeoDataFrames in the crs of the maps
+        aois (GeoDataFrame): areas of interest with the column name, see read_aois
+        workers (Integer): number of worker processes
+        **options: crs_epsg, basemap, title, render_mode, offline and lod of the maps, see map_gpd
+
+    Returns:
+        dict: names of the AOIs by result: saved, skipped (no features inside of the AOI) and failed
+    """
+    aois = aois.to_crs(epsg=options["crs_epsg"])
+    shms = []
+    try:
+        shared_layers = []
+        for name, color, layer in zip(map_layer["Name"], map_layer["Color"], map_layer.iloc[:, -1]):
+            shms.append(share_layer(layer))
+            shared_layers.append({"name": name, "color": color, "shm_name": shms[-1].name, "n_features": len(layer)})
+
+        # the spatial index is only queried here, the workers get the positions of the features of their AOI
+        tasks = {}
+        for name, aoi in zip(aois["name"], aois.geometry):
+            selections = [layer.sindex.query(aoi, predicate="intersects") for layer in map_layer.iloc[:, -1]]
+            aoi_wkb = to_wkb(aoi) if from_wkb else aoi.wkb
+            tasks[name] = (name, aoi_wkb, selections, options)
+
+        results = {"saved": [], "skipped": [], "failed": []}
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(shared_layers,)) as executor:
+            futures = {executor.submit(_render_aoi, *task): name for name, task in tasks.items()}
+            for future in as_completed(futures):
+                name = futures[future]
+                # a failing AOI must not abort the others
+                try:
+                    result = future.result()
+                except (Exception, SystemExit) as err:
+                    logger_f.error("map of %s failed: %r", name, err)
+                    result = "failed"
+                else:
+                    if result == "saved":
+                        logger_f.info("map of %s saved", name)
+                results[result].append(name)
+    finally:
+        for shm in shms:
+            shm.close()
+            shm.unlink()
+    return results
@@ -0,0 +1,625 @@
+"""Benchmarks of the mapping tool, e.g. `python src/benchmark.py startup` or `python src/benchmark.py pipeline`.
+
+All benchmarks run offline: the layers are generated, the ohsome API and the tile servers are replaced by local stubs.
+"""
+import io
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from contextlib import ExitStack, contextmanager
+from datetime import datetime
+from pathlib import Path
+import click
+import numpy as np
+from definitions import OUTPUT_PATH, ROOT_DIR
+
+SRC_DIR = Path(__file__).resolve().parent
+
+BENCHMARK_PATH = OUTPUT_PATH / "benchmark"
+
+# modules the commands import on top of main with their default options: the imports at the beginning of the commands
+# and of the functions they call. test_lazy_imports checks that every command is listed
+COMMAND_IMPORTS = {
+    "--help": [],
+    "run-download": ["inputOutput", "download_cache", "ohsome_api"],
+    "run-plotting --plot_package gpd": [
+        "inputOutput",
+        "matplotlib.colors",
+        "mapping",
+        "basemap_cache",
+        "matplotlib.pyplot",
+        "rasterize",
+        "matplotlib.lines",
+        "matplotlib.patches",
+        "matplotlib_scalebar.scalebar",
+        "matplotlib.collections",
+        "matplotlib.path",
+        "contextily",
+    ],
+    "run-plotting --plot_package bokeh": [
+        "inputOutput",
+        "matplotlib.colors",
+        "mapping",
+        "bokeh.io",
+        "bokeh.plotting",
+        "bokeh.layouts",
+        "bokeh.models",
+        "bokeh.tile_providers",
+        "png_export",
+        "matplotlib.pyplot",
+        "matplotlib.collections",
+        "matplotlib.patches",
+        "matplotlib.path",
+        "contextily",
+    ],
+    "run --plot_package gpd": [
+        "inputOutput",
+        "download_cache",
+        "ohsome_api",
+        "matplotlib.colors",
+        "mapping",
+        "basemap_cache",
+        "matplotlib.pyplot",
+        "rasterize",
+        "matplotlib.lines",
+        "matplotlib.patches",
+        "matplotlib_scalebar.scalebar",
+        "matplotlib.collections",
+        "matplotlib.path",
+        "contextily",
+    ],
+    "run-batch": ["basemap_cache", "batch", "inputOutput", "mapping", "ohsome_api", "download_cache", "matplotlib.colors"],
+    "create-tiles": ["inputOutput", "vector_tiles", "mapping", "xyzservices", "matplotlib.colors"],
+    "prefetch-tiles": ["basemap_cache", "inputOutput", "pandas", "mapping", "xyzservices"],
+    "serve": [
+        "inputOutput",
+        "server",
+        "mapping",
+        "matplotlib.colors",
+        "bokeh.application",
+        "bokeh.application.handlers.function",
+        "bokeh.server.server",
+        "tornado.web",
+        "bokeh.events",
+        "bokeh.layouts",
+        "bokeh.models",
+        "bokeh.plotting",
+        "bokeh.tile_providers",
+        "rasterize",
+    ],
+}
+
+
+def startup_code(command, modules):
+    """Python code that starts the cli with the given command and imports the modules of the command.
+
+    Args:
+        command (String): command and options, --help is appended
+        modules (list): modules imported by the command
+
+    Returns:
+        String: code to be run with python -c
+    """
+    args = [arg for arg in command.split() if arg != "--help"] + ["--help"]
+    lines = ["import main"] + [f"import {module}" for module in modules]
+    lines += ["try:", f"    main.cli({args!r}, prog_name='mapping_tool')", "except SystemExit:", "    pass"]
+    return "\n".join(lines)
+
+
+def parse_importtime(stderr):
+    """Parse the output of python -X importtime.
+
+    Args:
+        stderr (String): standard error of the python process
+
+    Returns:
+        dict: top level module -> cumulative import time in milliseconds
+    """
+    times = {}
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        # nested imports are indented below the module importing them
+        if not name.startswith("  "):
+            times[name.strip()] = int(cumulative) / 1000
+    return times
+
+
+def measure_startup(command, modules, repeat=5):
+    """Measure the startup of a command in fresh python processes.
+
+    Args:
+        command (String): command and options
+        modules (list): modules imported by the command
+        repeat (Integer): number of runs, the median is reported
+
+    Returns:
+        dict: median wall time and import time in milliseconds, number of imported modules and the slowest imports
+    """
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join([str(SRC_DIR), os.environ.get("PYTHONPATH", "")]))
+    code = startup_code(command, modules)
+
+    wall, imports = [], []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        process = subprocess.run(
+            [sys.executable, "-X", "importtime", "-c", code], cwd=ROOT_DIR, env=env, capture_output=True, text=True
+        )
+        wall.append((time.perf_counter() - start) * 1000)
+        if process.returncode:
+            raise click.ClickException(f"startup of '{command}' failed:\n{process.stderr[-2000:]}")
+        imports.append(parse_importtime(process.stderr))
+
+    times = imports[-1]
+    return {
+        "command": command,
+        "wall_ms": round(statistics.median(wall), 1),
+        "import_ms": round(statistics.median(sum(run.values()) for run in imports), 1),
+        "modules": len(times),
+        "slowest": dict(sorted(times.items(), key=lambda x: -x[1])[:5]),
+    }
+
+
+def save_results(name, results):
+    """Save benchmark results with the environment they were measured in as json.
+
+    Args:
+        name (String): name of the benchmark
+        results (list): one dict per scenario
+
+    Returns:
+        Path: path of the result file
+    """
+    BENCHMARK_PATH.mkdir(parents=True, exist_ok=True)
+    path = BENCHMARK_PATH / f"{name}_{datetime.now():%Y%m%d_%H%M%S}.json"
+    report = {
+        "benchmark": name,
+        "timestamp": datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "results": results,
+    }
+    with open(path, "w") as f:
+        json.dump(report, f, indent=2)
+    return path
+
+
+############################## SYNTHETIC LAYERS ##############################
+
+# layers are generated within Heidelberg (EPSG:4326), the area of the example input
+SYNTHETIC_BOUNDS = (8.57, 49.35, 8.79, 49.46)
+
+# number of vertices of the synthetic lines
+LINE_VERTICES = 6
+
+GEOMETRY_TYPES = ["point", "line", "polygon"]
+
+
+def synthetic_layer(geometry_type, n_features, seed=0):
+    """Generate a layer like it is downloaded from the ohsome API.
+
+    Points are spread uniformly, lines are random walks of LINE_VERTICES vertices with steps of about 30 m and
+    polygons are building sized rectangles (10 to 40 m).
+
+    Args:
+        geometry_type (String): point, line, polygon
+        n_features (Integer): number of features
+        seed (Integer): seed of the random generator -> the same layer for every run
+
+    Returns:
+        GeoDataFrame: layer with the columns @osmId and geometry in EPSG:4326
+    """
+    import geopandas as gpd
+    import shapely.geometry
+
+    rng = np.random.default_rng(seed)
+    west, south, east, north = SYNTHETIC_BOUNDS
+    start = np.column_stack([rng.uniform(west, east, n_features), rng.uniform(south, north, n_features)])
+
+    if geometry_type == "point":
+        osm_type = "node"
+        coords = start
+        geometries = gpd.points_from_xy(coords[:, 0], coords[:, 1])
+    elif geometry_type == "line":
+        osm_type = "way"
+        steps = rng.normal(0, 0.0003, (n_features, LINE_VERTICES - 1, 2))
+        coords = np.concatenate([start[:, None], start[:, None] + np.cumsum(steps, axis=1)], axis=1)
+        geometries = _from_coords(coords, "linestrings", shapely.geometry.LineString)
+    elif geometry_type == "polygon":
+        osm_type = "way"
+        half_size = rng.uniform(0.00005, 0.0002, (n_features, 1, 2))
+        corners = np.array([[-1, -1], [1, -1], [1, 1], [-1, 1], [-1, -1]])
+        coords = start[:, None] + corners[None] * half_size
+        geometries = _from_coords(coords, "polygons", shapely.geometry.Polygon)
+    else:
+        raise ValueError(f"geometry type {geometry_type} not found")
+
+    osm_ids = np.char.add(f"{osm_type}/", np.arange(n_features).astype(str))
+    return gpd.GeoDataFrame({"@osmId": osm_ids}, geometry=geometries, crs="EPSG:4326")
+
+
+def _from_coords(coords, constructor, geometry_class):
+    """Create lines or polygons from an array of shape (features, vertices, 2)."""
+    try:
+        # shapely >= 2.0 creates all geometries at once
+        import shapely
+
+        return getattr(shapely, constructor)(coords)
+    except AttributeError:
+        return [geometry_class(feature) for feature in coords]
+
+
+############################## STUBS ##############################
+
+
+class _StubResponse:
+    """Successful response with a fixed body, all the code under test uses of requests.Response."""
+
+    status_code = 200
+    ok = True
+
+    def __init__(self, content):
+        self.content = content
+
+    def json(self):
+        return json.loads(self.content)
+
+    def raise_for_status(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class _StubSession:
+    """Stand-in of the sessions of ohsome_api and basemap_cache, answers every request with the same body."""
+
+    def __init__(self, content):
+        self.content = content
+
+    def request(self, method, url, **kwargs):
+        return _StubResponse(self.content)
+
+    def get(self, url, **kwargs):
+        return _StubResponse(self.content)
+
+
+@contextmanager
+def _patch(obj, name, value):
+    """Replace an attribute of a module for the duration of the context."""
+    original = getattr(obj, name)
+    setattr(obj, name, value)
+    try:
+        yield
+    finally:
+        setattr(obj, name, original)
+
+
+@contextmanager
+def offline_stubs(tmp_dir, layer=None):
+    """Replace the tile servers, the tile cache and the plot output folder, and optionally the ohsome API.
+
+    Args:
+        tmp_dir (Path): directory of the tile cache and the plots
+        layer (GeoDataFrame): layer every ohsome request returns. None: keep the ohsome API
+    """
+    import basemap_cache
+    import mapping
+    import ohsome_api
+    from PIL import Image
+
+    tile = io.BytesIO()
+    Image.new("RGB", (256, 256), "lightgrey").save(tile, format="PNG")
+    with ExitStack() as stack:
+        stack.enter_context(_patch(basemap_cache, "TILE_CACHE_PATH", tmp_dir / "tiles"))
+        stack.enter_context(_patch(basemap_cache, "_get_session", lambda: _StubSession(tile.getvalue())))
+        stack.enter_context(_patch(mapping, "OUTPUT_PATH", tmp_dir))
+        if layer is not None:
+            session = _StubSession(layer.to_json().encode("utf-8"))
+            stack.enter_context(_patch(ohsome_api, "get_session", lambda: session))
+        yield
+
+
+############################## PIPELINE ##############################
+
+PIPELINE_STAGES = ["download", "save", "read", "change_crs", "create_statistics", "map_gpd", "map_bokeh", "export_png"]
+DRIVERS = {"GeoJSON": "geojson", "gpkg": "gpkg", "parquet": "parquet"}
+
+# the basemap of the plots, its tiles come from the stub
+PROVIDER = "OpenStreetMap.Mapnik"
+
+
+def measure(func, repeat=3, memory=True):
+    """Measure the run time and the peak memory of a function.
+
+    The time is measured without tracemalloc, which slows down allocations. The memory is measured in an extra run.
+
+    Args:
+        func (function): function without arguments
+        repeat (Integer): number of timed runs
+        memory (Boolean): True: measure the peak of the memory allocated by python and numpy
+
+    Returns:
+        dict: median and minimum time in seconds, peak memory in MB (None if not measured)
+    """
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+
+    peak = None
+    if memory:
+        tracemalloc.start()
+        try:
+            func()
+            peak = tracemalloc.get_traced_memory()[1] / 1e6
+        finally:
+            tracemalloc.stop()
+    return {
+        "seconds": round(statistics.median(times), 4),
+        "min_seconds": round(min(times), 4),
+        "peak_mb": None if peak is None else round(peak, 1),
+    }
+
+
+def run_pipeline(sizes, geometry_types, drivers, stages, repeat=3, memory=True):
+    """Measure the stages of the pipeline with synthetic layers.
+
+    Args:
+        sizes (list): numbers of features
+        geometry_types (list): point, line, polygon
+        drivers (list): GeoJSON, gpkg, parquet (stages save and read)
+        stages (list): see PIPELINE_STAGES
+        repeat (Integer): number of timed runs per scenario
+        memory (Boolean): True: measure the peak memory of every scenario
+
+    Yields:
+        dict: result of a scenario with stage, geometry, features and driver
+    """
+    import matplotlib
+
+    matplotlib.use("Agg")
+    import inputOutput
+    from bokeh.embed import file_html
+    from bokeh.resources import CDN
+    from mapping import change_crs, create_statistics, map_bokeh, map_gpd
+    import png_export
+    from ohsome_api import download_osm
+    import pandas as pd
+    import geopandas as gpd
+    from shapely.geometry import box
+
+    with tempfile.TemporaryDirectory() as tmp:
+        tmp_dir = Path(tmp)
+        for geometry_type in geometry_types:
+            for n_features in sizes:
+                layer = synthetic_layer(geometry_type, n_features)
+                scenario = {"geometry": geometry_type, "features": n_features}
+
+                if "download" in stages:
+                    # the stub returns the layer as GeoJSON -> parsing the response and building the GeoDataFrame
+                    bpolys = gpd.GeoDataFrame(geometry=[box(*SYNTHETIC_BOUNDS)], crs="EPSG:4326")
+                    with offline_stubs(tmp_dir, layer=layer):
+                        result = measure(lambda: download_osm("synthetic=*", None, bpolys), repeat, memory)
+                    yield {"stage": "download", **scenario, "driver": None, **result}
+
+                for driver in drivers:
+                    path = tmp_dir / f"{geometry_type}_{n_features}.{DRIVERS[driver]}"
+                    save = lambda: inputOutput.save_osm(path, driver, layer.set_index("@osmId"))
+                    if "save" in stages:
+                        yield {"stage": "save", **scenario, "driver": driver, **measure(save, repeat, memory)}
+                    else:
+                        save()
+                    if "read" in stages:
+                        result = measure(lambda: inputOutput.read_file(path, "gpd"), repeat, memory)
+                        yield {"stage": "read", **scenario, "driver": driver, **result}
+                    path.unlink()
+
+                map_layer = pd.DataFrame({"Name": [geometry_type], "Color": ["#094884"], "Layers": [layer]})
+                if "change_crs" in stages:
+                    result = measure(lambda: change_crs(map_layer.copy(), 3857), repeat, memory)
+                    yield {"stage": "change_crs", **scenario, "driver": None, **result}
+                projected = change_crs(map_layer.copy(), 3857)
+
+                if "create_statistics" in stages:
+                    result = measure(lambda: create_statistics(projected), repeat, memory)
+                    yield {"stage": "create_statistics", **scenario, "driver": None, **result}
+
+                with offline_stubs(tmp_dir):
+                    if "map_gpd" in stages:
+                        # matplotlib draws when saving -> the plot is saved
+                        render = lambda: map_gpd(projected, 3857, PROVIDER, "benchmark", save_plot=True, show_plot=False)
+                        yield {"stage": "map_gpd", **scenario, "driver": None, **measure(render, repeat, memory)}
+
+                    if "map_bokeh" in stages:
+                        # bokeh serializes the data when the html is created
+                        render = lambda: file_html(map_bokeh(projected, PROVIDER, "benchmark"), CDN)
+                        result = measure(render, repeat, memory)
+                        html_mb = round(len(render()) / 1e6, 2)
+                        yield {"stage": "map_bokeh", **scenario, "driver": None, **result, "html_mb": html_mb}
+
+                    if "export_png" in stages:
+                        # the PNG of the bokeh map drawn without browser, see png_export
+                        layout = map_bokeh(projected, PROVIDER, "benchmark")
+                        render = lambda: png_export.export_png(layout, tmp_dir / "bokeh.png")
+                        yield {"stage": "export_png", **scenario, "driver": None, **measure(render, repeat, memory)}
+
+
+def run_downloads(sizes, jobs, max_tile_features=0, repeat=3, **stub_options):
+    """Measure the download throughput against the local ohsome stub, see ohsome_stub.py.
+
+    Args:
+        sizes (list): numbers of features served by the stub, all of them are downloaded
+        jobs (list): numbers of parallel downloads, only used with tiling
+        max_tile_features (Integer): split the area of interest into tiles with at most this many features. 0: no tiling
+        repeat (Integer): number of timed runs per scenario
+        **stub_options: latency, jitter, error_rate and error_status of the stub, see OhsomeStubServer
+
+    Yields:
+        dict: result of a scenario with features, jobs, features per second and requests per endpoint
+    """
+    import geopandas as gpd
+    import ohsome_api
+    import ohsome_stub
+    from shapely.geometry import box
+
+    bpolys = gpd.GeoDataFrame(geometry=[box(*ohsome_stub.DEFAULT_EXTENT)], crs="EPSG:4326")
+    original_url = ohsome_api.endpoint_url("").rstrip("/")
+    for n_features in sizes:
+        server = ohsome_stub.start_server(n_features, **stub_options)
+        try:
+            for n_jobs in jobs if max_tile_features else [1]:
+                ohsome_api.configure_client(url=server.url, backoff=0.1, pool_size=max(10, n_jobs * n_jobs))
+                server.requests.clear()
+                download = lambda: ohsome_api.download_osm("synthetic=*", None, bpolys, max_tile_features, jobs=n_jobs)
+                result = measure(download, repeat, memory=False)
+                yield {
+                    "stage": "download",
+                    "features": n_features,
+                    "jobs": n_jobs,
+                    "max_tile_features": max_tile_features,
+                    **stub_options,
+                    **result,
+                    "features_per_s": round(n_features / result["seconds"]),
+                    "requests": {endpoint: count / repeat for endpoint, count in server.requests.items()},
+                }
+        finally:
+            server.shutdown()
+            server.server_close()
+            ohsome_api.configure_client(url=original_url)
+
+
+def compare_results(old, new, threshold=1.2):
+    """Compare the results of two runs of the same benchmark.
+
+    Args:
+        old (dict): report of the reference run, see save_results
+        new (dict): report of the compared run
+        threshold (Float): ratio of the times above which a scenario counts as regression
+
+    Returns:
+        list: tuples of scenario, old time, new time and ratio of all scenarios in both reports
+    """
+    metric = "wall_ms" if old["benchmark"] == "startup" else "seconds"
+    scenario_keys = ["stage", "geometry", "features", "driver", "command", "jobs", "max_tile_features"]
+
+    def scenarios(report):
+        return {tuple(result.get(key) for key in scenario_keys): result[metric] for result in report["results"]}
+
+    old_times, new_times = scenarios(old), scenarios(new)
+    rows = []
+    for scenario, new_time in new_times.items():
+        if scenario in old_times:
+            old_time = old_times[scenario]
+            ratio = new_time / old_time if old_time else float("inf")
+            label = " ".join(str(value) for value in scenario if value is not None)
+            rows.append((label, old_time, new_time, ratio, ratio > threshold))
+    return rows
+
+
+def _split(values):
+    """Split a comma separated option."""
+    return [value.strip() for value in values.split(",") if value.strip()]
+
+
+@click.group()
+def cli() -> None:
+    """Run benchmarks of the mapping tool, the results are saved to data/output/benchmark."""
+
+
+@cli.command()
+@click.option("--repeat", "-r", default=5, type=int, help="Specify how often each command is started. Default: 5")
+def startup(repeat: int) -> None:
+    """Measure the startup and import time of each command."""
+    results = []
+    for command, modules in COMMAND_IMPORTS.items():
+        result = measure_startup(command, modules, repeat=repeat)
+        click.echo(f"{command:<36} {result['wall_ms']:>8.0f} ms wall {result['import_ms']:>8.0f} ms imports")
+        results.append(result)
+    click.echo(f"results saved to {save_results('startup', results)}")
+
+
+@cli.command()
+@click.option(
+    "--sizes",
+    "-s",
+    default="1000,10000,100000",
+    help="Specify the numbers of features of the synthetic layers, from 1000 to 10000000. Default: 1000,10000,100000",
+)
+@click.option("--geometries", "-g", default=",".join(GEOMETRY_TYPES), help="Specify the geometry types. Default: all types")
+@click.option("--drivers", "-d", default=",".join(DRIVERS), help="Specify the drivers to save and read. Default: all drivers")
+@click.option("--stages", "-st", default=",".join(PIPELINE_STAGES), help="Specify the stages to measure. Default: all stages")
+@click.option("--repeat", "-r", default=3, type=int, help="Specify how often each scenario is timed. Default: 3")
+@click.option("--memory/--no-memory", default=True, help="Specify whether the peak memory is measured. Default: --memory")
+def pipeline(sizes: str, geometries: str, drivers: str, stages: str, repeat: int, memory: bool) -> None:
+    """Measure the stages of the pipeline with synthetic layers."""
+    sizes = [int(size) for size in _split(sizes)]
+    geometries, drivers, stages = _split(geometries), _split(drivers), _split(stages)
+    for values, choices, name in [(geometries, GEOMETRY_TYPES, "--geometries"), (drivers, DRIVERS, "--drivers")]:
+        unknown = set(values) - set(choices)
+        if unknown:
+            raise click.BadParameter(f"unknown values {', '.join(sorted(unknown))}", param_hint=name)
+    unknown = set(stages) - set(PIPELINE_STAGES)
+    if unknown:
+        raise click.BadParameter(f"unknown values {', '.join(sorted(unknown))}", param_hint="--stages")
+
+    results = []
+    for result in run_pipeline(sizes, geometries, drivers, stages, repeat=repeat, memory=memory):
+        scenario = f"{result['stage']} {result['geometry']} {result['features']} {result['driver'] or ''}"
+        click.echo(f"{scenario:<40} {result['seconds']:>10.3f} s {result['peak_mb'] or 0:>10.1f} MB")
+        results.append(result)
+    click.echo(f"results saved to {save_results('pipeline', results)}")
+
+
+@cli.command()
+@click.option("--sizes", "-s", default="10000,100000", help="Specify the numbers of features of the stub. Default: 10000,100000")
+@click.option("--jobs", "-j", default="1,4", help="Specify the numbers of parallel downloads (with tiling). Default: 1,4")
+@click.option(
+    "--max_tile_features",
+    "-mtf",
+    default=0,
+    type=int,
+    help="Specify the maximum number of features per tile. Default: 0 (no tiling)",
+)
+@click.option("--latency", "-l", default=0.0, type=float, help="Specify the delay of every response in seconds. Default: 0")
+@click.option("--error_rate", "-er", default=0.0, type=float, help="Specify the share of failing requests. Default: 0")
+@click.option("--repeat", "-r", default=3, type=int, help="Specify how often each scenario is timed. Default: 3")
+def download(sizes: str, jobs: str, max_tile_features: int, latency: float, error_rate: float, repeat: int) -> None:
+    """Measure the download throughput against the local ohsome stub."""
+    sizes, jobs = [int(size) for size in _split(sizes)], [int(n_jobs) for n_jobs in _split(jobs)]
+    results = []
+    for result in run_downloads(sizes, jobs, max_tile_features, repeat, latency=latency, error_rate=error_rate):
+        scenario = f"{result['features']} features, {result['jobs']} jobs"
+        click.echo(f"{scenario:<40} {result['seconds']:>10.3f} s {result['features_per_s']:>10} features/s")
+        results.append(result)
+    click.echo(f"results saved to {save_results('download', results)}")
+
+
+@cli.command()
+@click.argument("old", type=click.Path(exists=True, path_type=Path))
+@click.argument("new", type=click.Path(exists=True, path_type=Path))
+@click.option("--threshold", "-th", default=1.2, type=float, help="Specify the ratio of slower scenarios. Default: 1.2")
+def compare(old: Path, new: Path, threshold: float) -> None:
+    """Compare two result files of the same benchmark, exits with 1 if a scenario is slower than the threshold."""
+    with open(old) as f_old, open(new) as f_new:
+        reports = json.load(f_old), json.load(f_new)
+    if reports[0]["benchmark"] != reports[1]["benchmark"]:
+        raise click.BadParameter("the files are results of different benchmarks")
+
+    rows = compare_results(*reports, threshold=threshold)
+    for label, old_time, new_time, ratio, regression in rows:
+        click.echo(f"{label:<40} {old_time:>10} {new_time:>10} {ratio:>6.2f}{'  REGRESSION' if regression else ''}")
+    if any(row[-1] for row in rows):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    cli()
@@ -1,6 +1,11 @@
 # Gives definitions about static path variables and encompasses logger settings.
+# Importing it has no side effects, the cli creates the directories and configures the loggers (see setup_logging).
+import atexit
 import logging
+import os
+import queue
 from logging import config
+from logging.handlers import QueueHandler, QueueListener
 from pathlib import Path
 
 ROOT_DIR = Path.cwd()
@@ -20,15 +25,17 @@ INPUT_PATH = DATA_PATH / "input"
 
 OUTPUT_PATH = DATA_PATH / "output"
 
+PROFILE_PATH = OUTPUT_PATH / "profile"
+
 INPUT_PATH_DOWNLOAD = INPUT_PATH / "input_download.json"
 INPUT_PATH_GPD = INPUT_PATH / "input_gpd.json"
 INPUT_PATH_BOKEH = INPUT_PATH / "input_bokeh.json"
 
-if not DATA_PATH.exists():
-    DATA_PATH.mkdir()
+CACHE_PATH = DATA_PATH / "cache"
+TILE_CACHE_PATH = CACHE_PATH / "tiles"
 
-if not LOG_DIR.exists():
-    LOG_DIR.mkdir()
+# e.g. the url of a local stand-in, see ohsome_stub.py
+OHSOME_API_URL = os.environ.get("OHSOME_API_URL", "https://api.ohsome.org/v1").rstrip("/")
 
 log_config = {
     "version": 1,
@@ -74,18 +81,110 @@ log_config = {
     },
 }
 
-config.dictConfig(log_config)
 ################ Logger #################
 logger_m = logging.getLogger("main")
 logger_f = logging.getLogger("function")
 
-logging.config.dictConfig(log_config)
-
 logger = logging.getLogger("mapper")
-logging.getLogger("shapely").setLevel(logging.WARNING)
-logging.getLogger("oauth2client.crypt").setLevel(logging.WARNING)
-logging.getLogger("fiona.env").setLevel(logging.WARNING)
-logging.getLogger("fiona._env").setLevel(logging.WARNING)
-logging.getLogger("Fiona").setLevel(logging.WARNING)
-logging.getLogger("fiona.ogrext").setLevel(logging.WARNING)
-logging.getLogger("fiona.collection").setLevel(logging.WARNING)
+
+# loggers of libraries that are too verbose on INFO
+QUIET_LOGGERS = ["shapely", "oauth2client.crypt", "fiona.env", "fiona._env", "Fiona", "fiona.ogrext", "fiona.collection"]
+
+# loggers whose handlers are moved to the listener thread in asynchronous mode ("" is the root logger)
+ASYNC_LOGGERS = ["", "main", "function"]
+
+_logging_configured = False
+
+# listener of the asynchronous mode and the original handlers of the loggers, see start_async_logging
+_listener = None
+_async_handlers = {}
+
+
+class _LoggerQueueListener(QueueListener):
+    """Listener passing the queued records to the handlers of the logger they were logged with."""
+
+    def __init__(self, log_queue, handlers):
+        """Listen to the queue, handlers: logger name -> handlers of the logger."""
+        super().__init__(log_queue)
+        self.logger_handlers = handlers
+
+    def handle(self, record):
+        """Handle a record like its logger would have, records of other loggers propagated to the root logger."""
+        record = self.prepare(record)
+        handlers = self.logger_handlers.get(record.name, self.logger_handlers.get("", []))
+        for handler in handlers:
+            if record.levelno >= handler.level:
+                handler.handle(record)
+
+
+def setup_logging(console=True, async_log=False):
+    """Create the log directory and configure the loggers, only the first call has an effect.
+
+    Args:
+        console (Boolean): False: the main and function loggers only log to the log files
+        async_log (Boolean): True: the log records are written by a background thread, see start_async_logging
+    """
+    global _logging_configured
+    if _logging_configured:
+        return
+    LOG_DIR.mkdir(parents=True, exist_ok=True)
+    config.dictConfig(log_config)
+    for name in QUIET_LOGGERS:
+        logging.getLogger(name).setLevel(logging.WARNING)
+    if not console:
+        for logger_name in ["main", "function"]:
+            log = logging.getLogger(logger_name)
+            for handler in [handler for handler in log.handlers if handler.name.startswith("console")]:
+                log.removeHandler(handler)
+    if async_log:
+        start_async_logging()
+    _logging_configured = True
+
+
+def start_async_logging(names=None):
+    """Move the handlers of the loggers to a background thread.
+
+    The loggers only put their records into a queue, so that e.g. parallel downloads do not wait for the locks of the
+    log files. The records are formatted (message and arguments) before they are queued.
+
+    Args:
+        names (list): names of the loggers. None: ASYNC_LOGGERS
+    """
+    global _listener
+    if _listener is not None:
+        return
+    log_queue = queue.SimpleQueue()
+    for name in ASYNC_LOGGERS if names is None else names:
+        log = logging.getLogger(name)
+        _async_handlers[name] = list(log.handlers)
+        for handler in _async_handlers[name]:
+            log.removeHandler(handler)
+        log.addHandler(QueueHandler(log_queue))
+    _listener = _LoggerQueueListener(log_queue, dict(_async_handlers))
+    _listener.start()
+    # the queued records are written before the program ends
+    atexit.register(stop_async_logging)
+
+
+def stop_async_logging():
+    """Write the queued records and let the loggers handle their records synchronously again, e.g. in worker processes."""
+    global _listener
+    if _listener is None:
+        return
+    # in forked worker processes the listener thread does not run, its queue is dropped
+    if _listener._thread is not None and _listener._thread.is_alive():
+        _listener.stop()
+    for name, handlers in _async_handlers.items():
+        log = logging.getLogger(name)
+        for handler in [handler for handler in log.handlers if isinstance(handler, QueueHandler)]:
+            log.removeHandler(handler)
+        for handler in handlers:
+            log.addHandler(handler)
+    _async_handlers.clear()
+    _listener = None
+
+
+def create_dirs():
+    """Create the data and output directories if they do not exist yet."""
+    for path in (DATA_PATH, OUTPUT_PATH):
+        path.mkdir(parents=True, exist_ok=True)
@@ -0,0 +1,194 @@
+"""Content-addressed cache for downloaded OSM layers."""
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time as _time
+from pathlib import Path
+from definitions import CACHE_PATH, OHSOME_API_URL, logger_f
+from shapely import wkt
+
+MANIFEST_PATH = CACHE_PATH / "manifest.json"
+
+# the manifest is shared by all download threads
+_manifest_lock = threading.Lock()
+
+
+def cache_key(filter, time, bpolys, endpoint=f"{OHSOME_API_URL}/elements/geometry", crs=4326):
+    """Create the cache key of a download request.
+
+    Args:
+        filter (String): query for the ohsome api
+        time (String): time parameter, None for the latest available data
+        bpolys (GeoDataFrame): area of interest
+        endpoint (String): ohsome endpoint the request is sent to
+        crs (Integer): EPSG of the CRS the layer is stored in
+
+    Returns:
+        String: sha256 hex digest of the normalized request
+    """
+    if bpolys.crs is not None:
+        bpolys = bpolys.to_crs(epsg=4326)
+    # merge all polygons and round the coordinates -> same area gives the same key, independent of the file it comes from
+    geometry = wkt.dumps(bpolys.unary_union, rounding_precision=7)
+
+    request = {
+        "filter": " ".join(filter.split()),  # whitespace does not change the query
+        "time": time,
+        "bpolys": geometry,
+        "endpoint": endpoint,
+    }
+    # layers in the CRS of the ohsome API keep the keys they had before the CRS was configurable
+    if crs != 4326:
+        request["crs"] = crs
+    return hashlib.sha256(json.dumps(request, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+def _read_manifest():
+    """Read the cache manifest, returns an empty one if there is none yet."""
+    if not MANIFEST_PATH.is_file():
+        return {}
+    try:
+        with open(MANIFEST_PATH, "r") as f:
+            return json.load(f)
+    except ValueError as err:
+        logger_f.warning(f"cache manifest is corrupt and will be rebuilt: {err}")
+        return {}
+
+
+def _write_manifest(manifest):
+    """Write the cache manifest atomically."""
+    CACHE_PATH.mkdir(parents=True, exist_ok=True)
+    tmp_path = MANIFEST_PATH.with_suffix(".tmp")
+    with open(tmp_path, "w") as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(tmp_path, MANIFEST_PATH)
+
+
+def _remove_entry(manifest, entry_id):
+    """Delete a cache entry and its file."""
+    entry = manifest.pop(entry_id)
+    (CACHE_PATH / entry["file"]).unlink(missing_ok=True)
+
+
+def get_cached_layer(key, driver, ttl=None):
+    """Look up a cached layer.
+
+    Args:
+        key (String): cache key, see cache_key
+        driver (String): JSON, GeoJSON, gpkg
+        ttl (Float): maximum age of the entry in hours. None: entries do not expire
+
+    Returns:
+        Path: path of the cached layer file, None if there is no valid entry
+    """
+    entry_id = f"{key}.{driver}"
+    with _manifest_lock:
+        manifest = _read_manifest()
+        entry = manifest.get(entry_id)
+        if entry is None:
+            return None
+
+        now = _time.time()
+        expired = ttl is not None and now - entry["created"] > ttl * 3600
+        if expired or not (CACHE_PATH / entry["file"]).is_file():
+            logger_f.info("cache entry %s is expired or missing", entry_id)
+            _remove_entry(manifest, entry_id)
+            _write_manifest(manifest)
+            return None
+
+        entry["last_access"] = now
+        _write_manifest(manifest)
+    return CACHE_PATH / entry["file"]
+
+
+def get_cache_info(key, driver):
+    """Get the manifest entry of a cached layer.
+
+    Args:
+        key (String): cache key, see cache_key
+        driver (String): JSON, GeoJSON, gpkg
+
+    Returns:
+        dict: copy of the manifest entry, None if the layer is not cached
+    """
+    with _manifest_lock:
+        entry = _read_manifest().get(f"{key}.{driver}")
+    return None if entry is None else dict(entry)
+
+
+def add_to_cache(key, driver, path, max_size=None, **info):
+    """Copy a downloaded layer file into the cache.
+
+    Args:
+        key (String): cache key, see cache_key
+        driver (String): JSON, GeoJSON, gpkg
+        path (Path): layer file to be cached
+        max_size (Integer): maximum size of the cache in bytes, least recently used entries are evicted. None: unbounded
+        **info: additional request information stored in the manifest (e.g. filter, time)
+
+    Returns:
+        Path: path of the cached layer file
+    """
+    CACHE_PATH.mkdir(parents=True, exist_ok=True)
+    entry_id = f"{key}.{driver}"
+    cache_file = CACHE_PATH / entry_id
+    # parallel downloads of the same request copy to their own temporary file, the last one replaces the cached file
+    with tempfile.NamedTemporaryFile(dir=CACHE_PATH, prefix=f"{entry_id}.", suffix=".tmp", delete=False) as tmp:
+        tmp_file = Path(tmp.name)
+    try:
+        shutil.copyfile(path, tmp_file)
+    except BaseException:
+        tmp_file.unlink(missing_ok=True)
+        raise
+
+    now = _time.time()
+    with _manifest_lock:
+        os.replace(tmp_file, cache_file)
+        manifest = _read_manifest()
+        manifest[entry_id] = {
+            "file": cache_file.name,
+            "driver": driver,
+            "size": cache_file.stat().st_size,
+            "created": now,
+            "last_access": now,
+            **info,
+        }
+        if max_size is not None:
+            _evict(manifest, max_size, keep=entry_id)
+        _write_manifest(manifest)
+    return cache_file
+
+
+def _evict(manifest, max_size, keep=None):
+    """Remove least recently used entries until the cache is not larger than max_size bytes."""
+    total = sum(entry["size"] for entry in manifest.values())
+    for entry_id in sorted(manifest, key=lambda x: manifest[x]["last_access"]):
+        if total <= max_size:
+            break
+        if entry_id == keep:
+            continue
+        total -= manifest[entry_id]["size"]
+        logger_f.info("evict %s from the download cache", entry_id)
+        _remove_entry(manifest, entry_id)
+
+
+def link_layer(cache_file, layer_path):
+    """Make a cached layer available under the layer path of the data folder.
+
+    A hard link is used if possible so that the layer is not stored twice, otherwise the file is copied.
+
+    Args:
+        cache_file (Path): path of the cached layer file
+        layer_path (Path): path the layer is expected at by the plotting functions
+    """
+    if layer_path.is_file():
+        if os.path.samefile(cache_file, layer_path):
+            return
+        layer_path.unlink()
+    try:
+        os.link(cache_file, layer_path)
+    except OSError:
+        shutil.copyfile(cache_file, layer_path)
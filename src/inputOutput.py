@@ -2,55 +2,83 @@
 import sys
 import pandas as pd
 import geopandas as gpd
-import fiona
 import json
+import numpy as np
+from pyproj import CRS, Transformer
+from shapely.geometry import box
+from pathlib import Path
 from definitions import logger_f
+import metrics
+import profiling
 import re
-import matplotlib.colors as mcolors
+from functools import lru_cache
+
+try:
+    # shapely >= 2.0 transforms the coordinates of all geometries at once
+    from shapely import transform
+except ImportError:
+    transform = None
+
+# fiona, pyarrow and matplotlib are imported by the functions using them -> downloads do not load them
 
 ##################### INPUT ######################
 
 
-def read_file(fpath, driver):
+def read_file(fpath, driver, columns=None, bbox=None, mask=None):
     """Read file based on given path and driver.
 
     Args:
         fpath (Path): a pathlib path
-        driver (String): self defined list of drivers: gpd, fiona, txt
+        driver (String): self defined list of drivers: gpd, parquet, fiona, txt, json
+        columns (list): only read these columns (parquet only, column projection). None: read all columns
+        bbox (tuple, GeoSeries): only read features intersecting this bounding box (gpd and parquet only).
+            A tuple has to be in the CRS of the file, a GeoSeries/GeoDataFrame is reprojected if required
+        mask (GeoSeries): only read features intersecting this geometry (gpd and parquet only)
 
     Returns:
         file: returns a file in the format of the provided driver
     """
-    try:
-        # returns geopandas.GeoDataframe
-        if driver == "gpd":
-            data = gpd.read_file(fpath)
-
-        # returns a Fiona collection object as list of dicts.
-        elif driver == "fiona":
-            with fiona.open(fpath, "r") as f:
-                data = list(f)
-
-        # returns a string
-        elif driver == "txt":
-            with open(fpath, "r") as f:
-                data = f.read()
-
-        elif driver == "json":
-            with open(fpath, "r") as f:
-                data = json.load(f)
-
-        else:
-            logger_f.error(f"read method '{driver}' not found")
-            data = None
-    except FileNotFoundError as err:
-        logger_f.error(f"{fpath} could not be found ", err)
-        sys.exit(1)
-    except OSError as err:
-        logger_f.error("system-related error: ", err)
-    except Exception as err:
-        logger_f.error("could not open file", err)
-        sys.exit(1)
+    timer = metrics.timer("mapping_tool_read_seconds", driver=driver)
+    with profiling.span("read", path=Path(fpath).name, driver=driver) as reading, timer:
+        try:
+            # returns geopandas.GeoDataframe, GeoParquet files are recognized by their suffix
+            if driver == "parquet" or (driver == "gpd" and Path(fpath).suffix == ".parquet"):
+                data = _read_parquet(fpath, columns=columns, bbox=bbox, mask=mask)
+
+            # the filter is pushed down to OGR, which uses the spatial index (R-tree) of GeoPackages
+            elif driver == "gpd":
+                data = gpd.read_file(fpath, bbox=bbox, mask=mask)
+
+            # returns a Fiona collection object as list of dicts.
+            elif driver == "fiona":
+                import fiona
+
+                with fiona.open(fpath, "r") as f:
+                    data = list(f)
+
+            # returns a string
+            elif driver == "txt":
+                with open(fpath, "r") as f:
+                    data = f.read()
+
+            elif driver == "json":
+                with open(fpath, "r") as f:
+                    data = json.load(f)
+
+            else:
+                logger_f.error(f"read method '{driver}' not found")
+                data = None
+        except FileNotFoundError as err:
+            logger_f.error(f"{fpath} could not be found ", err)
+            sys.exit(1)
+        except OSError as err:
+            logger_f.error("system-related error: ", err)
+        except Exception as err:
+            logger_f.error("could not open file", err)
+            sys.exit(1)
+        if isinstance(data, gpd.GeoDataFrame):
+            reading.count(data)
+            metrics.inc("mapping_tool_read_features_total", len(data), driver=driver)
     return data
 
 
@@ -59,27 +87,233 @@ def save_osm(path, driver, file):
 
     Args:
         path (Path): pathlib path
-        driver (String): JSON, GeoJSON, gpkg
+        driver (String): JSON, GeoJSON, gpkg, parquet
         file (file): the file to be saved
     """
+    with metrics.timer("mapping_tool_save_seconds", driver=driver):
+        try:
+            if driver == "JSON":
+                with open(path, "w+") as json_file:  # ATTENTION! will overwrite
+                    json.dump(file, json_file)
+            elif driver == "GeoJSON":
+                file.to_file(path, driver=driver)
+            elif driver == "gpkg":
+                file.to_file(path, driver=driver.upper())
+            elif driver == "parquet":
+                _save_parquet(path, file)
+            else:
+                logger_f.error(f"file method ({driver}) not found")
+        except FileNotFoundError as err:
+            logger_f.error(f"{path} could not be found ", err)
+            sys.exit(1)
+        except OSError as err:
+            logger_f.error("system-related error: ", err)
+        except Exception as err:
+            logger_f.error("something unexpected happened: ", err)
+            sys.exit(1)
+
+
+# bounding box columns of GeoParquet layers, their row group statistics allow to skip data outside of a bbox
+BBOX_COLUMNS = ["bbox_xmin", "bbox_ymin", "bbox_xmax", "bbox_ymax"]
+PARQUET_ROW_GROUP_SIZE = 50000
+
+
+def _save_parquet(path, file):
+    """Save a GeoDataFrame as GeoParquet, sorted spatially and with bounding box columns for filtered reads."""
+    # store the @osmId index as column like to_file does
+    if any(name is not None for name in file.index.names):
+        file = file.reset_index()
+
+    bounds = file.geometry.bounds.to_numpy()
+    file = file.assign(**dict(zip(BBOX_COLUMNS, bounds.T)))
+    # neighbouring features end up in the same row group -> small row group bounding boxes
+    if len(file):
+        file = file.iloc[np.argsort(_morton_code(bounds), kind="stable")]
+    file.to_parquet(path, index=False, row_group_size=PARQUET_ROW_GROUP_SIZE)
+
+
+def _morton_code(bounds):
+    """Z-order curve position of the center of each bounding box (n x 4 array)."""
+    centers = np.column_stack([bounds[:, 0] + bounds[:, 2], bounds[:, 1] + bounds[:, 3]]) / 2
+    centers = np.nan_to_num(centers)
+    low, high = centers.min(axis=0), centers.max(axis=0)
+    cells = ((centers - low) / np.where(high > low, high - low, 1) * 0xFFFF).astype(np.uint64)
+
+    code = np.zeros(len(cells), dtype=np.uint64)
+    for bit in range(16):
+        for dim in range(2):
+            code |= ((cells[:, dim] >> np.uint64(bit)) & np.uint64(1)) << np.uint64(2 * bit + dim)
+    return code
+
+
+def _read_parquet(fpath, columns=None, bbox=None, mask=None):
+    """Read a GeoParquet layer, bbox and mask are pushed down to the row group statistics of the bbox columns."""
+    import pyarrow.parquet as pq
+
+    names = pq.read_schema(fpath).names
+    has_bbox = all(col in names for col in BBOX_COLUMNS)
+    read_columns = columns if columns is None else [col for col in names if col in columns]
+
+    filters = None
+    area = mask if mask is not None else bbox
+    if area is not None:
+        crs = _parquet_crs(fpath)
+        if hasattr(area, "to_crs") and crs is not None:
+            area = area.to_crs(crs)
+        minx, miny, maxx, maxy = area.total_bounds if hasattr(area, "total_bounds") else getattr(area, "bounds", area)
+        if has_bbox:
+            filters = [("bbox_xmax", ">=", minx), ("bbox_xmin", "<=", maxx), ("bbox_ymax", ">=", miny), ("bbox_ymin", "<=", maxy)]
+
+    data = gpd.read_parquet(fpath, columns=read_columns, filters=filters)
+    data = data.drop(columns=[col for col in BBOX_COLUMNS if col in data.columns])
+
+    if area is not None:
+        # exact test, the bbox filter only compares the bounding boxes
+        geometry = area.unary_union if hasattr(area, "unary_union") else area
+        if mask is None:
+            geometry = box(minx, miny, maxx, maxy)
+        data = data[data.intersects(geometry)]
+    return data
+
+
+def _parquet_crs(fpath):
+    """Read the CRS of the primary geometry column of a GeoParquet file."""
+    import pyarrow.parquet as pq
+
+    geo = json.loads(pq.read_schema(fpath).metadata[b"geo"])
+    column = geo["columns"][geo["primary_column"]]
+    # the GeoParquet specification defaults to WGS84 if the crs is missing
+    return CRS.from_user_input(column["crs"]) if column.get("crs") is not None else CRS.from_epsg(4326)
+
+
+def save_osm_stream(path, driver, features, batch_size=10000):
+    """Append GeoJSON features batch by batch to a file, without holding all of them in memory.
+
+    The file is written to a temporary file first and only moved to path when it is complete.
+    GeoPackages get a text column for every property of any feature, the features are spooled to a temporary newline
+    delimited JSON file until all keys are known. Nothing is written if there are no features.
+
+    Args:
+        path (Path): pathlib path
+        driver (String): GeoJSON, gpkg
+        features (iterable): GeoJSON feature dicts
+        batch_size (Integer): number of features written at once
+
+    Returns:
+        Integer: number of written features
+    """
+    tmp_path = path.with_name(f"{path.stem}.part{path.suffix}")
+    spool_path = path.with_name(f"{path.stem}.part.jsonl")
+    n_features = 0
     try:
-        if driver == "JSON":
-            with open(path, "w+") as json_file:  # ATTENTION! will overwrite
-                json.dump(file, json_file)
-        elif driver == "GeoJSON":
-            file.to_file(path, driver=driver)
+        if driver == "GeoJSON":
+            with open(tmp_path, "w") as f:
+                f.write('{"type": "FeatureCollection", "features": [\n')
+                for feature in features:
+                    if n_features:
+                        f.write(",\n")
+                    json.dump(feature, f)
+                    n_features += 1
+                f.write("\n]}\n")
+
         elif driver == "gpkg":
-            file.to_file(path, driver=driver.upper())
+            import fiona
+
+            # OSM features do not share a fixed schema and the schema of a GeoPackage is fixed when it is created
+            # -> the features are spooled to newline delimited JSON until the keys of all of them are known
+            keys = {}
+            n_spooled = 0
+            with open(spool_path, "w") as f:
+                for feature in features:
+                    keys.update(dict.fromkeys(feature["properties"]))
+                    f.write(json.dumps(feature) + "\n")
+                    n_spooled += 1
+
+            if n_spooled:
+                # every property is stored as text
+                schema = {"geometry": "Unknown", "properties": {key: "str" for key in keys}}
+                with open(spool_path) as f, fiona.open(tmp_path, "w", driver="GPKG", schema=schema, crs="EPSG:4326") as dst:
+                    for batch in _batches(map(json.loads, f), batch_size):
+                        records = [
+                            {
+                                "type": "Feature",
+                                "geometry": feature["geometry"],
+                                "properties": {key: _to_str(feature["properties"].get(key)) for key in keys},
+                            }
+                            for feature in batch
+                        ]
+                        dst.writerecords(records)
+                        n_features += len(records)
         else:
-            logger_f.error(f"file method ({driver}) not found")
-    except FileNotFoundError as err:
-        logger_f.error(f"{path} could not be found ", err)
-        sys.exit(1)
-    except OSError as err:
-        logger_f.error("system-related error: ", err)
-    except Exception as err:
-        logger_f.error("something unexpected happened: ", err)
-        sys.exit(1)
+            logger_f.error(f"stream method ({driver}) not found")
+            return 0
+    except BaseException:
+        tmp_path.unlink(missing_ok=True)
+        raise
+    finally:
+        spool_path.unlink(missing_ok=True)
+
+    if n_features:
+        tmp_path.replace(path)
+    else:
+        tmp_path.unlink(missing_ok=True)
+    return n_features
+
+
+def _batches(iterable, size):
+    """Yield lists of at most size items of the iterable."""
+    batch = []
+    for item in iterable:
+        batch.append(item)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def _to_str(value):
+    """Convert a property value to text, keeps None."""
+    return None if value is None else str(value)
+
+
+@lru_cache(maxsize=32)
+def get_transformer(crs_from, crs_to):
+    """Get a transformer between two CRS, building one takes longer than reprojecting small layers.
+
+    Args:
+        crs_from (CRS, String): source CRS
+        crs_to (CRS, String): target CRS
+
+    Returns:
+        Transformer: pyproj transformer with x, y (lon, lat) axis order
+    """
+    return Transformer.from_crs(crs_from, crs_to, always_xy=True)
+
+
+def reproject(lay, crs_epsg):
+    """Reproject a layer with a cached transformer.
+
+    Args:
+        lay (GeoDataFrame): layer with a CRS
+        crs_epsg (Integer): EPSG of the target CRS
+
+    Returns:
+        GeoDataFrame: reprojected copy of the layer, the layer itself if it already is in the target CRS
+    """
+    crs = CRS.from_epsg(crs_epsg)
+    if lay.crs == crs:
+        return lay
+    with profiling.span("reproject", crs=crs_epsg) as reprojection:
+        reprojection.count(lay)
+        if lay.crs is None or transform is None:
+            return lay.to_crs(epsg=crs_epsg)
+
+        transformer = get_transformer(lay.crs, crs)
+        geometries = transform(np.asarray(lay.geometry), lambda coords: np.column_stack(transformer.transform(*coords.T)))
+        reprojected = lay.copy()
+        reprojected[lay.geometry.name] = gpd.GeoSeries(geometries, index=lay.index, crs=crs)
+        return reprojected
 
 
 # does more or less the same as the function below, just for string input
@@ -159,6 +393,8 @@ def check_color(color):
     Returns:
         bool: True if color is valid, False if not
     """
+    import matplotlib.colors as mcolors
+
     valid = False
     if color.startswith("#"):
         # check if hext
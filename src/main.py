@@ -6,20 +6,26 @@ from definitions import (
     INPUT_PATH_BOKEH,
     INPUT_PATH_DOWNLOAD,
     INPUT_PATH_GPD,
+    LOG_DIR,
+    OHSOME_API_URL,
+    create_dirs,
     logger_m,
     logger_f,
     OUTPUT_PATH,
+    PROFILE_PATH,
+    setup_logging,
 )
-from mapping import change_crs, get_cx_providers, map_bokeh, map_gpd, map_multiple
-from ohsome_api import download_osm
-import inputOutput
 import click
+from datetime import datetime
 from pathlib import Path
 import sys
-from bokeh.io import show
-from bokeh.plotting import output_file
-from bokeh.plotting import save
-from bokeh.io import export_png
+import time as _time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import metrics
+import profiling
+
+# the geo libraries and plotting backends are imported by the commands using them,
+# so that e.g. --help or run-download do not load bokeh and matplotlib
 
 _driver_option = [
     click.option(
@@ -27,7 +33,7 @@ _driver_option = [
         "-d",
         default="GeoJSON",
         type=str,
-        help="Specify the type in which the OSM layers should be saved. gpkg or Default: GeoJSON",
+        help="Specify the type in which the OSM layers should be saved. gpkg, parquet (GeoParquet) or Default: GeoJSON",
     )
 ]
 
@@ -99,6 +105,269 @@ _random_baserlayer_option = [
     )
 ]
 
+_jobs_option = [
+    click.option(
+        "--jobs",
+        "-j",
+        default=1,
+        type=int,
+        help="Specify how many layers should be downloaded in parallel. Default: 1",
+    )
+]
+
+_cache_ttl_option = [
+    click.option(
+        "--cache_ttl",
+        "-ct",
+        default=0,
+        type=float,
+        help="Specify after how many hours a cached download expires. Default: 0 (never expires)",
+    )
+]
+
+_cache_size_option = [
+    click.option(
+        "--cache_size",
+        "-cs",
+        default=2048,
+        type=int,
+        help="Specify the maximum size of the download cache in MB. Least recently used layers are evicted. Default: 2048",
+    )
+]
+
+_max_tile_features_option = [
+    click.option(
+        "--max_tile_features",
+        "-mt",
+        default=0,
+        type=int,
+        help="Split large areas of interest into tiles with at most this many (estimated) features each. \
+            Tiles are downloaded in parallel (see --jobs). Default: 0 (no tiling)",
+    )
+]
+
+_stream_option = [
+    click.option(
+        "--stream",
+        "-s",
+        default=False,
+        type=bool,
+        help="Specify whether downloaded features should be written straight to the layer file in batches \
+            (bounded memory, GeoJSON and gpkg only, no tiling) or not. Default: False",
+    )
+]
+
+_refresh_option = [
+    click.option(
+        "--refresh",
+        "-r",
+        is_flag=True,
+        help="Update cached layers with the OSM changes since they were downloaded instead of using them as they are. \
+            Only layers without time parameter can be refreshed.",
+    )
+]
+
+_timeout_option = [
+    click.option(
+        "--timeout",
+        "-to",
+        default=600,
+        type=float,
+        help="Specify after how many seconds without response a request to the ohsome API is aborted. Default: 600",
+    )
+]
+
+_retries_option = [
+    click.option(
+        "--retries",
+        "-rt",
+        default=5,
+        type=int,
+        help="Specify how often failed requests (timeouts, connection and server errors) are retried \
+            with exponential backoff. Default: 5",
+    )
+]
+
+_rate_limit_option = [
+    click.option(
+        "--rate_limit",
+        "-rl",
+        default=0,
+        type=float,
+        help="Specify the maximum number of requests per second sent to the ohsome API. Default: 0 (unlimited)",
+    )
+]
+
+_extent_option = [
+    click.option(
+        "--extent",
+        "-e",
+        default=None,
+        type=str,
+        help="Specify the map extent as 'minx,miny,maxx,maxy' in EPSG:4326. Only features inside of it are read and \
+            plotted. Default: None (whole layers)",
+    )
+]
+
+_lod_option = [
+    click.option(
+        "--lod",
+        "-l",
+        is_flag=True,
+        help="Simplify lines and polygons to the level of detail visible on the plot. Speeds up plotting of large layers \
+            and reduces the size of saved plots.",
+    )
+]
+
+_render_mode_option = [
+    click.option(
+        "--render_mode",
+        "-rm",
+        default="vector",
+        type=click.Choice(["vector", "raster"]),
+        help="Specify how the layers are drawn. vector: every feature. raster: the features are aggregated per pixel \
+            (points counted, line lengths and polygon coverage summed up) and drawn as one image per layer, fast for \
+            layers with millions of features. Default: vector",
+    )
+]
+
+_png_export_option = [
+    click.option(
+        "--png_export",
+        "-pe",
+        default="native",
+        type=click.Choice(["native", "browser"]),
+        help="Specify how the PNG of bokeh plots is saved. native: the maps are drawn with matplotlib, no browser needed. \
+            browser: bokeh exports the whole layout with a headless browser (needs selenium and a webdriver). Default: native",
+    )
+]
+
+_port_option = [
+    click.option(
+        "--port",
+        "-po",
+        default=5006,
+        type=int,
+        help="Specify the port of the bokeh server. Default: 5006",
+    )
+]
+
+_max_features_option = [
+    click.option(
+        "--max_features",
+        "-mf",
+        default=50000,
+        type=int,
+        help="Specify how many features of a layer in the viewport are sent to the browser, layers with more features \
+            are aggregated per pixel of the viewport and sent as image. Default: 50000",
+    )
+]
+
+_min_zoom_option = [
+    click.option(
+        "--min_zoom",
+        "-minz",
+        default=10,
+        type=click.IntRange(0, 22),
+        help="Specify the lowest zoom level of the vector or basemap tiles. Default: 10",
+    )
+]
+
+_max_zoom_option = [
+    click.option(
+        "--max_zoom",
+        "-maxz",
+        default=14,
+        type=click.IntRange(0, 22),
+        help="Specify the highest zoom level of the vector or basemap tiles, the vector tile map shows this level when \
+            zooming in further. Default: 14",
+    )
+]
+
+_offline_option = [
+    click.option(
+        "--offline",
+        "-off",
+        is_flag=True,
+        help="Only use basemap tiles of the tile cache (see prefetch-tiles), never connect to a tile server.",
+    )
+]
+
+_tile_cache_size_option = [
+    click.option(
+        "--tile_cache_size",
+        "-tcs",
+        default=1024,
+        type=int,
+        help="Specify the maximum size of the basemap tile cache in MB, least recently used tiles are removed first. \
+            Default: 1024",
+    )
+]
+
+_basemaps_option = [
+    click.option(
+        "--basemap",
+        "-b",
+        multiple=True,
+        default=["Stamen.TonerLite"],
+        help="Specify a basemap provider whose tiles should be cached, can be given multiple times. The labels of Stamen \
+            basemaps are cached as well. Respect the tile usage policy of the provider. Default: 'Stamen.TonerLite'",
+    )
+]
+
+_store_crs_option = [
+    click.option(
+        "--store_crs",
+        "-sc",
+        default=4326,
+        type=int,
+        help="Specify the CRS EPSG the downloaded layers are saved in, e.g. the --crs_epsg of the plots so that they need \
+            no reprojection. Not applied to streamed downloads. Default: 4326",
+    )
+]
+
+_aois_option = [
+    click.option(
+        "--aois",
+        "-a",
+        required=True,
+        type=click.Path(exists=True, path_type=Path),
+        help="Specify the areas of interest of the batch: a polygon file with one area per feature \
+            or a directory with one .geojson/.gpkg file per area.",
+    )
+]
+
+_aoi_name_option = [
+    click.option(
+        "--aoi_name",
+        "-an",
+        default=None,
+        type=str,
+        help="Specify the column of the polygon file holding the names of the areas, they are part of the map file names. \
+            Default: the column name if it exists, otherwise the number of the feature",
+    )
+]
+
+_workers_option = [
+    click.option(
+        "--workers",
+        "-w",
+        default=4,
+        type=int,
+        help="Specify how many maps should be rendered in parallel (processes). Default: 4",
+    )
+]
+
+_ohsome_url_option = [
+    click.option(
+        "--ohsome_url",
+        "-ou",
+        default=OHSOME_API_URL,
+        help="Specify the base url of the ohsome API, e.g. http://127.0.0.1:8080/v1 of the local stand-in ohsome_stub.py. \
+            Default: the environment variable OHSOME_API_URL or https://api.ohsome.org/v1",
+    )
+]
+
 # _xxx_option = [
 #     click.option(
 
@@ -120,18 +389,267 @@ def add_options(options):
 
 @click.group()
 @click.option("--verbose", "-v", is_flag=True, help="Will print verbose messages.")
-def cli(verbose: bool) -> None:
+@click.option(
+    "--async_log",
+    "-al",
+    is_flag=True,
+    help="Will write the log messages in a background thread, the commands do not wait for the log files.",
+)
+@click.option(
+    "--profile",
+    "-p",
+    is_flag=True,
+    help="Will save the duration, features, vertices and peak memory of the pipeline stages as Chrome trace \
+        to ./data/output/profile (open it in chrome://tracing or https://ui.perfetto.dev).",
+)
+@click.pass_context
+def cli(ctx, verbose: bool, async_log: bool, profile: bool) -> None:
     """Activate verbose mode."""
-    if not verbose:
-        del logger_f.handlers[0]
-        del logger_m.handlers[0]
+    setup_logging(console=verbose, async_log=async_log)
+    create_dirs()
+    # the metrics of every run are saved when the command ended, see save_metrics
+    metrics.reset()
+    ctx.call_on_close(lambda start=_time.perf_counter(): save_metrics(ctx.invoked_subcommand, start))
+    if profile:
+        profiling.enable()
+        command = ctx.invoked_subcommand
+        trace_path = PROFILE_PATH / f"trace_{command}_{datetime.now():%Y%m%d_%H%M%S}.json"
+        # the trace is saved when the command ended, also if it failed. The span of the command is closed first
+        ctx.call_on_close(lambda: profiling.save_trace(trace_path, command=command, args=sys.argv[1:]))
+        ctx.with_resource(profiling.span(command, category="command"))
+
+
+def save_metrics(command, start):
+    """Save the metrics of a run to the log directory, called when the command ended (also if it failed).
+
+    Args:
+        command (String): name of the command
+        start (Float): time.perf_counter() at the start of the command
+    """
+    error = sys.exc_info()[1]
+    # --help ends the command with click's Exit before it ran
+    if isinstance(error, click.exceptions.Exit):
+        return
+    success = error is None or (isinstance(error, SystemExit) and not error.code)
+    metrics.save(LOG_DIR, command, _time.perf_counter() - start, success)
+
+
+def parse_extent(extent):
+    """Convert the extent option to a polygon.
+
+    Args:
+        extent (String): 'minx,miny,maxx,maxy' in EPSG:4326
+
+    Returns:
+        GeoSeries: bounding box of the extent in EPSG:4326, None if no extent is given
+    """
+    import geopandas as gpd
+    from shapely.geometry import box
+
+    if not extent:
+        return None
+    try:
+        minx, miny, maxx, maxy = (float(x) for x in extent.split(","))
+    except ValueError:
+        raise click.BadParameter(f"'{extent}' is not of the form 'minx,miny,maxx,maxy'", param_hint="--extent")
+    if minx >= maxx or miny >= maxy:
+        raise click.BadParameter(f"'{extent}' is an empty extent", param_hint="--extent")
+    return gpd.GeoSeries([box(minx, miny, maxx, maxy)], crs="EPSG:4326")
+
+
+def refresh_layer(name, filter, bpolys, key, driver, cached, cache_size=None):
+    """Patch a cached layer with the OSM changes since its download and update the cache entry.
+
+    Args:
+        name (String): name of the layer
+        filter (String): query for the ohsome api
+        bpolys (GeoDataFrame): area of interest
+        key (String): cache key of the layer
+        driver (String): JSON, GeoJSON, gpkg
+        cached (Path): path of the cached layer file
+        cache_size (Integer): maximum size of the download cache in bytes. None: unbounded
+
+    Returns:
+        Path: path of the refreshed cached layer file
+    """
+    import download_cache
+    import inputOutput
+    from ohsome_api import apply_changes, download_changes, get_data_timestamp
+
+    start = download_cache.get_cache_info(key, driver).get("timestamp")
+    if start is None:
+        logger_m.warning(f"layer {name} was cached without timestamp and can not be refreshed")
+        return cached
+
+    end = get_data_timestamp()
+    if end <= start:
+        logger_m.info(f"layer {name} is up to date ({start})")
+        return cached
+
+    changed, deleted = download_changes(filter=filter, start=start, end=end, bpolys=bpolys)
+    layer = inputOutput.read_file(cached, driver="gpd")
+    layer = apply_changes(layer, changed=changed, deleted=deleted, timestamp=end)
+
+    # write the patched layer next to the cache and replace the entry, the old file might still be linked
+    patched_path = DATA_PATH / f"{name}.refresh.{driver}"
+    inputOutput.save_osm(patched_path, driver=driver, file=layer)
+    cached = download_cache.add_to_cache(
+        key, driver, patched_path, max_size=cache_size, filter=filter, time=None, name=name, timestamp=end
+    )
+    patched_path.unlink()
+    logger_m.info(f"layer {name} refreshed from {start} to {end}")
+    return cached
+
+
+@profiling.traced()
+@metrics.timed("mapping_tool_layer_download_seconds")
+def download_layer(
+    row,
+    driver,
+    overwrite,
+    cache_ttl=None,
+    cache_size=None,
+    max_tile_features=0,
+    jobs=1,
+    stream=False,
+    refresh=False,
+    bpolys=None,
+    layer_path=None,
+    store_crs=4326,
+):
+    """Download a single OSM layer and save it to the data folder.
+
+    Identical requests (same filter, time, area and ohsome endpoint) are served from the download cache,
+    independent of the layer name.
+
+    Args:
+        row (Series): one row of the download input parameters (name, filter, time, polygon)
+        driver (String): JSON, GeoJSON, gpkg
+        overwrite (Boolean): True: ignore the cache and download the layer again
+        cache_ttl (Float): hours after which a cached download expires. None: never
+        cache_size (Integer): maximum size of the download cache in bytes. None: unbounded
+        max_tile_features (Integer): split the area of interest into tiles with at most this many features. 0: no tiling
+        jobs (Integer): number of tiles downloaded in parallel
+        stream (Boolean): True: write the features straight to the layer file instead of loading them into memory
+        refresh (Boolean): True: update a cached layer with the OSM changes since its download
+        bpolys (GeoDataFrame): area of interest. None: read the polygon file of the row
+        layer_path (Path): file the layer is saved to. None: data folder/<name>.<driver>
+        store_crs (Integer): EPSG of the CRS the layer is saved in (not streamed layers only)
+
+    Returns:
+        Boolean: True if the layer is available in the data folder afterwards, False if not
+    """
+    import download_cache
+    import inputOutput
+    from ohsome_api import download_osm, download_osm_to_file, endpoint_url, get_data_timestamp
+
+    name = row[0]
+    filter = row[1]
+    f_none = lambda x: None if x == "None" else x  # converts string "None" to None
+    time = f_none(row[2])
+    if bpolys is None:
+        bpolys = inputOutput.read_file(INPUT_PATH / row[-1], driver="gpd")
+
+    # check if the request was already downloaded and only download again if wanted
+    layer_path = layer_path or DATA_PATH / f"{name}.{driver}"
+    # streamed features are written as they come from the ohsome API
+    stream = stream and driver in ("GeoJSON", "gpkg")
+    if stream and store_crs != 4326:
+        logger_m.warning(f"streamed downloads are saved in EPSG:4326, --store_crs is ignored for layer {name}.")
+    crs = 4326 if stream else store_crs
+    # downloads of another ohsome API (e.g. the local stand-in) are cached separately
+    endpoint = endpoint_url("elements/geometry")
+    key = download_cache.cache_key(filter=filter, time=time, bpolys=bpolys, endpoint=endpoint, crs=crs)
+    with profiling.span("cache_lookup", layer=name) as lookup:
+        cached = None if overwrite else download_cache.get_cached_layer(key, driver, ttl=cache_ttl)
+        lookup.set(hit=cached is not None)
+    if not overwrite:
+        metrics.inc("mapping_tool_download_cache_requests_total", result="miss" if cached is None else "hit")
+    if cached is not None:
+        # historic data does not change -> only layers of the latest data are refreshed
+        if refresh and time is None:
+            cached = refresh_layer(name, filter, bpolys, key, driver, cached, cache_size=cache_size)
+        download_cache.link_layer(cached, layer_path)
+        logger_m.info("file %s.%s is already downloaded (cache %s)", name, driver, key[:12])
+        metrics.inc("mapping_tool_layers_total", result="cached")
+        return True
+
+    logger_m.info("start download of layer %s", name)
+    # remember the data timestamp to be able to refresh the layer later on
+    timestamp = get_data_timestamp() if time is None else None
+    with profiling.span("download", layer=name, stream=stream) as download:
+        if stream:
+            if max_tile_features:
+                logger_m.warning(f"tiling is not supported for streamed downloads. Download layer {name} in one request.")
+            # the streamed file is only moved to the layer path once it is complete
+            found = download_osm_to_file(filter=filter, time=time, bpolys=bpolys, path=layer_path, driver=driver)
+            download.set(features=found)
+            n_features = found
+        else:
+            layer = download_osm(filter=filter, time=time, bpolys=bpolys, max_features=max_tile_features, jobs=jobs)
+            found = layer is not None
+            n_features = 0 if layer is None else len(layer)
+            if found:
+                download.count(layer)
+    metrics.inc("mapping_tool_downloaded_features_total", n_features)
+
+    # if no features could be found, continue with the next layer
+    if not found:
+        logger_m.warning(
+            f"requested layer with filter: {filter} did not return any features for the given search areas. \
+            Skip layer {name}."
+        )
+        metrics.inc("mapping_tool_layers_total", result="empty")
+        return False
+
+    if not stream:
+        # the old file might be linked to a cache entry -> never write into it
+        layer_path.unlink(missing_ok=True)
+        layer = inputOutput.reproject(layer, crs)
+        with profiling.span("save", layer=name, driver=driver):
+            inputOutput.save_osm(layer_path, driver=driver, file=layer)
+    download_cache.add_to_cache(
+        key, driver, layer_path, max_size=cache_size, filter=filter, time=time, name=name, timestamp=timestamp
+    )
+    logger_m.info("layer %s saved to %s", name, layer_path)
+    metrics.inc("mapping_tool_layers_total", result="downloaded")
+    metrics.set_gauge("mapping_tool_layer_features", n_features, layer=name)
+    return True
 
 
 @cli.command()
 @add_options(_driver_option)
 @add_options(_overwrite_option)
-def run_download(driver: str, overwrite: bool) -> None:
+@add_options(_jobs_option)
+@add_options(_cache_ttl_option)
+@add_options(_cache_size_option)
+@add_options(_max_tile_features_option)
+@add_options(_stream_option)
+@add_options(_refresh_option)
+@add_options(_timeout_option)
+@add_options(_retries_option)
+@add_options(_rate_limit_option)
+@add_options(_store_crs_option)
+@add_options(_ohsome_url_option)
+def run_download(
+    driver: str,
+    overwrite: bool,
+    jobs: int,
+    cache_ttl: float,
+    cache_size: int,
+    max_tile_features: int,
+    stream: bool,
+    refresh: bool,
+    timeout: float,
+    retries: int,
+    rate_limit: float,
+    store_crs: int,
+    ohsome_url: str,
+) -> None:
     """Executes command to download and save OSM layer."""
+    import inputOutput
+    from ohsome_api import configure_client
+
     in_file = inputOutput.read_file(fpath=INPUT_PATH_DOWNLOAD, driver="json")
     in_params = inputOutput.get_params(input_file=in_file)
 
@@ -141,33 +659,99 @@ def run_download(driver: str, overwrite: bool) -> None:
         logger_f.warning("Download input is not correct. End Program.")
         sys.exit()
 
+    cache_ttl = cache_ttl or None  # 0 -> no expiry
+    cache_size = cache_size * 1024**2
+
+    # all layers (and their tiles) share one connection pool, rate limit and retry policy
+    jobs = max(1, jobs)
+    configure_client(timeout=timeout, retries=retries, rate_limit=rate_limit, pool_size=max(10, jobs * jobs), url=ohsome_url)
+
     # download each layer with the given parameters and save each to the data folder
-    for index, row in in_params.iterrows():  # start of the download changed
-        name = row[0]
-        filter = row[1]
-        f_none = lambda x: None if x == "None" else x  # converts string "None" to None
-        time = f_none(row[2])
-        bpolys_path = INPUT_PATH / row[-1]
-        bpolys = inputOutput.read_file(bpolys_path, driver="gpd")
+    # layers are independent of each other -> download them in a bounded thread pool, jobs=1 keeps it serial
+    failed = []
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        futures = {
+            executor.submit(
+                download_layer,
+                row,
+                driver,
+                overwrite,
+                cache_ttl,
+                cache_size,
+                max_tile_features,
+                jobs,
+                stream,
+                refresh,
+                store_crs=store_crs,
+            ): row[0]
+            for index, row in in_params.iterrows()
+        }
+        for future in as_completed(futures):
+            name = futures[future]
+            # a failing layer must not abort the others. SystemExit is raised by the helpers on unrecoverable errors
+            try:
+                future.result()
+            except (Exception, SystemExit) as err:
+                logger_m.error("download of layer %s failed: %r", name, err)
+                metrics.inc("mapping_tool_layers_total", result="failed")
+                failed.append(name)
 
-        # check if data already exists and only download and overwrite if wanted
-        layer_path = DATA_PATH / f"{name}.{driver}"
-        if Path(layer_path).is_file() and not overwrite:
-            logger_m.info(f"file {name}.{driver} is already downloaded")
-            continue
+    if failed:
+        logger_m.error(f"{len(failed)} of {len(in_params)} layers could not be downloaded: {', '.join(failed)}")
+        sys.exit(1)
 
-        layer = download_osm(filter=filter, time=time, bpolys=bpolys)
 
-        # if no features could be found, continue with the next layer
-        if layer is None:
-            logger_m.warning(
-                f"requested layer with filter: {filter} did not return any features for the given search areas. \
-                Skip layer {name}."
-            )
+@profiling.traced()
+def load_layers(driver, columns=None, extent=None):
+    """Read the downloaded layers of the download input.
+
+    Args:
+        driver (String): JSON, GeoJSON, gpkg, parquet
+        columns (list): only read these columns (parquet only). None: read all columns
+        extent (GeoSeries): only read features inside of this extent, see parse_extent. None: whole layers
+
+    Returns:
+        dict: layer name -> GeoDataFrame, layers that do not exist or are empty within the extent are skipped
+    """
+    import geopandas as gpd
+    import inputOutput
+
+    # get general layer information about layer -> load input parameters as dataframe
+    in_file = inputOutput.read_file(fpath=INPUT_PATH_DOWNLOAD, driver="json")
+    in_params = inputOutput.get_params(input_file=in_file)
+
+    # check user layer information (download) input
+    if inputOutput.check_download_input(in_params):
+        logger_f.info("Given user download input is correct (time parameter not checked)")
+    else:
+        logger_f.warning("Download input is not correct. End Program.")
+        sys.exit()
+
+    # get the map layer and create list of layers
+    layers = {}
+    for index, row in in_params.iterrows():
+        name = row[0]
+        layer_path = DATA_PATH / f"{name}.{driver}"
+
+        # check if layer exists. If not: continue.
+        if not Path(layer_path).is_file():
+            logger_m.warning(f"file {name}.{driver} does not exist. Continue with the next.")
             continue
 
-        save_path = DATA_PATH / f"{name}.{driver}"
-        inputOutput.save_osm(save_path, driver=driver, file=layer)
+        # the extent is pushed down to the reader -> features outside of it are not loaded at all
+        layer = inputOutput.read_file(fpath=layer_path, driver="gpd", columns=columns, bbox=extent)
+        if extent is not None:
+            layer = gpd.clip(layer, extent.to_crs(layer.crs))
+            if layer.empty:
+                logger_m.warning(f"layer {name} has no features inside the given extent. Continue with the next.")
+                continue
+        layers[name] = layer
+    # exit program if no valid layer is given
+    if not len(layers):
+        logger_m.error("No valid layer given.")
+        sys.exit()
+
+    return layers
 
 
 @cli.command()
@@ -178,10 +762,31 @@ def run_download(driver: str, overwrite: bool) -> None:
 @add_options(_save_plot_option)
 @add_options(_basemap_option)
 @add_options(_random_baserlayer_option)
+@add_options(_extent_option)
+@add_options(_lod_option)
+@add_options(_render_mode_option)
+@add_options(_offline_option)
+@add_options(_tile_cache_size_option)
+@add_options(_png_export_option)
 def run_plotting(
-    plot_package: str, driver: str, crs_epsg: int, title: str, save_plot: bool, basemap: str, random_baselayer: bool
+    plot_package: str,
+    driver: str,
+    crs_epsg: int,
+    title: str,
+    save_plot: bool,
+    basemap: str,
+    random_baselayer: bool,
+    extent: str,
+    lod: bool,
+    render_mode: str,
+    offline: bool,
+    tile_cache_size: int,
+    png_export: str,
 ) -> None:
     """Execute command to plot the given layer based on input files."""
+    import inputOutput
+    from mapping import change_crs, plot_pixels, simplify_layers
+
     # choose plot parameter file location based on plot_package
     input_dict_download = {"gpd": INPUT_PATH_GPD, "bokeh": INPUT_PATH_BOKEH}
     map_input = input_dict_download[plot_package]
@@ -197,42 +802,21 @@ def run_plotting(
         logger_f.warning("Plotting input is not correct. End Program.")
         sys.exit()
 
-    # get general layer information about layer -> load input parameters as dataframe
-    in_file = inputOutput.read_file(fpath=INPUT_PATH_DOWNLOAD, driver="json")
-    in_params = inputOutput.get_params(input_file=in_file)
-
-    # check user layer information (download) input
-    if inputOutput.check_download_input(in_params):
-        logger_f.info("Given user download input is correct (time parameter not checked)")
-    else:
-        logger_f.warning("Download input is not correct. End Program.")
-        sys.exit()
-
-    # get the map layer and create list of layers
-    layers = []
-    for index, row in in_params.iterrows():
-        name = row[0]
-        layer_path = DATA_PATH / f"{name}.{driver}"
-
-        # check if layer exists. If not: continue.
-        if not Path(layer_path).is_file():
-            logger_m.warning(f"file {name}.{driver} does not exist. Continue with the next.")
-            continue
-
-        layer = inputOutput.read_file(fpath=layer_path, driver="gpd")
-        layers.append(layer)
-    # exit program if no valid layer is given
-    if not len(layers):
-        logger_m.error("No valid layer given.")
-        sys.exit()
+    # the plots only use the geometry, the style comes from the plotting input -> columnar files only load that
+    layers = load_layers(driver, columns=["geometry"], extent=parse_extent(extent))
 
     # combine osm layers with the gpd input params
     # no need to handle empty files, they will not be saved in the first place (see run_download: 178f)
-    map_layer = in_params_plot.assign(Layers=layers)
+    map_layer = in_params_plot[in_params_plot["Name"].isin(layers)].copy()
+    map_layer = map_layer.assign(Layers=[layers[name] for name in map_layer["Name"]])
 
     # change crs of layers
     map_layer = change_crs(map_layer, crs_epsg)
 
+    # simplify layers to the plotted level of detail
+    if lod:
+        map_layer = simplify_layers(map_layer, pixels=plot_pixels(plot_package))
+
     # reverse dataframe so that the last item is going to be plotted first and the others on top of it
     reverse_map = map_layer.iloc[::-1]
 
@@ -241,18 +825,26 @@ def run_plotting(
 
     # create map with gpd
     if plot_package == "gpd":
+        import basemap_cache
+        from mapping import get_cx_providers, map_gpd
+
         # check if basemap exists, if not choose default
         if basemap not in get_cx_providers():
             basemap = "Stamen.TonerLite"
             logger_m.warning("Given baselayer name does not exist. Changed to default.")
 
-        map_gpd(reverse_map, crs_epsg, basemap, title, save_plot)
+        map_gpd(reverse_map, crs_epsg, basemap, title, save_plot, render_mode, offline)
+        basemap_cache.evict(tile_cache_size * 1e6)
 
     elif plot_package == "bokeh":
+        from bokeh.io import show
+        from bokeh.plotting import output_file, save
+        from mapping import map_bokeh, map_multiple
+
         if not random_baselayer:
-            p = map_bokeh(reverse_map, basemap, title)
+            p = map_bokeh(reverse_map, basemap, title, render_mode=render_mode, offline=offline)
         else:
-            p = map_multiple(reverse_map, basemap, title)
+            p = map_multiple(reverse_map, basemap, title, render_mode, offline)
             # show(grid)
 
         # save plot if wanted
@@ -262,9 +854,20 @@ def run_plotting(
         output_file(title=title_underscore, filename=save_to)
         if save_plot:
             # save_to = OUTPUT_PATH / f"bokeh_{title_underscore}.html"
-            save(p)
+            # the plot and its data are serialized to json when saved
+            with profiling.span("save_html"), metrics.timer("mapping_tool_render_seconds", function="save_html"):
+                save(p)
             save_to_png = OUTPUT_PATH / f"bokeh_{title_underscore}.png"
-            export_png(obj=p, filename=save_to_png)
+            timer = metrics.timer("mapping_tool_render_seconds", function="export_png")
+            with profiling.span("export_png", mode=png_export), timer:
+                if png_export == "native":
+                    import png_export as native
+
+                    native.export_png(p, save_to_png, offline=offline)
+                else:
+                    from bokeh.io import export_png
+
+                    export_png(obj=p, filename=save_to_png)
         show(p)
 
     else:
@@ -272,14 +875,256 @@ def run_plotting(
         sys.exit(1)
 
 
+@cli.command()
+@add_options(_driver_option)
+@add_options(_title_option)
+@add_options(_basemap_option)
+@add_options(_min_zoom_option)
+@add_options(_max_zoom_option)
+def create_tiles(driver: str, title: str, basemap: str, min_zoom: int, max_zoom: int) -> None:
+    """Execute command to cut the layers into vector tiles and create a map loading them on demand."""
+    import inputOutput
+    import vector_tiles
+    from mapping import get_cx_providers
+    from xyzservices import TileProvider
+
+    if min_zoom > max_zoom:
+        raise click.BadParameter("has to be higher than --min_zoom", param_hint="--max_zoom")
+
+    # the tiles are styled like the interactive bokeh plot
+    in_params_plot = inputOutput.get_params(input_file=inputOutput.read_file(fpath=INPUT_PATH_BOKEH, driver="json"))
+    if not inputOutput.check_plotting_input(in_params_plot):
+        logger_f.warning("Plotting input is not correct. End Program.")
+        sys.exit()
+
+    providers = get_cx_providers()
+    if basemap not in providers:
+        basemap = "Stamen.TonerLite"
+        logger_m.warning("Given baselayer name does not exist. Changed to default.")
+
+    layers = load_layers(driver, columns=["@osmId", "geometry"])
+    map_layer = in_params_plot[in_params_plot["Name"].isin(layers)].copy()
+    map_layer = map_layer.assign(Layers=[layers[name] for name in map_layer["Name"]])
+
+    out_dir = OUTPUT_PATH / "tiles"
+    vector_tiles.clear_tiles(out_dir)
+    vector_tiles.create_tiles(map_layer, out_dir, min_zoom=min_zoom, max_zoom=max_zoom)
+    vector_tiles.write_viewer(map_layer, out_dir, TileProvider(providers[basemap]), title, min_zoom=min_zoom, max_zoom=max_zoom)
+    logger_m.info(f"open the map with: python -m http.server --directory {out_dir} -> http://localhost:8000")
+
+
+@cli.command()
+@add_options(_driver_option)
+@add_options(_title_option)
+@add_options(_basemap_option)
+@add_options(_extent_option)
+@add_options(_offline_option)
+@add_options(_port_option)
+@add_options(_max_features_option)
+def serve(driver: str, title: str, basemap: str, extent: str, offline: bool, port: int, max_features: int) -> None:
+    """Execute command to explore the layers in a bokeh server, which only sends the features in view."""
+    import inputOutput
+    import server
+    from mapping import change_crs, get_cx_providers
+
+    # the layers are styled like the interactive bokeh plot
+    in_params_plot = inputOutput.get_params(input_file=inputOutput.read_file(fpath=INPUT_PATH_BOKEH, driver="json"))
+    if not inputOutput.check_plotting_input(in_params_plot):
+        logger_f.warning("Plotting input is not correct. End Program.")
+        sys.exit()
+
+    if basemap not in get_cx_providers():
+        basemap = "Stamen.TonerLite"
+        logger_m.warning("Given baselayer name does not exist. Changed to default.")
+
+    layers = load_layers(driver, columns=["geometry"], extent=parse_extent(extent))
+    map_layer = in_params_plot[in_params_plot["Name"].isin(layers)].copy()
+    map_layer = map_layer.assign(Layers=[layers[name] for name in map_layer["Name"]])
+    # the basemap tiles are in web mercator, the last layer is drawn first like in run_plotting
+    map_layer = change_crs(map_layer, 3857).iloc[::-1].reset_index(drop=True)
+
+    server.serve(map_layer, basemap, title, port=port, offline=offline, max_features=max_features)
+
+
+@cli.command()
+@add_options(_basemaps_option)
+@add_options(_min_zoom_option)
+@add_options(_max_zoom_option)
+@add_options(_tile_cache_size_option)
+@add_options(_jobs_option)
+def prefetch_tiles(basemap: tuple, min_zoom: int, max_zoom: int, tile_cache_size: int, jobs: int) -> None:
+    """Execute command to download the basemap tiles of the download polygons into the tile cache."""
+    import basemap_cache
+    import inputOutput
+    import pandas as pd
+    from mapping import get_cx_providers
+    from xyzservices import TileProvider
+
+    if min_zoom > max_zoom:
+        raise click.BadParameter("has to be higher than --min_zoom", param_hint="--max_zoom")
+
+    providers = get_cx_providers()
+    names = []
+    for name in basemap:
+        if name not in providers:
+            raise click.BadParameter(f"basemap {name} does not exist", param_hint="--basemap")
+        names.append(name)
+        # the plots add the labels to Stamen basemaps
+        if name.startswith("Stamen.") and "Stamen.TonerLabels" not in names:
+            names.append("Stamen.TonerLabels")
+
+    # area of interest: all polygons of the download input
+    in_params = inputOutput.get_params(input_file=inputOutput.read_file(fpath=INPUT_PATH_DOWNLOAD, driver="json"))
+    polygons = [inputOutput.read_file(fpath=INPUT_PATH / polygon, driver="gpd") for polygon in in_params["Polygon"].unique()]
+    bounds = pd.concat([polygon.to_crs(epsg=4326) for polygon in polygons]).total_bounds
+
+    for name in names:
+        available = basemap_cache.prefetch(TileProvider(providers[name]), bounds, min_zoom, max_zoom, jobs=max(jobs, 4))
+        logger_m.info(f"{available} tiles of {name} are cached")
+    basemap_cache.evict(tile_cache_size * 1e6)
+
+
+@cli.command()
+@add_options(_aois_option)
+@add_options(_aoi_name_option)
+@add_options(_driver_option)
+@add_options(_crs_epsg_option)
+@add_options(_title_option)
+@add_options(_basemap_option)
+@add_options(_overwrite_option)
+@add_options(_jobs_option)
+@add_options(_workers_option)
+@add_options(_cache_ttl_option)
+@add_options(_cache_size_option)
+@add_options(_lod_option)
+@add_options(_render_mode_option)
+@add_options(_offline_option)
+@add_options(_tile_cache_size_option)
+@add_options(_ohsome_url_option)
+def run_batch(
+    aois: Path,
+    aoi_name: str,
+    driver: str,
+    crs_epsg: int,
+    title: str,
+    basemap: str,
+    overwrite: bool,
+    jobs: int,
+    workers: int,
+    cache_ttl: float,
+    cache_size: int,
+    lod: bool,
+    render_mode: str,
+    offline: bool,
+    tile_cache_size: int,
+    ohsome_url: str,
+) -> None:
+    """Execute command to download the layers once for many areas and save one gpd map per area."""
+    import basemap_cache
+    import batch
+    import inputOutput
+    from mapping import change_crs, get_cx_providers
+    from ohsome_api import configure_client
+
+    try:
+        aoi_polygons = batch.read_aois(aois, name_column=aoi_name)
+    except ValueError as err:
+        raise click.BadParameter(str(err), param_hint="--aois")
+
+    in_params = inputOutput.get_params(input_file=inputOutput.read_file(fpath=INPUT_PATH_DOWNLOAD, driver="json"))
+    in_params_plot = inputOutput.get_params(input_file=inputOutput.read_file(fpath=INPUT_PATH_GPD, driver="json"))
+    if not (inputOutput.check_download_input(in_params) and inputOutput.check_plotting_input(in_params_plot)):
+        logger_f.warning("Download or plotting input is not correct. End Program.")
+        sys.exit()
+
+    if basemap not in get_cx_providers():
+        basemap = "Stamen.TonerLite"
+        logger_m.warning("Given baselayer name does not exist. Changed to default.")
+
+    configure_client(url=ohsome_url)
+    # each layer is downloaded once for all areas and stored in the crs of the maps,
+    # the polygon files of the download input are not used
+    batch_path = DATA_PATH / "batch"
+    batch_path.mkdir(parents=True, exist_ok=True)
+    cache_ttl = cache_ttl or None
+    layers = {}
+    for index, row in in_params.iterrows():
+        name = row[0]
+        layer_path = batch_path / f"{name}.{driver}"
+        # a failing layer must not abort the others, see run_download
+        try:
+            found = download_layer(
+                row,
+                driver,
+                overwrite,
+                cache_ttl=cache_ttl,
+                cache_size=cache_size * 1024**2,
+                jobs=max(1, jobs),
+                bpolys=aoi_polygons[["geometry"]],
+                layer_path=layer_path,
+                store_crs=crs_epsg,
+            )
+        except (Exception, SystemExit) as err:
+            logger_m.error("download of layer %s failed: %r", name, err)
+            metrics.inc("mapping_tool_layers_total", result="failed")
+            continue
+        if found:
+            layers[name] = inputOutput.read_file(fpath=layer_path, driver="gpd", columns=["geometry"])
+    if not layers:
+        logger_m.error("No valid layer given.")
+        sys.exit()
+
+    map_layer = in_params_plot[in_params_plot["Name"].isin(layers)].copy()
+    map_layer = map_layer.assign(Layers=[layers[name] for name in map_layer["Name"]])
+    map_layer = change_crs(map_layer, crs_epsg)
+
+    results = batch.render_batch(
+        map_layer,
+        aoi_polygons,
+        workers=max(1, workers),
+        crs_epsg=crs_epsg,
+        basemap=basemap,
+        title=title,
+        render_mode=render_mode,
+        offline=offline,
+        lod=lod,
+    )
+    basemap_cache.evict(tile_cache_size * 1e6)
+    saved, skipped, failed = results["saved"], results["skipped"], results["failed"]
+    logger_m.info(f"{len(saved)} maps saved to {OUTPUT_PATH}, {len(skipped)} skipped, {len(failed)} failed")
+    if skipped:
+        logger_m.warning(f"{len(skipped)} of {len(aoi_polygons)} areas have no features, no map: {', '.join(skipped)}")
+    if failed:
+        logger_m.error(f"{len(failed)} of {len(aoi_polygons)} maps could not be rendered: {', '.join(failed)}")
+        sys.exit(1)
+
+
 @cli.command()
 @add_options(_driver_option)
 @add_options(_crs_epsg_option)
 @add_options(_plot_package_option)
 @add_options(_title_option)
 @add_options(_save_plot_option)
+@add_options(_basemap_option)
 @add_options(_overwrite_option)
 @add_options(_random_baserlayer_option)
+@add_options(_jobs_option)
+@add_options(_cache_ttl_option)
+@add_options(_cache_size_option)
+@add_options(_max_tile_features_option)
+@add_options(_stream_option)
+@add_options(_refresh_option)
+@add_options(_timeout_option)
+@add_options(_retries_option)
+@add_options(_rate_limit_option)
+@add_options(_store_crs_option)
+@add_options(_extent_option)
+@add_options(_lod_option)
+@add_options(_render_mode_option)
+@add_options(_offline_option)
+@add_options(_tile_cache_size_option)
+@add_options(_png_export_option)
+@add_options(_ohsome_url_option)
 @click.pass_context
 def run(
     ctx,
@@ -288,23 +1133,66 @@ def run(
     plot_package: str,
     title: str,
     save_plot: bool,
+    basemap: str,
     overwrite: bool,
     random_baselayer: str,
+    jobs: int,
+    cache_ttl: float,
+    cache_size: int,
+    max_tile_features: int,
+    stream: bool,
+    refresh: bool,
+    timeout: float,
+    retries: int,
+    rate_limit: float,
+    store_crs: int,
+    extent: str,
+    lod: bool,
+    render_mode: str,
+    offline: bool,
+    tile_cache_size: int,
+    png_export: str,
+    ohsome_url: str,
 ) -> None:
     """Execute command to download and plot."""
-    ctx.invoke(run_download, driver=driver, overwrite=overwrite)
+    ctx.invoke(
+        run_download,
+        driver=driver,
+        overwrite=overwrite,
+        jobs=jobs,
+        cache_ttl=cache_ttl,
+        cache_size=cache_size,
+        max_tile_features=max_tile_features,
+        stream=stream,
+        refresh=refresh,
+        timeout=timeout,
+        retries=retries,
+        rate_limit=rate_limit,
+        store_crs=store_crs,
+        ohsome_url=ohsome_url,
+    )
 
     ctx.invoke(
         run_plotting,
+        driver=driver,
         crs_epsg=crs_epsg,
         plot_package=plot_package,
         title=title,
         save_plot=save_plot,
+        basemap=basemap,
         random_baselayer=random_baselayer,
+        extent=extent,
+        lod=lod,
+        render_mode=render_mode,
+        offline=offline,
+        tile_cache_size=tile_cache_size,
+        png_export=png_export,
     )
 
 
 if __name__ == "__main__":
+    setup_logging()
+    create_dirs()
     logger_m.info("start main proc<ess")
 
     # define the click parameters as shown below
@@ -1,29 +1,33 @@
-from bokeh.models.widgets.inputs import ColorPicker, Spinner
+# the plotting backends (matplotlib, contextily, bokeh) and rasterize are imported by the functions using them,
+# so that only the plot package of a command is loaded
 from definitions import OUTPUT_PATH, logger_f
 import pandas as pd
 from datetime import datetime
-import contextily as cx
-import matplotlib.pyplot as plt
-from matplotlib.colors import ListedColormap
-from matplotlib.patches import Patch
-from matplotlib.lines import Line2D
-from matplotlib_scalebar.scalebar import ScaleBar
-from bokeh.models import (
-    ColumnDataSource,
-    GeoJSONDataSource,
-)
-from bokeh.layouts import column, gridplot, grid
-from bokeh.layouts import row as brow
-from bokeh.plotting import figure
-from bokeh.tile_providers import get_provider
+import xyzservices
 from xyzservices import TileProvider
+import numpy as np
+import basemap_cache
+from inputOutput import get_transformer, reproject
+import metrics
+import profiling
+from definitions import TILE_CACHE_PATH
 import random
 import sys
+from collections import OrderedDict
 
+try:
+    # shapely >= 2.0 extracts the coordinates of all geometries at once
+    from shapely import get_coordinates, get_exterior_ring, get_parts, get_rings, get_type_id
+except ImportError:
+    get_coordinates = None
 
+
+@profiling.traced()
 def change_crs(map_layer, crs_epsg):
     """Change the crs of a geopandasdataframes column in another dataframe, has to be the last column.
 
+    Layers already in the target CRS (e.g. stored in it at download, see --store_crs) are not reprojected.
+
     Args:
         map_layer ([DataFrame]): with the last column GeoDataFrames
         crs_epsg ([Integer]): [four-digit epsg number]
@@ -31,11 +35,155 @@ def change_crs(map_layer, crs_epsg):
     Returns:
         [DataFrame]: [input dataframe with changed CRS of the last column]
     """
-    layers = pd.Series([lay.to_crs(epsg=crs_epsg) for lay in map_layer.iloc[:, -1]])
+    layers = pd.Series([reproject(lay, crs_epsg) for lay in map_layer.iloc[:, -1]])
     map_layer.iloc[:, -1] = layers
     return map_layer
 
 
+# size of the plots in pixels, the level of detail of the layers is based on it
+FIGSIZE_GPD = (10, 8)
+PLOT_SIZE_BOKEH = 950
+
+# maximum deviation of simplified geometries in pixels
+LOD_PIXEL_TOLERANCE = 0.5
+LOD_CACHE_SIZE = 32
+
+# simplified layers per (layer name, crs, tolerance), least recently used are dropped first
+_lod_cache = OrderedDict()
+
+
+def plot_pixels(plot_package):
+    """Get the size of the longer side of the plot in pixels.
+
+    Args:
+        plot_package (String): gpd, bokeh
+
+    Returns:
+        Integer: number of pixels
+    """
+    if plot_package == "gpd":
+        import matplotlib
+
+        return int(max(FIGSIZE_GPD) * matplotlib.rcParams["figure.dpi"])
+    return PLOT_SIZE_BOKEH
+
+
+def total_bounds(map_layer):
+    """Get the extent of all layers.
+
+    Args:
+        map_layer (DataFrame): with the last column GeoDataFrames
+
+    Returns:
+        tuple: minx, miny, maxx, maxy, None if all layers are empty
+    """
+    bounds = np.array([lay.total_bounds for lay in map_layer.iloc[:, -1] if not lay.empty])
+    if not len(bounds):
+        return None
+    return bounds[:, 0].min(), bounds[:, 1].min(), bounds[:, 2].max(), bounds[:, 3].max()
+
+
+def lod_tolerance(map_layer, pixels):
+    """Get the simplification tolerance for the extent of all layers drawn on the given number of pixels.
+
+    The tolerance is rounded down to a power of two, comparable to the zoom levels of tiled maps. Similar extents
+    share the same tolerance and thus the cached simplified layers.
+
+    Args:
+        map_layer (DataFrame): with the last column GeoDataFrames
+        pixels (Integer): size of the longer side of the plot in pixels
+
+    Returns:
+        Float: tolerance in units of the crs of the layers, None if the layers have no extent
+    """
+    bounds = total_bounds(map_layer)
+    if bounds is None:
+        return None
+    return extent_tolerance(bounds, pixels)
+
+
+def extent_tolerance(bounds, pixels):
+    """Get the simplification tolerance for an extent drawn on the given number of pixels, see lod_tolerance.
+
+    Args:
+        bounds (tuple): minx, miny, maxx, maxy of the extent, e.g. the viewport of the server mode
+        pixels (Integer): size of the longer side of the plot in pixels
+
+    Returns:
+        Float: tolerance in units of the bounds, None if the extent has no area
+    """
+    extent = max(bounds[2] - bounds[0], bounds[3] - bounds[1])
+    if not extent > 0:
+        return None
+    return 2.0 ** np.floor(np.log2(extent / pixels * LOD_PIXEL_TOLERANCE))
+
+
+@profiling.traced()
+def simplify_layers(map_layer, pixels):
+    """Simplify the lines and polygons of all layers to the level of detail visible on the plot.
+
+    Vertices closer together than the tolerance (see lod_tolerance) are removed, the topology is preserved.
+    Simplified layers are cached per tolerance. Points are not changed.
+
+    Args:
+        map_layer (DataFrame): with the columns Name and last column GeoDataFrames in a projected crs
+        pixels (Integer): size of the longer side of the plot in pixels
+
+    Returns:
+        DataFrame: input dataframe with simplified layers in the last column
+    """
+    tolerance = lod_tolerance(map_layer, pixels)
+    if tolerance is None:
+        return map_layer
+
+    layers = []
+    for name, lay in zip(map_layer["Name"], map_layer.iloc[:, -1]):
+        key = (name, str(lay.crs), tolerance)
+        # the layer might have changed since it was cached, e.g. by a new download
+        fingerprint = (len(lay), tuple(lay.total_bounds))
+        cached = _lod_cache.get(key)
+        if cached is not None and cached[0] == fingerprint:
+            _lod_cache.move_to_end(key)
+            layers.append(cached[1])
+            continue
+
+        simplified = lay
+        if not lay.geom_type.isin(["Point", "MultiPoint"]).all():
+            logger_f.info("simplify %s with tolerance %s", name, tolerance)
+            with profiling.span("simplify", layer=name, tolerance=tolerance) as simplification:
+                simplified = lay.copy()
+                simplified.geometry = lay.geometry.simplify(tolerance, preserve_topology=True)
+                simplification.count(simplified)
+
+        _lod_cache[key] = (fingerprint, simplified)
+        if len(_lod_cache) > LOD_CACHE_SIZE:
+            _lod_cache.popitem(last=False)
+        layers.append(simplified)
+
+    map_layer = map_layer.copy()
+    map_layer.iloc[:, -1] = pd.Series(layers, index=map_layer.index)
+    return map_layer
+
+
+def raster_grid(map_layer, pixels):
+    """Get the common pixel grid of all layers for the raster render mode.
+
+    Args:
+        map_layer (DataFrame): with the last column GeoDataFrames
+        pixels (Integer): size of the longer side of the plot in pixels
+
+    Returns:
+        tuple: bounds (minx, miny, maxx, maxy) and shape (height, width) of the grid
+    """
+    import rasterize
+
+    minx, miny, maxx, maxy = total_bounds(map_layer)
+    # a single point or a straight line still needs an area to be drawn on
+    pad = max(maxx - minx, maxy - miny) / pixels or 1
+    bounds = (minx - pad, miny - pad, maxx + pad, maxy + pad)
+    return bounds, rasterize.raster_shape(bounds, pixels)
+
+
 def get_cx_providers():
     """Get all built in providers of contextily in a flat directory.
 
@@ -43,6 +191,7 @@ def get_cx_providers():
         dictionary: flat dictionary of all contextily basemap providers
     """
     # code from: https://contextily.readthedocs.io/en/latest/providers_deepdive.html
+    # contextily.providers are the xyzservices providers, which can be read without importing contextily
     providers = {}
 
     def get_providers(provider):
@@ -52,13 +201,126 @@ def get_cx_providers():
             for prov in provider.values():
                 get_providers(prov)
 
-    get_providers(cx.providers)
+    get_providers(xyzservices.providers)
 
     return providers
 
 
+def add_basemap(ax, provider, crs_epsg, offline=False, zorder=None, pixels=None):
+    """Add the tiles of a provider covering the current extent of the axis, the tiles are read from the tile cache.
+
+    Args:
+        ax (matplotlib axis): axis with the layers already plotted
+        provider (TileProvider): xyzservices provider
+        crs_epsg (Integer): EPSG of the axis
+        offline (Boolean): True: only use cached tiles, see basemap_cache
+        zorder (Integer): zorder of the basemap
+        pixels (Integer): size of the longer side of the plot in pixels. None: size of the gpd plot
+    """
+    import contextily as cx
+
+    xmin, xmax, ymin, ymax = ax.axis()
+    bounds = (xmin, ymin, xmax, ymax)
+    if crs_epsg != 3857:
+        bounds = get_transformer(f"EPSG:{crs_epsg}", "EPSG:3857").transform_bounds(*bounds)
+
+    zoom = basemap_cache.zoom_for(bounds, pixels or plot_pixels("gpd"), provider)
+    tiles = basemap_cache.mosaic(provider, bounds, zoom, offline=offline)
+    if tiles is None:
+        logger_f.warning(f"no cached tiles of {provider['name']} for this extent, see prefetch-tiles. Plot without basemap.")
+        return
+    image, extent = tiles
+    if crs_epsg != 3857:
+        image, extent = cx.warp_tiles(image, extent, t_crs=f"EPSG:{crs_epsg}")
+
+    ax.imshow(image, extent=extent, interpolation="bilinear", zorder=zorder)
+    ax.axis((xmin, xmax, ymin, ymax))  # imshow extends the axis to the whole tiles
+    cx.add_attribution(ax, provider.get("attribution", ""))
+
+
+def draw_layer(ax, geom_layer, color, zorder):
+    """Draw a layer in one color with one matplotlib collection per geometry type, the layer is not modified.
+
+    Polygons are drawn as one compound path, lines as one LineCollection and points as one scatter, all built from the
+    coordinate arrays of the whole layer instead of one patch per feature. The style is the one of GeoDataFrame.plot.
+
+    Args:
+        ax (Axes): matplotlib axes to draw on
+        geom_layer (GeoDataFrame): layer to be drawn
+        color (String): color of the layer
+        zorder (Integer): zorder of the collections of the layer
+    """
+    if get_coordinates is None:
+        geom_layer.plot(ax=ax, color=color, zorder=zorder)
+        return
+
+    from matplotlib.collections import LineCollection, PatchCollection
+    from matplotlib.patches import PathPatch
+
+    # parts of multi geometries and geometry collections, missing and empty geometries have no parts
+    parts = get_parts(get_parts(np.asarray(geom_layer.geometry)))
+    type_ids = get_type_id(parts)
+
+    polygons = parts[type_ids == 3]
+    if len(polygons):
+        patch = PathPatch(_polygon_path(polygons))
+        ax.add_collection(PatchCollection([patch], color=color, zorder=zorder), autolim=True)
+
+    lines = parts[(type_ids == 1) | (type_ids == 2)]
+    if len(lines):
+        coords, line_index = get_coordinates(lines, return_index=True)
+        segments = np.split(coords, np.cumsum(np.bincount(line_index, minlength=len(lines)))[:-1])
+        ax.add_collection(LineCollection(segments, color=color, zorder=zorder), autolim=True)
+
+    points = parts[type_ids == 0]
+    if len(points):
+        coords = get_coordinates(points)
+        ax.scatter(coords[:, 0], coords[:, 1], color=color, zorder=zorder)
+
+    ax.autoscale_view()
+    # like GeoDataFrame.plot: geographic coordinates are stretched by the latitude, projected ones have equal axes
+    if geom_layer.crs is not None and geom_layer.crs.is_geographic:
+        bounds = geom_layer.total_bounds
+        ax.set_aspect(1 / np.cos(np.radians((bounds[1] + bounds[3]) / 2)))
+    else:
+        ax.set_aspect("equal")
+
+
+def _polygon_path(polygons):
+    """Compound matplotlib path of all rings of the polygons (shapely >= 2.0), see draw_layer.
+
+    Exterior rings are oriented counterclockwise and holes clockwise, so that the holes stay empty when filled.
+    """
+    from matplotlib.path import Path
+
+    rings, polygon_index = get_rings(polygons, return_index=True)
+    coords, ring_index = get_coordinates(rings, return_index=True)
+    sizes = np.bincount(ring_index, minlength=len(rings))
+    ends = np.cumsum(sizes) - 1
+    starts = ends - sizes + 1
+
+    # twice the signed area of every ring (shoelace formula), positive if counterclockwise
+    cross = np.zeros(len(coords))
+    cross[:-1] = coords[:-1, 0] * coords[1:, 1] - coords[1:, 0] * coords[:-1, 1]
+    cross[ends] = 0  # no edge from the last coordinate of a ring to the first of the next
+    area = np.add.reduceat(cross, starts)
+    is_exterior = np.r_[True, polygon_index[1:] != polygon_index[:-1]]
+
+    # reverse the coordinates of wrongly oriented rings within their ring
+    position = np.arange(len(coords))
+    flip = ((area > 0) != is_exterior)[ring_index]
+    position[flip] = starts[ring_index[flip]] + ends[ring_index[flip]] - position[flip]
+
+    codes = np.full(len(coords), Path.LINETO, dtype=Path.code_type)
+    codes[starts] = Path.MOVETO
+    codes[ends] = Path.CLOSEPOLY
+    return Path(coords[position], codes)
+
+
 # geopandasmapping
-def map_gpd(map_layer, crs_epsg, provider, title, save_plot):
+@profiling.traced()
+@metrics.timed("mapping_tool_render_seconds", function="map_gpd")
+def map_gpd(map_layer, crs_epsg, provider, title, save_plot, render_mode="vector", offline=False, show_plot=True):
     """Create gpd plotly plot with given layers and basemap.
 
     Args:
@@ -67,44 +329,58 @@ def map_gpd(map_layer, crs_epsg, provider, title, save_plot):
         basemap (String): Provider of the Contextily / xyzservices provider
         title (String): Title of the plot
         save_plot (Boolean): True: Save plot.
+        render_mode (String): vector: draw every feature. raster: draw the features aggregated per pixel as image.
+        offline (Boolean): True: only use basemap tiles of the tile cache.
+        show_plot (Boolean): True: show the plot. False: close it after saving, e.g. in batch runs.
 
     Returns:
         gpd plotly figure: One plot with all given layers and given baselayer
     """
+    import matplotlib.pyplot as plt
+    import rasterize
+    from matplotlib.lines import Line2D
+    from matplotlib.patches import Patch
+    from matplotlib_scalebar.scalebar import ScaleBar
+
     logger_f.info("start mapping")
     start_time = datetime.now()
 
-    fig, ax = plt.subplots(figsize=(10, 8))
+    fig, ax = plt.subplots(figsize=FIGSIZE_GPD)
+
+    if render_mode == "raster":
+        bounds, shape = raster_grid(map_layer, plot_pixels("gpd"))
 
     legend_elements = []
     zorder = 5
     for index, row in map_layer.iterrows():
 
-        name = row[0].capitalize()
-        color = row[1]
-        geometry = row[-1]
-
-        logger_f.info(f"start to plot: {row[0]}")
-
-        # create colormap based on the given color
-        cmap = ListedColormap([color], name=name)
-
-        # work around to color the layer in one color and still manage the legend correctly
-        geometry.insert(loc=geometry.shape[1] - 1, column="coloring", value=1)
-
-        geometry.plot(ax=ax, column="coloring", cmap=cmap, categorical=True, legend=True, zorder=zorder)
-        zorder += 5  # increase zorder for the next layer to plot the next on top
-
-        # add legend_items and icon based on their geometry type
-        if geometry.iloc[:, -1][index].geom_type == ("Point" or "MultiPoint"):
-            legend_element = Line2D([0], [0], marker="o", color="w", label=name, markerfacecolor=color, markersize=10)
-        elif geometry.iloc[:, -1][index].geom_type == ("LineString" or "LinearRing" or "MultiLineString"):
-            legend_element = Line2D([0], [0], color=color, lw=2, label=name)
-        elif geometry.iloc[:, -1][index].geom_type == ("Polygon" or "MultiPolygon" or "GeometryCollection"):
-            legend_element = Patch(facecolor=color, edgecolor="black", label=name)
-        else:
-            logger_f.info(f"{name} layer could not be displayed in the legend due to mismatched geometrytype")
-        legend_elements.append(legend_element)
+        with profiling.span("plot_layer", layer=row[0]) as layer_span:
+            layer_span.count(row[-1])
+            name = row[0].capitalize()
+            color = row[1]
+            geometry = row[-1]
+
+            logger_f.info("start to plot: %s", row[0])
+
+            if render_mode == "raster":
+                image = rasterize.to_image(rasterize.rasterize_layer(geometry, bounds, shape), color)
+                extent = (bounds[0], bounds[2], bounds[1], bounds[3])
+                ax.imshow(image, extent=extent, origin="upper", interpolation="nearest", zorder=zorder)
+            else:
+                draw_layer(ax, geometry, color, zorder)
+            zorder += 5  # increase zorder for the next layer to plot the next on top
+
+            # add legend_items and icon based on their geometry type (of the first feature)
+            geom_type = geometry.geom_type.iloc[0]
+            if geom_type in ("Point", "MultiPoint"):
+                legend_element = Line2D([0], [0], marker="o", color="w", label=name, markerfacecolor=color, markersize=10)
+            elif geom_type in ("LineString", "LinearRing", "MultiLineString"):
+                legend_element = Line2D([0], [0], color=color, lw=2, label=name)
+            elif geom_type in ("Polygon", "MultiPolygon", "GeometryCollection"):
+                legend_element = Patch(facecolor=color, edgecolor="black", label=name)
+            else:
+                logger_f.info("%s layer could not be displayed in the legend due to mismatched geometrytype", name)
+            legend_elements.append(legend_element)
 
     # reverse legend to account for the right order
     legend_elements = legend_elements[::-1]
@@ -112,10 +388,11 @@ def map_gpd(map_layer, crs_epsg, provider, title, save_plot):
     providers = get_cx_providers()
 
     try:
-        cx.add_basemap(ax, source=providers[provider], crs=f"EPSG:{crs_epsg}")
-        # bring the labels upfront if provider Stamen
-        if "Stamen" in provider:
-            cx.add_basemap(ax, source=cx.providers.Stamen.TonerLabels, crs=f"EPSG:{crs_epsg}", zorder=1000)
+        with profiling.span("basemap", provider=provider):
+            add_basemap(ax, providers[provider], crs_epsg, offline=offline)
+            # bring the labels upfront if provider Stamen
+            if "Stamen" in provider:
+                add_basemap(ax, providers["Stamen.TonerLabels"], crs_epsg, offline=offline, zorder=1000)
     except TimeoutError as err:
         logger_f.error("Connection to basemap provider could not be established. Check internet connection. Err:", err)
         sys.exit()
@@ -156,11 +433,16 @@ def map_gpd(map_layer, crs_epsg, provider, title, save_plot):
     # title_underscore = title
     if save_plot:
         save_to = OUTPUT_PATH / f"{title_underscore}.png"
-        plt.savefig(save_to)
+        # matplotlib draws the plot when saving
+        with profiling.span("save_png"):
+            plt.savefig(save_to)
 
     end_time = datetime.now() - start_time
     logger_f.info(f"mapping of {title} finished, Time elapsed: {end_time}")
-    plt.show()
+    if show_plot:
+        plt.show()
+    else:
+        plt.close(fig)
 
 
 ##################################### BOKEH #######################################################
@@ -175,6 +457,9 @@ def create_statistics(map_layer):
     Returns:
         [bokeh figure]: [bokeh figure bar plot]
     """
+    from bokeh.models import ColumnDataSource
+    from bokeh.plotting import figure
+
     categories = list(map_layer["Name"])
     values = [len(map_layer["Layers"][i]) for i in range(len(map_layer))]
 
@@ -201,7 +486,127 @@ def create_statistics(map_layer):
     return p
 
 
-def map_bokeh(map_layer, provider, title, add_func=True):
+def glyph_type(geom_layer):
+    """Get the bokeh glyph drawing a layer: circle (points), multi_line (lines) or patches (polygons)."""
+    geom_types = set(geom_layer.geom_type.dropna())
+    if geom_types and geom_types <= {"Point", "MultiPoint"}:
+        return "circle"
+    if geom_types & {"Polygon", "MultiPolygon", "GeometryCollection"}:
+        return "patches"
+    return "multi_line"
+
+
+def geometry_source(geom_layer):
+    """Create the bokeh data source of a layer directly from its coordinates.
+
+    Points get the columns x and y. Lines and polygons get the columns xs and ys with a single row holding the whole layer,
+    features and parts of multi geometries are separated by NaN which multi_line and patches draw as gaps.
+    Like GeoJSONDataSource only the exterior rings of polygons are used.
+    The columns are flat numpy arrays -> bokeh embeds them binary encoded instead of as coordinate text.
+
+    Args:
+        geom_layer (GeoDataFrame): layer to be plotted
+
+    Returns:
+        ColumnDataSource: source for circle (points), multi_line (lines) or patches (polygons) glyphs
+    """
+    from bokeh.models import ColumnDataSource
+
+    geometries = np.asarray(geom_layer.geometry)
+
+    if len(geometries) and geom_layer.geom_type.isin(["Point", "MultiPoint"]).all():
+        coords = get_coordinates(geometries) if get_coordinates else _point_coordinates(geometries)
+        return ColumnDataSource(data={"x": coords[:, 0], "y": coords[:, 1]})
+
+    coords = _separated_coordinates(geometries) if get_coordinates else _separated_coordinates_loop(geometries)
+    return ColumnDataSource(data={"xs": [coords[:, 0]], "ys": [coords[:, 1]]})
+
+
+def _separated_coordinates(geometries):
+    """Vectorized coordinates of lines and polygons separated by NaN (shapely >= 2.0), see geometry_source."""
+    parts = get_parts(geometries)
+    is_polygon = get_type_id(parts) == 3
+    parts[is_polygon] = get_exterior_ring(parts[is_polygon])
+    coords, part_index = get_coordinates(parts, return_index=True)
+
+    # every coordinate moves forward by the number of separators in front of it, one behind each previous part
+    position = np.arange(len(coords)) + part_index
+    separated = np.full((len(coords) + len(parts), 2), np.nan)
+    separated[position] = coords
+    return separated[:-1]
+
+
+def _separated_coordinates_loop(geometries):
+    """Coordinates of lines and polygons separated by NaN for shapely < 2.0, see geometry_source."""
+    separator = np.full((1, 2), np.nan)
+    coords = []
+    for geometry in geometries:
+        for part in getattr(geometry, "geoms", [geometry]):
+            ring = getattr(part, "exterior", part)
+            coords += [np.asarray(ring.coords)[:, :2], separator]
+    return np.vstack(coords)[:-1] if coords else np.empty((0, 2))
+
+
+def _point_coordinates(geometries):
+    """Coordinates of points and multi points for shapely < 2.0."""
+    coords = [(part.x, part.y) for geometry in geometries for part in getattr(geometry, "geoms", [geometry])]
+    return np.array(coords, dtype=float).reshape(-1, 2)
+
+
+@profiling.traced()
+def layer_sources(map_layer, render_mode="vector"):
+    """Create the bokeh data sources of all layers.
+
+    The sources can be shared by several figures, bokeh embeds each source only once per document.
+
+    Args:
+        map_layer (DataFrame): with the columns Name, Color and last column GeoDataFrames
+        render_mode (String): vector: the features, see geometry_source. raster: one image per layer aggregated per pixel.
+
+    Returns:
+        list: one ColumnDataSource per layer in the order of map_layer
+    """
+    from bokeh.models import ColumnDataSource
+
+    sources = []
+    if render_mode != "raster":
+        for name, geom_layer in zip(map_layer["Name"], map_layer.iloc[:, -1]):
+            with profiling.span("layer_source", layer=name) as layer_span:
+                layer_span.count(geom_layer)
+                sources.append(geometry_source(geom_layer))
+        return sources
+
+    bounds, shape = raster_grid(map_layer, PLOT_SIZE_BOKEH)
+    for name, color, geom_layer in zip(map_layer["Name"], map_layer["Color"], map_layer.iloc[:, -1]):
+        with profiling.span("rasterize", layer=name) as layer_span:
+            layer_span.count(geom_layer)
+            sources.append(ColumnDataSource(data=raster_data(geom_layer, color, bounds, shape)))
+    return sources
+
+
+def raster_data(geom_layer, color, bounds, shape):
+    """Aggregate a layer per pixel into the data of a bokeh image_rgba glyph, see rasterize.
+
+    Args:
+        geom_layer (GeoDataFrame): layer to be aggregated
+        color (String): color of the layer
+        bounds (tuple): minx, miny, maxx, maxy of the image
+        shape (tuple): height and width of the image in pixels
+
+    Returns:
+        dict: columns image, x, y, dw and dh with one row
+    """
+    import rasterize
+
+    # bokeh images start at the bottom, the colors are packed into one uint32 per pixel
+    image = rasterize.to_image(rasterize.rasterize_layer(geom_layer, bounds, shape), color)[::-1]
+    image = np.ascontiguousarray(image).view(np.uint32)[..., 0]
+    return {"image": [image], "x": [bounds[0]], "y": [bounds[1]], "dw": [bounds[2] - bounds[0]], "dh": [bounds[3] - bounds[1]]}
+
+
+@profiling.traced()
+@metrics.timed("mapping_tool_render_seconds", function="map_bokeh")
+def map_bokeh(map_layer, provider, title, add_func=True, render_mode="vector", offline=False, sources=None):
     """Create bokeh plot with given layers and basemap.
 
     Args:
@@ -209,14 +614,29 @@ def map_bokeh(map_layer, provider, title, add_func=True):
         basemap (String): Provider of the Contextily / xyzservices provider
         title (String): Title of the plot
         add_func(Boolean): add additional functionality widgets to the plot (True) or not (False). Default: True.
+        render_mode (String): vector: draw every feature. raster: draw the features aggregated per pixel as image.
+        offline (Boolean): True: load the basemap tiles from the tile cache instead of the tile server.
+        sources (list): data sources of the layers, see layer_sources. None: create them
 
     Returns:
         Bokeh plot: One plot with all given layers and given baselayer
     """
+    from bokeh.layouts import column, grid
+    from bokeh.layouts import row as brow
+    from bokeh.models.widgets.inputs import ColorPicker, Spinner
+    from bokeh.plotting import figure
+    from bokeh.tile_providers import get_provider
+
     logger_f.info("start mapping bokeh")
     start_time = datetime.now()
 
-    p = figure(title=title, height=950, width=950, toolbar_location="right", tools="pan, wheel_zoom, box_zoom, reset , save")
+    p = figure(
+        title=title,
+        height=PLOT_SIZE_BOKEH,
+        width=PLOT_SIZE_BOKEH,
+        toolbar_location="right",
+        tools="pan, wheel_zoom, box_zoom, reset , save",
+    )
 
     # hide grid
     p.xgrid.grid_line_color = None
@@ -227,17 +647,25 @@ def map_bokeh(map_layer, provider, title, add_func=True):
     pickers = []
     spinners = []
 
-    for index, row in map_layer.iterrows():
+    if sources is None:
+        sources = layer_sources(map_layer, render_mode)
+
+    for (_, row), geosource in zip(map_layer.iterrows(), sources):
         name = row[0].capitalize()
         color = row[1]
         geom_layer = row[-1]
 
-        logger_f.info(f"start to plot: {row[0]}")
+        logger_f.info("start to plot: %s", row[0])
+
+        if render_mode == "raster":
+            p.image_rgba(image="image", x="x", y="y", dw="dw", dh="dh", source=geosource, legend_label=name)
+            continue
 
-        geosource = GeoJSONDataSource(geojson=geom_layer.to_json())
+        # the glyph depends on the geometry types of the whole layer, like the columns of geometry_source
+        glyph = glyph_type(geom_layer)
 
         ## POINTS
-        if geom_layer.iloc[:, -1][index].geom_type == ("Point" or "MultiPoint"):
+        if glyph == "circle":
 
             points = p.circle("x", "y", source=geosource, color=color, size=10, legend_label=name)
             # p.add_tools(HoverTool(
@@ -253,7 +681,7 @@ def map_bokeh(map_layer, provider, title, add_func=True):
 
             spinners.append(spinner)
         ## LINES
-        elif geom_layer.iloc[:, -1][index].geom_type == ("LineString" or "LinearRing" or "MultiLineString"):
+        elif glyph == "multi_line":
 
             lines = p.multi_line("xs", "ys", source=geosource, line_color=color, line_width=3, legend_label=name)
             picker = ColorPicker(title=f"{name} Line Color", color=color)
@@ -271,7 +699,7 @@ def map_bokeh(map_layer, provider, title, add_func=True):
             # ))
 
         # POLYGONS
-        elif geom_layer.iloc[:, -1][index].geom_type == ("Polygon" or "MultiPolygon" or "GeometryCollection"):
+        else:
             polygons = p.patches(
                 "xs",
                 "ys",
@@ -289,8 +717,6 @@ def map_bokeh(map_layer, provider, title, add_func=True):
             picker = ColorPicker(title=f"{name} Polygon Color", color=color)
             picker.js_link("color", polygons.glyph, "fill_color")
             pickers.append(picker)
-        else:
-            logger_f.info(f"{name} layer geometrytype not found. Could not display layer")
 
     ######################### BASEMAP ##################################
 
@@ -298,16 +724,22 @@ def map_bokeh(map_layer, provider, title, add_func=True):
 
     # add basemap and labels
     private_provider = TileProvider(providers[provider])
+    if offline:
+        # the plot loads the tiles from the tile cache, see prefetch-tiles
+        private_provider = basemap_cache.local_provider(private_provider)
     tile_provider = get_provider(private_provider)
-    p.add_tile(tile_provider)
+    # the name of the provider lets the native PNG export find the tiles, see png_export
+    p.add_tile(tile_provider, name=provider)
 
     # add labels if baselayer is Stamen -> only Stamen because not all other provider have an extra label baselayer
     # thus -> exclusive Stamen feature
     if provider.split(".")[0] == "Stamen":
         labels = "Stamen.TonerLabels"
         private_provider = TileProvider(providers[labels])
+        if offline:
+            private_provider = basemap_cache.local_provider(private_provider)
         tile_provider = get_provider(private_provider)
-        p.add_tile(tile_provider, level="overlay")  # overlay -> put the labels on top of everything else
+        p.add_tile(tile_provider, level="overlay", name=labels)  # overlay -> put the labels on top of everything else
 
     ######################### Title and Legend #########################
 
@@ -324,9 +756,7 @@ def map_bokeh(map_layer, provider, title, add_func=True):
     if not add_func:
         return p
 
-    # below would work with my own bokeh server -> surpasses this course unfortunately
-    # would add the possiblitity to choose the background tile dynamically
-    # add_select()
+    # the basemap can be switched in the server mode, see server.py
 
     ######################## Create Layout #############################
 
@@ -355,21 +785,33 @@ def map_bokeh(map_layer, provider, title, add_func=True):
     return grid_layout
 
 
-def map_multiple(reverse_map, basemap, title):
+def map_multiple(reverse_map, basemap, title, render_mode="vector", offline=False):
     """Create grid with four bokeh figures with random baselayer.
 
     Args:
         reverse_map (DataFrame): DataFrame. First columns are layer parameter with last column as layer GeoDataFrame
         basemap (String): Provider of the Contextily / xyzservices provider
         title (String): Title of the plot
+        render_mode (String): vector: draw every feature. raster: draw the features aggregated per pixel as image.
+        offline (Boolean): True: only choose basemaps of the tile cache.
 
 
     Returns:
         Bokeh Gridplot: 2x2 grid with four plots with randomly different baselayer
     """
+    from bokeh.layouts import gridplot
+
     logger_f.info("start mapping bokeh gridplot")
     start_time = datetime.now()
     providers = get_cx_providers()
+    if offline:
+        cached = {name: prov for name, prov in providers.items() if (TILE_CACHE_PATH / name).is_dir()}
+        if cached:
+            providers = cached
+        else:
+            logger_f.warning("no basemap tiles cached, see prefetch-tiles")
+    # the layers are prepared once, all four figures share their data sources and only differ in the basemap
+    sources = layer_sources(reverse_map, render_mode)
     map_list = []
     for i in range(4):
         check = True
@@ -382,7 +824,7 @@ def map_multiple(reverse_map, basemap, title):
 
         title = f"{provider}"
         add_func = False
-        map_list.append(map_bokeh(reverse_map, basemap, title, add_func))
+        map_list.append(map_bokeh(reverse_map, basemap, title, add_func, render_mode, offline, sources=sources))
 
     # create 2x2 grid
     grid = gridplot(
@@ -392,24 +834,3 @@ def map_multiple(reverse_map, basemap, title):
     end_time = datetime.now() - start_time
     logger_f.info(f"mapping of {title} finished, Time elapsed: {end_time}")
     return grid
-
-
-"""
-below would work with my own bokeh server -> surpasses this course unfortunately
-def add_select():
-    tile_prov_select = Select(title="Tile Provider", value="NA", options=["OpenStreetMap c", "ESRI"])
-
-    tiles = {"OpenStreetMap c": WMTSTileSource(url="http://c.tile.openstreetmap.org/{Z}/{X}/{Y}.png 1"),
-            "ESRI": WMTSTileSource(url="https://server.arcgisonline.com/ArcGIS/
-                                    rest/services/World_Imagery/MapServer/tile/{Z}/{Y}/{X}.jpg")}
-    #callback
-    def change_tiles_callback(attr, old, new):
-        #removing the renderer corresponding to the tile layer
-        p.renderers = [x for x in p.renderers if not str(x).startswith('TileRenderer')]
-        #inserting the new tile renderer
-        tile_renderer = renderers.TileRenderer(tile_source=tiles[new])
-        p.renderers.insert(0, tile_renderer)
-
-    # #Assign callback to select menu
-    tile_prov_select.on_change("value", change_tiles_callback)
-"""
@@ -0,0 +1,187 @@
+"""Counters, gauges and histograms of a run, written as Prometheus text format and as JSON when the command ends.
+
+The Prometheus file always holds the metrics of the latest run (e.g. for the textfile collector of the node exporter),
+the JSON lines file gets one line per run so that runs can be compared.
+"""
+import functools
+import json
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime
+from definitions import logger_f
+
+# upper bounds of the histogram buckets in seconds
+DURATION_BUCKETS = (0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30, 60, 300, 900)
+
+# type and description of all metrics, metrics missing here can not be recorded
+METRICS = {
+    "mapping_tool_run_duration_seconds": ("gauge", "Duration of the command."),
+    "mapping_tool_run_timestamp_seconds": ("gauge", "Unix time the command ended."),
+    "mapping_tool_run_success": ("gauge", "1 if the command succeeded, 0 if it failed."),
+    "mapping_tool_layers_total": ("counter", "Layers by result of the download (downloaded, cached, empty, failed)."),
+    "mapping_tool_layer_features": ("gauge", "Number of features of a downloaded layer."),
+    "mapping_tool_layer_download_seconds": ("histogram", "Duration of the download of a layer, including saving it."),
+    "mapping_tool_download_cache_requests_total": ("counter", "Lookups of the download cache by result (hit, miss)."),
+    "mapping_tool_ohsome_requests_total": ("counter", "Requests sent to the ohsome API by endpoint and status."),
+    "mapping_tool_ohsome_received_bytes_total": ("counter", "Bytes received from the ohsome API."),
+    "mapping_tool_downloaded_features_total": ("counter", "Features downloaded from the ohsome API."),
+    "mapping_tool_read_seconds": ("histogram", "Duration of reading a layer by driver."),
+    "mapping_tool_read_features_total": ("counter", "Features read from layer files by driver."),
+    "mapping_tool_save_seconds": ("histogram", "Duration of saving a layer by driver."),
+    "mapping_tool_render_seconds": ("histogram", "Duration of the render functions."),
+    "mapping_tool_basemap_tiles_total": ("counter", "Basemap tiles by source (cache, download, missing)."),
+    "mapping_tool_basemap_received_bytes_total": ("counter", "Bytes of basemap tiles received from tile servers."),
+}
+
+_lock = threading.Lock()
+# (name, labels) -> value, histograms: (bucket counts, sum, count)
+_values = {}
+
+
+def _key(name, labels):
+    if name not in METRICS:
+        raise KeyError(f"metric {name} is not defined in METRICS")
+    return name, tuple(sorted((key, str(value)) for key, value in labels.items()))
+
+
+def inc(name, value=1, **labels):
+    """Increase a counter.
+
+    Args:
+        name (String): name of the counter, see METRICS
+        value (Float): amount added to the counter
+        **labels: labels of the counter, e.g. endpoint="elements/geometry"
+    """
+    key = _key(name, labels)
+    with _lock:
+        _values[key] = _values.get(key, 0) + value
+
+
+def set_gauge(name, value, **labels):
+    """Set a gauge to a value, see inc."""
+    key = _key(name, labels)
+    with _lock:
+        _values[key] = value
+
+
+def observe(name, value, **labels):
+    """Add an observation (e.g. a duration in seconds) to a histogram, see inc."""
+    key = _key(name, labels)
+    with _lock:
+        buckets, total, count = _values.get(key, ([0] * len(DURATION_BUCKETS), 0, 0))
+        buckets = [n + (value <= bound) for n, bound in zip(buckets, DURATION_BUCKETS)]
+        _values[key] = (buckets, total + value, count + 1)
+
+
+@contextmanager
+def timer(name, **labels):
+    """Observe the duration of a block in a histogram, also if the block fails."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(name, time.perf_counter() - start, **labels)
+
+
+def timed(name, **labels):
+    """Observe the duration of every call of the decorated function in a histogram, see timer."""
+
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with timer(name, **labels):
+                return func(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def snapshot():
+    """Get the recorded metrics.
+
+    Returns:
+        dict: name -> list of dicts with labels and value. Histograms have buckets, sum and count instead of a value
+    """
+    with _lock:
+        values = dict(_values)
+    metrics = {}
+    for (name, labels), value in sorted(values.items()):
+        sample = {"labels": dict(labels)}
+        if METRICS[name][0] == "histogram":
+            buckets, total, count = value
+            sample.update(buckets=dict(zip(DURATION_BUCKETS, buckets)), sum=total, count=count)
+        else:
+            sample["value"] = value
+        metrics.setdefault(name, []).append(sample)
+    return metrics
+
+
+def _labels(labels, **extra):
+    """Label set in Prometheus text format."""
+    pairs = [(key, value) for key, value in labels.items()] + list(extra.items())
+    if not pairs:
+        return ""
+    escape = lambda value: str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+    return "{" + ",".join(f'{key}="{escape(value)}"' for key, value in pairs) + "}"
+
+
+def to_prometheus(metrics):
+    """Format metrics of snapshot in the Prometheus text exposition format.
+
+    Args:
+        metrics (dict): see snapshot
+
+    Returns:
+        String: one HELP and TYPE line per metric followed by its samples
+    """
+    lines = []
+    for name, samples in metrics.items():
+        metric_type, description = METRICS[name]
+        lines += [f"# HELP {name} {description}", f"# TYPE {name} {metric_type}"]
+        for sample in samples:
+            labels = sample["labels"]
+            if metric_type != "histogram":
+                lines.append(f"{name}{_labels(labels)} {sample['value']}")
+                continue
+            # the counts of the buckets of the exposition format are cumulative
+            for bound, count in sample["buckets"].items():
+                lines.append(f"{name}_bucket{_labels(labels, le=bound)} {count}")
+            lines.append(f"{name}_bucket{_labels(labels, le='+Inf')} {sample['count']}")
+            lines.append(f"{name}_sum{_labels(labels)} {sample['sum']}")
+            lines.append(f"{name}_count{_labels(labels)} {sample['count']}")
+    return "\n".join(lines) + "\n"
+
+
+def reset():
+    """Drop all recorded metrics."""
+    with _lock:
+        _values.clear()
+
+
+def save(directory, command, duration, success):
+    """Write the metrics of the run as Prometheus text file and append them as JSON line.
+
+    Args:
+        directory (Path): directory of the files, e.g. the log directory
+        command (String): command of the run
+        duration (Float): duration of the run in seconds
+        success (Boolean): whether the run succeeded
+    """
+    set_gauge("mapping_tool_run_duration_seconds", duration, command=command)
+    set_gauge("mapping_tool_run_timestamp_seconds", time.time(), command=command)
+    set_gauge("mapping_tool_run_success", int(success), command=command)
+    metrics = snapshot()
+
+    directory.mkdir(parents=True, exist_ok=True)
+    # the textfile collector must not read half written files
+    prom_path = directory / "metrics.prom"
+    tmp_path = prom_path.with_suffix(".prom.tmp")
+    tmp_path.write_text(to_prometheus(metrics))
+    tmp_path.replace(prom_path)
+
+    run = {"timestamp": datetime.now().isoformat(timespec="seconds"), "command": command, "metrics": metrics}
+    with open(directory / "metrics.jsonl", "a") as f:
+        f.write(json.dumps(run) + "\n")
+    logger_f.info(f"metrics saved to {prom_path}")
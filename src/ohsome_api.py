@@ -1,31 +1,209 @@
 """Handles Ohsome API OSM data extraction."""
-from definitions import logger_f
-from ohsome import OhsomeClient
+from definitions import OHSOME_API_URL, logger_f
 from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import codecs
+import json
+import random
+import re
+import threading
+import time as _time
+import geopandas as gpd
+import pandas as pd
+import requests
+from requests.adapters import HTTPAdapter
+from shapely.geometry import MultiPolygon, box
 import sys
+import inputOutput
+import metrics
+import profiling
 
+############################## CONNECTION ##############################
 
-def download_osm(filter, time, bpolys):
+# connection settings of all ohsome requests of a run, see configure_client
+_settings = {
+    "url": OHSOME_API_URL,  # base url of the API, e.g. of a local stand-in (see ohsome_stub.py)
+    "timeout": (10, 600),  # (connect, read) timeout in seconds
+    "retries": 5,  # retries of failed requests (connection errors, timeouts, 429 and 5xx responses)
+    "backoff": 1.0,  # base delay in seconds, doubled with every retry
+    "rate_limit": None,  # maximum requests per second of the whole run
+    "pool_size": 10,  # maximum number of pooled connections to the ohsome API
+}
+RETRY_STATUS = (429, 500, 502, 503, 504)
+
+_session = None
+_session_lock = threading.Lock()
+_rate_lock = threading.Lock()
+_next_request = 0.0
+
+
+def configure_client(timeout=None, retries=None, backoff=None, rate_limit=None, pool_size=None, url=None):
+    """Configure the connection to the ohsome API. Arguments which are None keep their current value.
+
+    Args:
+        timeout ([float]): [read timeout of a request in seconds]
+        retries ([int]): [number of retries of a failed request]
+        backoff ([float]): [base delay between retries in seconds, doubled with every retry]
+        rate_limit ([float]): [maximum number of requests per second, 0: unlimited]
+        pool_size ([int]): [maximum number of pooled connections, should be at least the number of parallel downloads]
+        url ([string]): [base url of the ohsome API, e.g. http://127.0.0.1:8080/v1]
+    """
+    global _session
+    if timeout is not None:
+        _settings["timeout"] = (_settings["timeout"][0], timeout)
+    if retries is not None:
+        _settings["retries"] = retries
+    if backoff is not None:
+        _settings["backoff"] = backoff
+    if rate_limit is not None:
+        _settings["rate_limit"] = rate_limit or None
+    if url is not None:
+        _settings["url"] = url.rstrip("/")
+    if pool_size is not None and pool_size != _settings["pool_size"]:
+        _settings["pool_size"] = pool_size
+        with _session_lock:
+            _session = None  # the pool size only applies to a new session
+
+
+def get_session():
+    """Get the HTTP session shared by all ohsome requests, keeps the connections alive between requests.
+
+    Returns:
+        [requests.Session]: [session with a connection pool of the configured size]
+    """
+    global _session
+    with _session_lock:
+        if _session is None:
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=_settings["pool_size"])
+            _session = requests.Session()
+            _session.mount("https://", adapter)
+            _session.mount("http://", adapter)
+            _session.headers["user-agent"] = "mapping_tool"
+        return _session
+
+
+def endpoint_url(endpoint):
+    """Get the url of an endpoint of the configured ohsome API, e.g. elements/geometry."""
+    return f"{_settings['url']}/{endpoint}"
+
+
+def _wait_for_rate_limit():
+    """Block until the next request is allowed by the rate limit of the run."""
+    global _next_request
+    if not _settings["rate_limit"]:
+        return
+    with _rate_lock:
+        now = _time.monotonic()
+        wait = _next_request - now
+        _next_request = max(now, _next_request) + 1 / _settings["rate_limit"]
+    if wait > 0:
+        _time.sleep(wait)
+
+
+def _request(method, endpoint, **kwargs):
+    """Send a request to the ohsome API and retry transient errors with exponential backoff and jitter.
+
+    Args:
+        method ([string]): [GET or POST]
+        endpoint ([string]): [ohsome endpoint, e.g. elements/geometry]
+        **kwargs: [passed to requests.Session.request]
+
+    Returns:
+        [requests.Response]: [successful response]
+    """
+    url = endpoint_url(endpoint)
+    retries = _settings["retries"]
+    for attempt in range(retries + 1):
+        _wait_for_rate_limit()
+        try:
+            with profiling.span("ohsome_request", category="http", endpoint=endpoint, attempt=attempt) as request:
+                response = get_session().request(method, url, timeout=_settings["timeout"], **kwargs)
+                request.set(status=response.status_code)
+        except (requests.ConnectionError, requests.Timeout) as err:
+            metrics.inc("mapping_tool_ohsome_requests_total", endpoint=endpoint, status=type(err).__name__)
+            if attempt == retries:
+                raise
+            error = repr(err)
+        else:
+            metrics.inc("mapping_tool_ohsome_requests_total", endpoint=endpoint, status=response.status_code)
+            if response.status_code not in RETRY_STATUS or attempt == retries:
+                if not response.ok:
+                    logger_f.error(f"ohsome request to {endpoint} failed with {response.status_code}: {response.text[:500]}")
+                response.raise_for_status()
+                # streamed responses are counted while they are read, see download_osm_to_file
+                if not kwargs.get("stream"):
+                    metrics.inc("mapping_tool_ohsome_received_bytes_total", len(response.content))
+                return response
+            error = f"status {response.status_code}"
+            response.close()
+
+        # full jitter -> parallel downloads do not retry in lockstep
+        delay = random.uniform(0, _settings["backoff"] * 2**attempt)
+        logger_f.warning("ohsome request to %s failed (%s), retry %d/%d in %.1fs", endpoint, error, attempt + 1, retries, delay)
+        _time.sleep(delay)
+
+
+def _post_params(filter, time, bpolys):
+    """Create the form parameters of an ohsome request."""
+    if bpolys.crs is not None:
+        bpolys = bpolys.to_crs(epsg=4326)
+    params = {"bpolys": bpolys.to_json(), "filter": filter}
+    if time is not None:
+        params["time"] = time
+    return params
+
+
+def _as_dataframe(features):
+    """Convert GeoJSON features of an ohsome response to a GeoDataFrame indexed by @osmId (and timestamps)."""
+    gdf = gpd.GeoDataFrame.from_features(features, crs="EPSG:4326")
+    index_columns = [col for col in ["@osmId", "@snapshotTimestamp", "@validFrom", "@validTo"] if col in gdf.columns]
+    return gdf.set_index(index_columns) if index_columns else gdf
+
+
+############################## DOWNLOAD ##############################
+
+
+def download_osm(filter, time, bpolys, max_features=None, jobs=1):
     """Download osm data via the ohsome extraction API.
 
     Args:
         filter ([string]): [query for the ohsome api]
         time ([string]): [time parameter]
         bpolys ([gepandas dataframe]): [area of interest]
+        max_features ([int]): [split the area of interest into tiles with at most this many features. None: no tiling]
+        jobs ([int]): [number of tiles downloaded in parallel]
     """
     logger_f.info("start downloading")
     start_time = datetime.now()
 
-    client = OhsomeClient()
-    response = client.elements.geometry.post(bpolys=bpolys, filter=filter, time=time)
+    if max_features:
+        tiles = list(download_osm_tiles(filter=filter, time=time, bpolys=bpolys, max_features=max_features, jobs=jobs))
+        if not tiles:
+            logger_f.info(f"Given filter: {filter} did not yield any output in the given area")
+            return None
+        response_gdf = merge_tiles(tiles)
+    else:
+        response_gdf = _download(filter=filter, time=time, bpolys=bpolys)
+        if response_gdf is None:
+            return None
+
+    end_time = datetime.now() - start_time
+    logger_f.info(f"download finished, Time elapsed: {end_time}")
+    return response_gdf
+
+
+def _download(filter, time, bpolys):
+    """Download the features of one area with a single ohsome request, returns None if there are none."""
+    response = _request("POST", "elements/geometry", data=_post_params(filter, time, bpolys))
+    data = response.json()
 
     # check if feature list of response if empty if yes log and return None
-    if not response.data["features"]:
-        logger_f.info(f"Given filter: {filter} did not yield any output in the given area")
+    if not data["features"]:
+        logger_f.info("Given filter: %s did not yield any output in the given area", filter)
         return None
 
     try:
-        response_gdf = response.as_dataframe()
+        response_gdf = _as_dataframe(data["features"])
     except TypeError as err:
         logger_f.error(
             "Error Type : {}, Error Message : {}".format(
@@ -33,7 +211,287 @@ def download_osm(filter, time, bpolys):
             )
         )
         sys.exit(1)
+    return response_gdf
+
+
+def count_features(filter, time, bpolys):
+    """Estimate the number of features of a request via the ohsome count endpoint.
+
+    Args:
+        filter ([string]): [query for the ohsome api]
+        time ([string]): [time parameter]
+        bpolys ([gepandas dataframe]): [area of interest]
+
+    Returns:
+        [int]: [number of features, the maximum over all requested timestamps]
+    """
+    response = _request("POST", "elements/count", data=_post_params(filter, time, bpolys))
+    return int(max(result["value"] for result in response.json()["result"]))
+
+
+def _polygonal(geometry):
+    """Return the polygonal part of a geometry, tile intersections can contain lines or points."""
+    if geometry.geom_type in ("Polygon", "MultiPolygon"):
+        return geometry
+    polygons = [geom for geom in getattr(geometry, "geoms", []) if geom.geom_type == "Polygon"]
+    return MultiPolygon(polygons) if polygons else None
+
+
+def _quadrants(geometry):
+    """Split a geometry into the parts covered by the four quadrants of its bounding box."""
+    minx, miny, maxx, maxy = geometry.bounds
+    midx, midy = (minx + maxx) / 2, (miny + maxy) / 2
+    cells = [box(minx, miny, midx, midy), box(midx, miny, maxx, midy), box(minx, midy, midx, maxy), box(midx, midy, maxx, maxy)]
+
+    quadrants = []
+    for cell in cells:
+        part = _polygonal(geometry.intersection(cell))
+        if part is not None and not part.is_empty:
+            quadrants.append(part)
+    return quadrants
+
+
+@profiling.traced()
+def split_aoi(filter, time, bpolys, max_features, max_depth=6, jobs=1):
+    """Split the area of interest into a quadtree of tiles sized by the estimated feature density.
+
+    A tile is split into four until it holds at most max_features features, so dense areas get small tiles
+    and sparse areas big ones.
+
+    Args:
+        filter ([string]): [query for the ohsome api]
+        time ([string]): [time parameter]
+        bpolys ([gepandas dataframe]): [area of interest]
+        max_features ([int]): [maximum estimated number of features per tile]
+        max_depth ([int]): [maximum number of splits]
+        jobs ([int]): [number of count requests sent in parallel]
+
+    Returns:
+        [list]: [list of GeoDataFrames, one per tile. Tiles without features are dropped]
+    """
+    to_frame = lambda geometry: gpd.GeoDataFrame(geometry=[geometry], crs=bpolys.crs)
+
+    tiles = []
+    cells = [(bpolys.unary_union, 0)]
+    with ThreadPoolExecutor(max_workers=max(1, jobs)) as executor:
+        while cells:
+            counts = executor.map(lambda cell: count_features(filter, time, to_frame(cell[0])), cells)
+            next_cells = []
+            for (cell, depth), count in zip(cells, counts):
+                if count == 0:
+                    continue
+                if count <= max_features or depth >= max_depth:
+                    tiles.append(to_frame(cell))
+                else:
+                    next_cells.extend((quadrant, depth + 1) for quadrant in _quadrants(cell))
+            cells = next_cells
+
+    logger_f.info(f"area of interest split into {len(tiles)} tiles")
+    return tiles
+
+
+def download_osm_tiles(filter, time, bpolys, max_features, jobs=1):
+    """Download osm data tile by tile, see split_aoi.
+
+    Args:
+        filter ([string]): [query for the ohsome api]
+        time ([string]): [time parameter]
+        bpolys ([gepandas dataframe]): [area of interest]
+        max_features ([int]): [maximum estimated number of features per tile]
+        jobs ([int]): [number of tiles downloaded in parallel]
+
+    Yields:
+        [GeoDataFrame]: [features of one tile, clipped to the tile. Tiles without features are skipped]
+    """
+    tiles = split_aoi(filter=filter, time=time, bpolys=bpolys, max_features=max_features, jobs=jobs)
+
+    with ThreadPoolExecutor(max_workers=max(1, jobs)) as executor:
+        futures = [executor.submit(_download, filter, time, tile) for tile in tiles]
+        for future in as_completed(futures):
+            tile_gdf = future.result()
+            if tile_gdf is not None:
+                yield tile_gdf
+
+
+@profiling.traced()
+def merge_tiles(tiles):
+    """Combine tile downloads into one GeoDataFrame.
+
+    Features crossing a tile border are returned once per tile, clipped to it. Their parts are merged by @osmId.
+
+    Args:
+        tiles ([list]): [GeoDataFrames as returned by download_osm_tiles]
+
+    Returns:
+        [GeoDataFrame]: [all features of the area of interest]
+    """
+    gdf = pd.concat(tiles)
+    index_names = [name for name in gdf.index.names if name is not None]
+    gdf = gdf.reset_index()
+    keys = index_names or ["@osmId"]
+
+    duplicated = gdf.duplicated(subset=keys, keep=False)
+    if duplicated.any():
+        merged = gdf[duplicated].dissolve(by=keys, as_index=False)[gdf.columns]
+        gdf = pd.concat([gdf[~duplicated], merged], ignore_index=True)
+        logger_f.info(f"merged {duplicated.sum()} parts of {len(merged)} features crossing tile borders")
+
+    if index_names:
+        gdf = gdf.set_index(index_names)
+    return gdf
+
+
+def iter_features(chunks):
+    """Parse the features of a GeoJSON FeatureCollection incrementally.
+
+    Only the feature that is currently parsed is held in memory, not the whole response.
+
+    Args:
+        chunks ([iterable]): [bytes of the response, e.g. requests.Response.iter_content]
+
+    Yields:
+        [dict]: [one GeoJSON feature]
+    """
+    decoder = json.JSONDecoder()
+    text_decoder = codecs.getincrementaldecoder("utf-8")()
+    features_start = re.compile(r'"features"\s*:\s*\[')
+    buffer = ""
+    in_features = False
+
+    for chunk in chunks:
+        buffer += text_decoder.decode(chunk)
+
+        # skip the header (type, attribution, ...) up to the start of the feature list
+        if not in_features:
+            match = features_start.search(buffer)
+            if match is None:
+                continue
+            start = match.end()
+            buffer = buffer[start:]
+            in_features = True
+
+        pos = 0
+        while True:
+            # skip separators between the features
+            while pos < len(buffer) and buffer[pos] in " \t\r\n,":
+                pos += 1
+            if pos == len(buffer):
+                break
+            if buffer[pos] == "]":
+                return
+            try:
+                feature, pos = decoder.raw_decode(buffer, pos)
+            except ValueError:
+                break  # feature is incomplete, wait for the next chunk
+            yield feature
+        buffer = buffer[pos:]
+
+    raise ValueError("ohsome response ended before the feature list was complete")
+
+
+def download_osm_to_file(filter, time, bpolys, path, driver, batch_size=10000):
+    """Download osm data via the ohsome extraction API and stream it straight into a file.
+
+    Memory stays bounded by batch_size, independent of the number of downloaded features.
+
+    Args:
+        filter ([string]): [query for the ohsome api]
+        time ([string]): [time parameter]
+        bpolys ([gepandas dataframe]): [area of interest]
+        path ([Path]): [file the layer is written to]
+        driver ([string]): [GeoJSON, gpkg]
+        batch_size ([int]): [number of features written to the file at once]
+
+    Returns:
+        [int]: [number of downloaded features, 0 if the request did not yield any output]
+    """
+    logger_f.info("start streaming download")
+    start_time = datetime.now()
+
+    params = _post_params(filter, time, bpolys)
+    with _request("POST", "elements/geometry", data=params, stream=True) as response:
+        features = iter_features(_counted(response.iter_content(chunk_size=2**16)))
+        n_features = inputOutput.save_osm_stream(path, driver=driver, features=features, batch_size=batch_size)
+
+    if not n_features:
+        logger_f.info(f"Given filter: {filter} did not yield any output in the given area")
+        return 0
 
     end_time = datetime.now() - start_time
-    logger_f.info(f"download finished, Time elapsed: {end_time}")
-    return response_gdf
+    logger_f.info(f"download of {n_features} features finished, Time elapsed: {end_time}")
+    return n_features
+
+
+def _counted(chunks):
+    """Pass the chunks of a streamed response through and count their bytes, see metrics."""
+    for chunk in chunks:
+        metrics.inc("mapping_tool_ohsome_received_bytes_total", len(chunk))
+        yield chunk
+
+
+def get_data_timestamp():
+    """Get the timestamp of the latest data available via the ohsome API.
+
+    Returns:
+        [string]: [ISO 8601 timestamp]
+    """
+    metadata = _request("GET", "metadata").json()
+    end = metadata["extractRegion"]["temporalExtent"]["toTimestamp"]
+    return datetime.fromisoformat(end.strip("Z")).isoformat(timespec="seconds")
+
+
+def download_changes(filter, start, end, bpolys):
+    """Download the changes of osm features between two timestamps via the ohsome contributions API.
+
+    Only the latest contribution of each feature is requested.
+
+    Args:
+        filter ([string]): [query for the ohsome api]
+        start ([string]): [ISO 8601 timestamp of the cached data]
+        end ([string]): [ISO 8601 timestamp the data should be updated to]
+        bpolys ([gepandas dataframe]): [area of interest]
+
+    Returns:
+        [tuple]: [GeoDataFrame of created or modified features (None if there are none), set of deleted @osmIds]
+    """
+    logger_f.info(f"download changes from {start} to {end}")
+    response = _request("POST", "contributions/latest/geometry", data=_post_params(filter, f"{start},{end}", bpolys))
+
+    # features which no longer match the filter are reported as deletion as well
+    deleted = set()
+    changed = []
+    for feature in response.json()["features"]:
+        if feature["properties"].get("@deletion") or not feature.get("geometry"):
+            deleted.add(feature["properties"]["@osmId"])
+        else:
+            changed.append(feature)
+
+    changed_gdf = gpd.GeoDataFrame.from_features(changed, crs="EPSG:4326") if changed else None
+    logger_f.info(f"{len(changed)} features created or modified, {len(deleted)} deleted")
+    return changed_gdf, deleted
+
+
+def apply_changes(layer, changed, deleted, timestamp):
+    """Patch a downloaded layer with the changes returned by download_changes.
+
+    Args:
+        layer ([GeoDataFrame]): [layer as saved by run_download, with an @osmId column]
+        changed ([GeoDataFrame]): [created or modified features, None if there are none]
+        deleted ([set]): [@osmIds of deleted features]
+        timestamp ([string]): [ISO 8601 timestamp the changes were requested up to]
+
+    Returns:
+        [GeoDataFrame]: [patched layer, with the same columns as the input layer]
+    """
+    replaced = set(deleted)
+    if changed is not None:
+        replaced.update(changed["@osmId"])
+    patched = layer[~layer["@osmId"].isin(replaced)]
+
+    if changed is not None:
+        if "@snapshotTimestamp" in layer.columns:
+            changed = changed.assign(**{"@snapshotTimestamp": timestamp})
+        changed = changed.reindex(columns=layer.columns).set_geometry(layer.geometry.name)
+        patched = pd.concat([patched, changed.to_crs(layer.crs)], ignore_index=True)
+
+    return patched.reset_index(drop=True)
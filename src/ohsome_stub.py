@@ -0,0 +1,293 @@
+"""Local stand-in of the ohsome API serving synthetic OSM features, for load and latency tests without the live service.
+
+Start it with e.g. `python src/ohsome_stub.py --features 100000 --latency 0.2 --error_rate 0.1` and point the tool at it
+with `--ohsome_url http://127.0.0.1:8080/v1` or the environment variable OHSOME_API_URL.
+
+The features are generated once at startup, spread uniformly over an extent. Every request returns the features whose
+first vertex lies inside the bounding box of its bpolys, so tiled downloads (elements/count) add up to the whole layer.
+"""
+import bisect
+import json
+import random
+import threading
+import time
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+import click
+
+# Heidelberg (EPSG:4326), the area of the example input
+DEFAULT_EXTENT = (8.57, 49.35, 8.79, 49.46)
+
+# number of features written to the response at once
+CHUNK_FEATURES = 1000
+
+ENDPOINTS = ["elements/geometry", "elements/count", "contributions/latest/geometry", "metadata"]
+
+
+class SyntheticData:
+    """Features of a synthetic layer, sorted by the x coordinate of their first vertex for fast bounding box queries.
+
+    Args:
+        n_features (Integer): number of features
+        geometry_type (String): point, line, polygon
+        extent (tuple): west, south, east, north in EPSG:4326
+        tag_size (Integer): length of the value of the tag of every feature in characters -> payload size
+        seed (Integer): seed of the random generator
+    """
+
+    def __init__(self, n_features, geometry_type="point", extent=DEFAULT_EXTENT, tag_size=0, seed=0):
+        """Generate the anchors of the features, their geometries are created when they are requested."""
+        rng = random.Random(seed)
+        west, south, east, north = extent
+        anchors = sorted((rng.uniform(west, east), rng.uniform(south, north), i) for i in range(n_features))
+        self.xs = [x for x, _, _ in anchors]
+        self.anchors = anchors
+        self.geometry_type = geometry_type
+        self.osm_type = "node" if geometry_type == "point" else "way"
+        self.tag = "x" * tag_size
+        self.seed = seed
+
+    def query(self, bbox):
+        """Get the anchors (x, y, id) of the features inside of a bounding box (west, south, east, north)."""
+        start = bisect.bisect_left(self.xs, bbox[0])
+        end = bisect.bisect_right(self.xs, bbox[2])
+        return [anchor for anchor in self.anchors[start:end] if bbox[1] <= anchor[1] <= bbox[3]]
+
+    def geometry(self, x, y, i):
+        """Create the GeoJSON geometry of a feature, derived from its anchor and id only -> the same for every request."""
+        if self.geometry_type == "point":
+            return {"type": "Point", "coordinates": [x, y]}
+        rng = random.Random(self.seed * 1000003 + i)
+        if self.geometry_type == "line":
+            coords = [[x, y]]
+            for _ in range(5):
+                coords.append([coords[-1][0] + rng.gauss(0, 0.0003), coords[-1][1] + rng.gauss(0, 0.0003)])
+            return {"type": "LineString", "coordinates": coords}
+        dx, dy = rng.uniform(0.0001, 0.0004), rng.uniform(0.0001, 0.0004)
+        ring = [[x, y], [x + dx, y], [x + dx, y + dy], [x, y + dy], [x, y]]
+        return {"type": "Polygon", "coordinates": [ring]}
+
+    def feature(self, x, y, i, **properties):
+        """Create the GeoJSON feature as the ohsome API returns it."""
+        properties = {"@osmId": f"{self.osm_type}/{i}", **properties}
+        if self.tag:
+            properties["synthetic"] = self.tag
+        return {"type": "Feature", "geometry": self.geometry(x, y, i), "properties": properties}
+
+
+def bpolys_bbox(bpolys):
+    """Bounding box (west, south, east, north) of the GeoJSON bpolys parameter of a request."""
+    data = json.loads(bpolys)
+    geometries = [feature["geometry"] for feature in data["features"]] if "features" in data else [data]
+    xs, ys = [], []
+
+    def collect(coords):
+        if isinstance(coords[0], (int, float)):
+            xs.append(coords[0])
+            ys.append(coords[1])
+        else:
+            for part in coords:
+                collect(part)
+
+    for geometry in geometries:
+        collect(geometry["coordinates"])
+    return min(xs), min(ys), max(xs), max(ys)
+
+
+class OhsomeStubHandler(BaseHTTPRequestHandler):
+    """Answers requests to the endpoints of ENDPOINTS, configured by the attributes of the server."""
+
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        """Only log the requests in verbose mode."""
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+    def do_GET(self):  # noqa: N802
+        """Answer metadata requests, parameters are part of the url."""
+        self._handle(parse_qs(urlparse(self.path).query))
+
+    def do_POST(self):  # noqa: N802
+        """Answer data requests, parameters are form encoded like the ohsome API expects them."""
+        length = int(self.headers.get("Content-Length", 0))
+        self._handle(parse_qs(self.rfile.read(length).decode("utf-8")))
+
+    def _handle(self, params):
+        server = self.server
+        endpoint = urlparse(self.path).path.strip("/")
+        endpoint = endpoint[len("v1/"):] if endpoint.startswith("v1/") else endpoint
+        server.count_request(endpoint)
+
+        delay = server.latency + random.uniform(0, server.jitter)
+        if delay:
+            time.sleep(delay)
+        if endpoint not in ENDPOINTS:
+            return self._error(404, f"endpoint {endpoint} not found")
+        if random.random() < server.error_rate:
+            return self._error(server.error_status, "injected error of the ohsome stub")
+
+        if endpoint == "metadata":
+            to_timestamp = datetime.now(timezone.utc).replace(microsecond=0).isoformat().replace("+00:00", "Z")
+            temporal_extent = {"fromTimestamp": "2007-10-08T00:00:00Z", "toTimestamp": to_timestamp}
+            return self._json({"extractRegion": {"temporalExtent": temporal_extent}})
+        if "bpolys" not in params:
+            return self._error(400, "the parameter bpolys is missing")
+
+        anchors = server.data.query(bpolys_bbox(params["bpolys"][0]))
+        if endpoint == "elements/count":
+            timestamp = params.get("time", ["2024-01-01T00:00:00Z"])[0].split(",")[-1]
+            return self._json({"result": [{"timestamp": timestamp, "value": float(len(anchors))}]})
+        if endpoint == "contributions/latest/geometry":
+            # features with an id divisible by 100 changed, the ones divisible by 1000 were deleted
+            features = []
+            for x, y, i in anchors:
+                if i % 1000 == 0:
+                    deletion = {"@osmId": f"{server.data.osm_type}/{i}", "@deletion": True}
+                    features.append({"type": "Feature", "geometry": None, "properties": deletion})
+                elif i % 100 == 0:
+                    features.append(server.data.feature(x, y, i, **{"@creation": False}))
+            return self._json({"type": "FeatureCollection", "features": features})
+        self._feature_collection(anchors)
+
+    def _feature_collection(self, anchors):
+        """Send the features chunk by chunk like the ohsome API streams its responses."""
+        self.send_response(200)
+        self.send_header("Content-Type", "application/geo+json")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        self._chunk('{"attribution":{"text":"synthetic data of the ohsome stub"},"type":"FeatureCollection","features":[')
+        for start in range(0, len(anchors), CHUNK_FEATURES):
+            features = (json.dumps(self.server.data.feature(*anchor)) for anchor in anchors[start:start + CHUNK_FEATURES])
+            self._chunk(("," if start else "") + ",".join(features))
+        self._chunk("]}")
+        self.wfile.write(b"0\r\n\r\n")
+
+    def _chunk(self, text):
+        data = text.encode("utf-8")
+        if data:
+            self.wfile.write(f"{len(data):x}\r\n".encode("ascii") + data + b"\r\n")
+
+    def _json(self, data, status=200):
+        body = json.dumps(data).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _error(self, status, message):
+        """Error response in the format of the ohsome API."""
+        timestamp = datetime.now(timezone.utc).isoformat()
+        self._json({"timestamp": timestamp, "status": status, "message": message, "requestUrl": self.path}, status=status)
+
+
+class OhsomeStubServer(ThreadingHTTPServer):
+    """HTTP server of the ohsome stub, every request is answered in its own thread.
+
+    Args:
+        address (tuple): host and port, port 0 picks a free port
+        data (SyntheticData): features served by the stub
+        latency (Float): seconds every response is delayed
+        jitter (Float): maximum random extra delay in seconds
+        error_rate (Float): share of requests answered with error_status, 0 to 1
+        error_status (Integer): HTTP status of the injected errors
+        verbose (Boolean): True: log every request
+    """
+
+    daemon_threads = True
+
+    def __init__(self, address, data, latency=0, jitter=0, error_rate=0, error_status=503, verbose=False):
+        """Bind the server to the address, it serves after serve_forever is called."""
+        super().__init__(address, OhsomeStubHandler)
+        self.data = data
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.verbose = verbose
+        self.requests = {}
+        self._requests_lock = threading.Lock()
+
+    @property
+    def url(self):
+        """Base url of the API, to be used as OHSOME_API_URL."""
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}/v1"
+
+    def count_request(self, endpoint):
+        """Count the requests per endpoint, e.g. to check the retries of a test."""
+        with self._requests_lock:
+            self.requests[endpoint] = self.requests.get(endpoint, 0) + 1
+
+
+def start_server(n_features=1000, geometry_type="point", host="127.0.0.1", port=0, tag_size=0, seed=0, **options):
+    """Start the ohsome stub in a background thread.
+
+    Args:
+        n_features (Integer): number of synthetic features
+        geometry_type (String): point, line, polygon
+        host (String): address the server listens on
+        port (Integer): port, 0 picks a free port
+        tag_size (Integer): length of the tag value of every feature in characters
+        seed (Integer): seed of the random generator
+        **options: latency, jitter, error_rate, error_status and verbose, see OhsomeStubServer
+
+    Returns:
+        OhsomeStubServer: running server, stop it with shutdown() and server_close()
+    """
+    data = SyntheticData(n_features, geometry_type, tag_size=tag_size, seed=seed)
+    server = OhsomeStubServer((host, port), data, **options)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+@click.command()
+@click.option("--host", default="127.0.0.1", help="Specify the address the stub listens on. Default: 127.0.0.1")
+@click.option("--port", "-p", default=8080, type=int, help="Specify the port of the stub. Default: 8080")
+@click.option("--features", "-f", default=10000, type=int, help="Specify the number of synthetic features. Default: 10000")
+@click.option(
+    "--geometry",
+    "-g",
+    default="point",
+    type=click.Choice(["point", "line", "polygon"]),
+    help="Specify the geometry type of the features. Default: point",
+)
+@click.option(
+    "--tag_size",
+    "-ts",
+    default=0,
+    type=int,
+    help="Specify the length of a tag value added to every feature in characters, increases the payload. Default: 0",
+)
+@click.option("--latency", "-l", default=0.0, type=float, help="Specify the delay of every response in seconds. Default: 0")
+@click.option("--jitter", "-j", default=0.0, type=float, help="Specify the maximum random extra delay in seconds. Default: 0")
+@click.option(
+    "--error_rate",
+    "-er",
+    default=0.0,
+    type=click.FloatRange(0, 1),
+    help="Specify the share of requests answered with an error. Default: 0",
+)
+@click.option("--error_status", "-es", default=503, type=int, help="Specify the HTTP status of the injected errors. Default: 503")
+@click.option("--seed", default=0, type=int, help="Specify the seed of the synthetic features. Default: 0")
+@click.option("--verbose", "-v", is_flag=True, help="Will log every request.")
+def cli(host, port, features, geometry, tag_size, latency, jitter, error_rate, error_status, seed, verbose) -> None:
+    """Serve synthetic features like the ohsome API until interrupted."""
+    data = SyntheticData(features, geometry, tag_size=tag_size, seed=seed)
+    server = OhsomeStubServer(
+        (host, port), data, latency=latency, jitter=jitter, error_rate=error_rate, error_status=error_status, verbose=verbose
+    )
+    click.echo(f"ohsome stub with {features} {geometry} features listening on {server.url}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        click.echo(f"requests: {server.requests}")
+
+
+if __name__ == "__main__":
+    cli()
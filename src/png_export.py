@@ -0,0 +1,221 @@
+"""Export of bokeh maps to PNG with matplotlib, without the headless browser bokeh.io.export_png needs.
+
+The map figures of a bokeh layout are redrawn from their data sources: circles, multi lines, patches and images with the
+colors and sizes of their glyphs, the basemap tiles of the tile renderers (see basemap_cache), the title and the legend.
+Widgets and the statistics of the layout are left out.
+"""
+import math
+import numpy as np
+from definitions import logger_f
+from mapping import add_basemap, get_cx_providers
+
+# resolution of the PNG, bokeh sizes are given in screen pixels
+DPI = 100
+
+# relative padding of the data ranges, like the default range_padding of bokeh
+RANGE_PADDING = 0.1
+
+# map glyphs of bokeh drawn by the export
+MAP_GLYPHS = ("Circle", "MultiLine", "Patches", "ImageRGBA")
+
+
+def export_png(obj, filename, offline=False):
+    """Save the maps of a bokeh figure or layout as PNG.
+
+    Args:
+        obj (bokeh model): figure or layout, e.g. of map_bokeh or map_multiple
+        filename (Path): path of the PNG
+        offline (Boolean): True: only use basemap tiles of the tile cache
+
+    Returns:
+        Path: path of the PNG, None if obj has no maps
+    """
+    import matplotlib.pyplot as plt
+
+    plots = [plot for plot in _plots(obj) if any(_glyph_name(renderer) in MAP_GLYPHS for renderer in plot.renderers)]
+    if not plots:
+        logger_f.warning("no map in the bokeh object, PNG export skipped")
+        return None
+
+    ncols = math.ceil(math.sqrt(len(plots)))
+    nrows = math.ceil(len(plots) / ncols)
+    width = max(plot.width for plot in plots) / DPI
+    height = max(plot.height for plot in plots) / DPI
+    fig, axes = plt.subplots(nrows, ncols, figsize=(width * ncols, height * nrows), squeeze=False)
+    for ax in axes.flat[len(plots):]:
+        ax.set_axis_off()
+
+    providers = get_cx_providers()
+    for plot, ax in zip(plots, axes.flat):
+        _draw_plot(plot, ax, providers, offline)
+
+    fig.tight_layout()
+    filename.parent.mkdir(parents=True, exist_ok=True)
+    fig.savefig(filename, dpi=DPI)
+    plt.close(fig)
+    logger_f.info(f"map saved to {filename}")
+    return filename
+
+
+def _plots(obj):
+    """Figures of a bokeh layout in the order of the layout."""
+    from bokeh.models import Plot
+
+    if isinstance(obj, Plot):
+        return [obj]
+    plots = []
+    for child in getattr(obj, "children", []):
+        # the children of grids are (model, row, column)
+        plots += _plots(child[0] if isinstance(child, tuple) else child)
+    return plots
+
+
+def _glyph_name(renderer):
+    """Type name of the glyph of a renderer, None for renderers without glyph (e.g. tiles)."""
+    glyph = getattr(renderer, "glyph", None)
+    return type(glyph).__name__ if glyph is not None else None
+
+
+def _points(px):
+    """Convert screen pixels of bokeh to points of matplotlib."""
+    return px * 72 / DPI
+
+
+def _separated(values):
+    """Flat coordinate array of the rows of a multi_line or patches column, the rows are separated by NaN."""
+    rows = [np.asarray(row, dtype=float) for row in values]
+    separator = np.full(1, np.nan)
+    return np.concatenate([part for row in rows for part in (row, separator)][:-1]) if rows else np.empty(0)
+
+
+def _patches_path(xs, ys):
+    """Compound matplotlib path of NaN separated patches, every patch becomes a closed sub path."""
+    from matplotlib.path import Path
+
+    valid = ~(np.isnan(xs) | np.isnan(ys))
+    coords = np.column_stack([xs[valid], ys[valid]])
+    # a patch starts at the first coordinate and after every separator
+    starts = valid & ~np.r_[False, valid[:-1]]
+    ends = valid & ~np.r_[valid[1:], False]
+    codes = np.full(len(coords), Path.LINETO, dtype=Path.code_type)
+    codes[starts[valid]] = Path.MOVETO
+    codes[ends[valid]] = Path.CLOSEPOLY
+    return Path(coords, codes)
+
+
+def _draw_glyph(ax, renderer, zorder):
+    """Draw a glyph renderer of a bokeh figure.
+
+    Returns:
+        tuple: matplotlib artist for the legend and the bounds (minx, miny, maxx, maxy) of the data, None if nothing is drawn
+    """
+    from matplotlib.collections import PatchCollection
+    from matplotlib.patches import Patch, PathPatch
+
+    glyph = renderer.glyph
+    data = renderer.data_source.data
+    name = _glyph_name(renderer)
+
+    if name == "Circle":
+        x, y = np.asarray(data[glyph.x], dtype=float), np.asarray(data[glyph.y], dtype=float)
+        # the size is a diameter in pixels, the size of scatter an area in points
+        size = np.asarray(data[glyph.size] if isinstance(glyph.size, str) else glyph.size, dtype=float)
+        artist = ax.scatter(
+            x,
+            y,
+            s=_points(size) ** 2,
+            facecolor=glyph.fill_color,
+            edgecolor=glyph.line_color,
+            alpha=glyph.fill_alpha,
+            zorder=zorder,
+        )
+    elif name == "MultiLine":
+        x, y = _separated(data[glyph.xs]), _separated(data[glyph.ys])
+        (artist,) = ax.plot(x, y, color=glyph.line_color, linewidth=_points(glyph.line_width), zorder=zorder)
+    elif name == "Patches":
+        x, y = _separated(data[glyph.xs]), _separated(data[glyph.ys])
+        artist = PatchCollection(
+            [PathPatch(_patches_path(x, y))],
+            facecolor=glyph.fill_color,
+            edgecolor=glyph.line_color,
+            linewidth=_points(glyph.line_width),
+            alpha=glyph.fill_alpha,
+            zorder=zorder,
+        )
+        ax.add_collection(artist)
+    elif name == "ImageRGBA":
+        if not len(data[glyph.image]):
+            return None
+        # bokeh images start at the bottom, the colors are packed into one uint32 per pixel
+        image = np.asarray(data[glyph.image][0], dtype=np.uint32)
+        image = np.ascontiguousarray(image).view(np.uint8).reshape(image.shape + (4,))
+        x, y, dw, dh = (data[getattr(glyph, key)][0] for key in ("x", "y", "dw", "dh"))
+        ax.imshow(image, extent=(x, x + dw, y, y + dh), origin="lower", interpolation="nearest", zorder=zorder)
+        opaque = image[image[..., 3] > 0]
+        artist = Patch(color=(opaque[:, :3].mean(axis=0) / 255) if len(opaque) else "none")
+        return artist, (x, y, x + dw, y + dh)
+    else:
+        return None
+
+    if not np.isfinite(x).any():
+        return artist, None
+    return artist, (np.nanmin(x), np.nanmin(y), np.nanmax(x), np.nanmax(y))
+
+
+def _draw_plot(plot, ax, providers, offline):
+    """Draw one bokeh figure with its layers, basemap, title and legend into a matplotlib axis."""
+    artists = {}
+    bounds = []
+    for zorder, renderer in enumerate(plot.renderers, start=5):
+        if not renderer.visible or _glyph_name(renderer) not in MAP_GLYPHS:
+            continue
+        drawn = _draw_glyph(ax, renderer, zorder)
+        if drawn is None:
+            continue
+        artists[renderer.id], layer_bounds = drawn
+        if layer_bounds is not None:
+            bounds.append(layer_bounds)
+
+    # extent of the padded data ranges of bokeh, the shorter side is extended to equal axes like match_aspect
+    if bounds:
+        bounds = np.array(bounds)
+        center_x, center_y = (bounds[:, 0].min() + bounds[:, 2].max()) / 2, (bounds[:, 1].min() + bounds[:, 3].max()) / 2
+        span_x = (bounds[:, 2].max() - bounds[:, 0].min()) * (1 + RANGE_PADDING) or 1
+        span_y = (bounds[:, 3].max() - bounds[:, 1].min()) * (1 + RANGE_PADDING) or 1
+        span_x, span_y = max(span_x, span_y * plot.width / plot.height), max(span_y, span_x * plot.height / plot.width)
+        ax.set_xlim(center_x - span_x / 2, center_x + span_x / 2)
+        ax.set_ylim(center_y - span_y / 2, center_y + span_y / 2)
+    ax.set_aspect("equal")
+
+    # bokeh draws tiles of the overlay level (e.g. labels) on top of the layers
+    for renderer in plot.renderers:
+        if type(renderer).__name__ != "TileRenderer" or not renderer.visible:
+            continue
+        provider = providers.get(renderer.name)
+        if provider is None:
+            logger_f.warning(f"basemap {renderer.name} is not a known provider, PNG export without it")
+            continue
+        zorder = 1000 if renderer.level == "overlay" else 0
+        add_basemap(ax, provider, 3857, offline=offline, zorder=zorder, pixels=max(plot.width, plot.height))
+
+    if plot.title is not None and plot.title.text:
+        size = _points(float(str(plot.title.text_font_size).rstrip("px") or 13))
+        ax.set_title(plot.title.text, fontsize=size, loc=plot.title.align or "left")
+
+    handles, labels = [], []
+    for legend in plot.legend:
+        for item in legend.items:
+            drawn = [artists[renderer.id] for renderer in item.renderers if renderer.id in artists]
+            label = item.label.get("value") if isinstance(item.label, dict) else item.label
+            if drawn and label:
+                handles.append(drawn[0])
+                labels.append(label)
+    if handles:
+        location = plot.legend[0].location
+        if isinstance(location, str):
+            location = location.replace("_", " ").replace("bottom", "lower").replace("top", "upper")
+        else:
+            location = "best"
+        ax.legend(handles, labels, loc=location)
+
+    ax.set_axis_off()
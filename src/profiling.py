@@ -0,0 +1,184 @@
+"""Nested timing spans of the pipeline stages, saved as Chrome trace (chrome://tracing, https://ui.perfetto.dev).
+
+Spans are only recorded after enable() was called (see --profile), otherwise span() does nothing but yield.
+"""
+import functools
+import json
+import os
+import platform
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from definitions import logger_m
+
+try:
+    import resource
+except ImportError:  # not available on windows
+    resource = None
+
+# recorded trace events, None: profiling is disabled
+_events = None
+_events_lock = threading.Lock()
+_origin = time.perf_counter()
+_thread_names = {}
+
+
+class Span:
+    """Arguments of a span, shown in the trace viewer when the span is selected."""
+
+    def __init__(self, args):
+        """Create the span with its initial arguments."""
+        self.args = args
+
+    def set(self, **args):
+        """Add arguments to the span, e.g. results that are only known at its end."""
+        self.args.update(args)
+
+    def count(self, layer):
+        """Add the number of features and vertices of a layer (GeoDataFrame) to the span."""
+        self.args["features"] = len(layer)
+        try:
+            # shapely >= 2.0 counts the vertices of all geometries at once
+            from shapely import get_num_coordinates
+        except ImportError:
+            return
+        self.args["vertices"] = int(get_num_coordinates(layer.geometry.array).sum())
+
+
+class _DisabledSpan(Span):
+    """Span of a disabled profiler, ignores all arguments."""
+
+    def __init__(self):
+        super().__init__({})
+
+    def set(self, **args):
+        pass
+
+    def count(self, layer):
+        pass
+
+
+_DISABLED_SPAN = _DisabledSpan()
+
+
+def enable():
+    """Start recording spans, previously recorded spans are dropped."""
+    global _events, _origin
+    with _events_lock:
+        _events = []
+        _thread_names.clear()
+        _origin = time.perf_counter()
+
+
+def is_enabled():
+    """Return whether spans are recorded."""
+    return _events is not None
+
+
+def peak_memory_mb():
+    """Get the peak resident memory of the process in MB, None if it can not be determined."""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # linux reports kilobytes, macOS bytes
+    return round(peak / (1e6 if sys.platform == "darwin" else 1e3), 1)
+
+
+@contextmanager
+def span(name, category="pipeline", **args):
+    """Record the time of a block as span, spans within the block are nested into it.
+
+    Args:
+        name (String): name of the span, e.g. the stage of the pipeline
+        category (String): category of the span, can be filtered in the trace viewer
+        **args: arguments of the span, e.g. the name of the layer
+
+    Yields:
+        Span: to add arguments while the block runs, e.g. span.count(layer)
+    """
+    if _events is None:
+        yield _DISABLED_SPAN
+        return
+
+    current = Span(dict(args))
+    start = time.perf_counter()
+    try:
+        yield current
+    finally:
+        end = time.perf_counter()
+        current.args["peak_memory_mb"] = peak_memory_mb()
+        thread = threading.current_thread()
+        event = {
+            "name": name,
+            "cat": category,
+            "ph": "X",  # complete event with start and duration
+            "ts": round((start - _origin) * 1e6, 1),
+            "dur": round((end - start) * 1e6, 1),
+            "pid": os.getpid(),
+            "tid": thread.ident,
+            "args": current.args,
+        }
+        with _events_lock:
+            if _events is not None:
+                _events.append(event)
+                _thread_names[thread.ident] = thread.name
+
+
+def traced(name=None, category="pipeline"):
+    """Record every call of the decorated function as span, see span.
+
+    Args:
+        name (String): name of the spans. None: name of the function
+        category (String): category of the spans
+    """
+
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with span(name or func.__name__, category):
+                return func(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def summary():
+    """Sum up the recorded spans by name.
+
+    Returns:
+        dict: name -> number of spans and total duration in seconds, ordered by the total duration
+    """
+    totals = {}
+    for event in _events or []:
+        count, seconds = totals.get(event["name"], (0, 0))
+        totals[event["name"]] = (count + 1, seconds + event["dur"] / 1e6)
+    return dict(sorted(totals.items(), key=lambda x: -x[1][1]))
+
+
+def save_trace(path, **metadata):
+    """Save the recorded spans in the Chrome trace event format.
+
+    Args:
+        path (Path): json file the trace is written to
+        **metadata: information about the run, e.g. the command, shown in the trace viewer
+    """
+    pid = os.getpid()
+    with _events_lock:
+        events = list(_events or [])
+        threads = list(_thread_names.items())
+        # metadata events -> the threads are shown with their names
+        names = [{"name": "thread_name", "ph": "M", "pid": pid, "tid": tid, "args": {"name": name}} for tid, name in threads]
+    trace = {
+        "traceEvents": names + events,
+        "displayTimeUnit": "ms",
+        "otherData": {"python": platform.python_version(), "platform": platform.platform(), **metadata},
+    }
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with open(path, "w") as f:
+        json.dump(trace, f)
+
+    for name, (count, seconds) in list(summary().items())[:10]:
+        logger_m.info(f"profile: {name} {count}x {seconds:.3f}s")
+    logger_m.info(f"profile saved to {path}")
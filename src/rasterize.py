@@ -0,0 +1,177 @@
+"""Aggregates layers on a pixel grid so that layers with millions of features can be drawn as images."""
+import numpy as np
+from matplotlib.colors import to_rgba
+from rasterio import features
+from rasterio.enums import MergeAlg
+from rasterio.transform import from_bounds
+
+try:
+    # shapely >= 2.0 extracts the coordinates of all geometries at once
+    from shapely import get_coordinates, get_parts
+except ImportError:
+    get_coordinates = None
+
+# polygons larger than a pixel are burned into a grid with this many sub pixels per pixel side
+SUPERSAMPLING = 4
+
+# points are counted in all pixels within this radius, single pixels would hardly be visible
+POINT_RADIUS = 1
+
+# minimum opacity of pixels with features, so that single features stay visible next to dense areas
+MIN_ALPHA = 0.3
+
+
+def raster_shape(bounds, pixels):
+    """Get the size of the pixel grid for the given extent.
+
+    Args:
+        bounds (tuple): minx, miny, maxx, maxy of the extent
+        pixels (Integer): number of pixels of the longer side
+
+    Returns:
+        tuple: height and width of the grid in pixels
+    """
+    width, height = bounds[2] - bounds[0], bounds[3] - bounds[1]
+    longer = max(width, height)
+    return max(1, round(pixels * height / longer)), max(1, round(pixels * width / longer))
+
+
+def rasterize_layer(layer, bounds, shape):
+    """Aggregate the features of a layer per pixel.
+
+    Points are counted (within POINT_RADIUS pixels), for lines the length within each pixel is summed up and for
+    polygons the covered share of each pixel. All aggregations are vectorized, the time depends on the number of
+    vertices and pixels.
+
+    Args:
+        layer (GeoDataFrame): layer in the crs of the bounds
+        bounds (tuple): minx, miny, maxx, maxy of the grid
+        shape (tuple): height and width of the grid in pixels
+
+    Returns:
+        numpy array: aggregated values with shape, the first row is the northern border of the grid
+    """
+    geometries = layer.geometry[~layer.geometry.is_empty]
+    geom_types = geometries.geom_type
+    pixel_size = ((bounds[2] - bounds[0]) / shape[1], (bounds[3] - bounds[1]) / shape[0])
+
+    grid = np.zeros(shape)
+    points = geometries[geom_types.isin(["Point", "MultiPoint"])]
+    if len(points):
+        coords, _ = _coordinates(points)
+        grid += _spread(_histogram(coords, bounds, shape), POINT_RADIUS)
+
+    lines = geometries[geom_types.isin(["LineString", "LinearRing", "MultiLineString"])]
+    if len(lines):
+        coords, weights = _line_samples(lines, min(pixel_size))
+        # length in pixels -> comparable between plots of different extents
+        grid += _histogram(coords, bounds, shape, weights / min(pixel_size))
+
+    polygons = geometries[geom_types.isin(["Polygon", "MultiPolygon"])]
+    if len(polygons):
+        grid += _coverage(polygons, bounds, shape, pixel_size[0] * pixel_size[1])
+    return grid
+
+
+def _coordinates(geometries):
+    """Coordinates of all parts of the geometries and the part each coordinate belongs to."""
+    if get_coordinates:
+        parts = get_parts(np.asarray(geometries))
+        return get_coordinates(parts, return_index=True)
+
+    coords, index = [], []
+    parts = [part for geometry in geometries for part in getattr(geometry, "geoms", [geometry])]
+    for i, part in enumerate(parts):
+        part_coords = np.asarray(part.coords)[:, :2]
+        coords.append(part_coords)
+        index.append(np.full(len(part_coords), i))
+    return np.vstack(coords), np.concatenate(index)
+
+
+def _line_samples(lines, step):
+    """Sample points along the lines at least every step, weighted with the length they stand for."""
+    coords, part_index = _coordinates(lines)
+    # segments between consecutive vertices of the same part
+    same_part = part_index[:-1] == part_index[1:]
+    start, end = coords[:-1][same_part], coords[1:][same_part]
+    length = np.hypot(*(end - start).T)
+
+    # long segments are split so that their length is spread over all pixels they cross
+    n_samples = np.maximum(1, np.ceil(length / step * 2)).astype(int)
+    segment = np.repeat(np.arange(len(length)), n_samples)
+    first_sample = np.cumsum(n_samples) - n_samples
+    position = (np.arange(len(segment)) - first_sample[segment] + 0.5) / n_samples[segment]
+
+    samples = start[segment] + (end[segment] - start[segment]) * position[:, None]
+    return samples, (length / n_samples)[segment]
+
+
+def _coverage(polygons, bounds, shape, pixel_area):
+    """Share of each pixel covered by the polygons, overlapping polygons add up."""
+    areas = polygons.area.to_numpy()
+    small = areas < pixel_area
+
+    # polygons smaller than a pixel are counted with their area at their centroid
+    centroids = polygons[small].centroid
+    grid = _histogram(np.column_stack([centroids.x, centroids.y]), bounds, shape, areas[small] / pixel_area)
+
+    if not small.all():
+        # large polygons are burned into a finer grid, the share of sub pixels gives the coverage
+        fine_shape = (shape[0] * SUPERSAMPLING, shape[1] * SUPERSAMPLING)
+        burned = features.rasterize(
+            ((polygon, 1) for polygon in polygons[~small]),
+            out_shape=fine_shape,
+            transform=from_bounds(*bounds, fine_shape[1], fine_shape[0]),
+            merge_alg=MergeAlg.add,
+            dtype="uint16",
+        )
+        grid += burned.reshape(shape[0], SUPERSAMPLING, shape[1], SUPERSAMPLING).mean(axis=(1, 3))
+    return grid
+
+
+def _histogram(coords, bounds, shape, weights=None):
+    """Sum up the weights of the coordinates per pixel, the first row is the northern border."""
+    grid, _, _ = np.histogram2d(
+        coords[:, 1],
+        coords[:, 0],
+        bins=shape,
+        range=[[bounds[1], bounds[3]], [bounds[0], bounds[2]]],
+        weights=weights,
+    )
+    return grid[::-1]
+
+
+def _spread(grid, radius):
+    """Sum up the values of all pixels within radius (square neighbourhood)."""
+    if radius < 1:
+        return grid
+    padded = np.pad(grid, radius)
+    spread = np.zeros_like(grid)
+    size = 2 * radius + 1
+    for dy in range(size):
+        for dx in range(size):
+            spread += padded[dy:dy + grid.shape[0], dx:dx + grid.shape[1]]
+    return spread
+
+
+def to_image(grid, color):
+    """Color the aggregated values of a layer, the opacity shows the value.
+
+    Args:
+        grid (numpy array): aggregated values, see rasterize_layer
+        color (String): color name or hex code of the layer
+
+    Returns:
+        numpy array: RGBA image as uint8 with shape (height, width, 4)
+    """
+    alpha = np.zeros(grid.shape)
+    filled = grid > 0
+    if filled.any():
+        # log scale -> sparse areas stay visible next to very dense ones
+        scaled = np.log1p(grid[filled]) / np.log1p(grid[filled].max())
+        alpha[filled] = MIN_ALPHA + (1 - MIN_ALPHA) * np.clip(scaled, 0, 1)
+
+    image = np.empty(grid.shape + (4,), dtype=np.uint8)
+    image[..., :3] = np.array(to_rgba(color)[:3]) * 255
+    image[..., 3] = alpha * 255
+    return image
@@ -0,0 +1,245 @@
+"""Bokeh server of the layers, only the features in the viewport are sent to the browser.
+
+The layers stay in memory with their spatial index. On every pan or zoom the features intersecting the viewport are
+looked up and simplified to the level of detail of the zoom (see mapping.extent_tolerance) before they replace the data of
+the plot. Layers with more features in the viewport than max_features are aggregated per pixel of the viewport instead
+(see rasterize). The basemap can be switched with a select widget.
+"""
+from functools import partial
+import geopandas as gpd
+import numpy as np
+from definitions import TILE_CACHE_PATH, logger_f
+import basemap_cache
+import mapping
+import profiling
+from xyzservices import TileProvider
+
+# layers with more features in the viewport are drawn as image
+MAX_FEATURES = 50000
+
+# url the server serves the tile cache at, the browser can not load file urls from a page served over http
+TILES_URL = "/tiles"
+
+# padding of the initial viewport relative to the extent of the layers, like the default range_padding of bokeh
+RANGE_PADDING = 0.1
+
+
+def viewport_data(geom_layer, color, bounds, pixels, max_features=MAX_FEATURES):
+    """Get the data of a layer in the viewport.
+
+    Args:
+        geom_layer (GeoDataFrame): layer with the same crs as the bounds
+        color (String): color of the layer, used for the image
+        bounds (tuple): minx, miny, maxx, maxy of the viewport
+        pixels (Integer): size of the longer side of the plot in pixels
+        max_features (Integer): more features in the viewport are aggregated to an image of the viewport
+
+    Returns:
+        tuple: data of the glyph (see mapping.geometry_source) and of the image (see mapping.raster_data), the unused one
+        is empty, and the number of features in the viewport
+    """
+    import rasterize
+    from shapely.geometry import box
+
+    glyph = mapping.glyph_type(geom_layer)
+    empty = {"x": [], "y": []} if glyph == "circle" else {"xs": [], "ys": []}
+    positions = np.sort(geom_layer.sindex.query(box(*bounds)))
+    if not len(positions):
+        return empty, {"image": [], "x": [], "y": [], "dw": [], "dh": []}, 0
+
+    visible = geom_layer if len(positions) == len(geom_layer) else geom_layer.iloc[positions]
+    if len(positions) > max_features:
+        shape = rasterize.raster_shape(bounds, pixels)
+        return empty, mapping.raster_data(visible, color, bounds, shape), len(positions)
+
+    tolerance = mapping.extent_tolerance(bounds, pixels)
+    geometries = visible.geometry
+    if glyph != "circle" and tolerance is not None:
+        geometries = geometries.simplify(tolerance, preserve_topology=True)
+    # the columns are moved to the source of the plot, bokeh can not assign the data of one source to another
+    data = dict(mapping.geometry_source(gpd.GeoDataFrame(geometry=geometries)).data)
+    return data, {"image": [], "x": [], "y": [], "dw": [], "dh": []}, len(positions)
+
+
+def basemap_options(offline=False):
+    """Get the names of the basemaps the server can switch between.
+
+    Args:
+        offline (Boolean): True: only basemaps of the tile cache
+
+    Returns:
+        list: names of the providers without API key
+    """
+    providers = mapping.get_cx_providers()
+    names = [name for name, provider in providers.items() if not TileProvider(provider).requires_token()]
+    if offline:
+        names = [name for name in names if (TILE_CACHE_PATH / name).is_dir()]
+    return sorted(names)
+
+
+def _tile_source(name, offline):
+    """Create the bokeh tile source of a basemap."""
+    from bokeh.tile_providers import get_provider
+
+    provider = TileProvider(mapping.get_cx_providers()[name])
+    if offline:
+        provider = basemap_cache.local_provider(provider, TILES_URL)
+    return get_provider(provider)
+
+
+def initial_bounds(map_layer):
+    """Get the viewport showing all layers, padded and square like the plot.
+
+    Args:
+        map_layer (DataFrame): with the last column GeoDataFrames
+
+    Returns:
+        tuple: minx, miny, maxx, maxy
+    """
+    minx, miny, maxx, maxy = mapping.total_bounds(map_layer)
+    size = max(maxx - minx, maxy - miny) * (1 + RANGE_PADDING) or 1
+    center_x, center_y = (minx + maxx) / 2, (miny + maxy) / 2
+    return center_x - size / 2, center_y - size / 2, center_x + size / 2, center_y + size / 2
+
+
+def make_document(doc, map_layer, basemap, title, offline=False, max_features=MAX_FEATURES):
+    """Create the plot of a browser session of the server.
+
+    Args:
+        doc (Document): bokeh document of the session
+        map_layer (DataFrame): with the columns Name, Color and last column GeoDataFrames in EPSG:3857, the first layer is
+            drawn first
+        basemap (String): name of the initial basemap
+        title (String): title of the plot
+        offline (Boolean): True: load the basemap tiles from the tile cache
+        max_features (Integer): more features of a layer in the viewport are drawn as image
+    """
+    from bokeh.events import RangesUpdate
+    from bokeh.layouts import column, row
+    from bokeh.models import ColumnDataSource, Div, Range1d, Select
+    from bokeh.plotting import figure
+
+    size = mapping.PLOT_SIZE_BOKEH
+    bounds = initial_bounds(map_layer)
+    p = figure(
+        title=title,
+        height=size,
+        width=size,
+        x_range=Range1d(bounds[0], bounds[2]),
+        y_range=Range1d(bounds[1], bounds[3]),
+        toolbar_location="right",
+        tools="pan, wheel_zoom, box_zoom, reset, save",
+        output_backend="webgl",
+    )
+    p.xgrid.grid_line_color = None
+    p.ygrid.grid_line_color = None
+    p.axis.visible = False
+    p.title.align = "center"
+    p.title.text_font_size = "40px"
+
+    tiles = p.add_tile(_tile_source(basemap, offline), name=basemap)
+
+    # every layer has a source for its features and one for its image, only one of them holds data
+    layers = []
+    for name, color, geom_layer in zip(map_layer["Name"], map_layer["Color"], map_layer.iloc[:, -1]):
+        label = name.capitalize()
+        features = ColumnDataSource()
+        image = ColumnDataSource(data={"image": [], "x": [], "y": [], "dw": [], "dh": []})
+        glyph = mapping.glyph_type(geom_layer)
+        if glyph == "circle":
+            features.data = {"x": [], "y": []}
+            p.circle("x", "y", source=features, color=color, size=10, legend_label=label)
+        elif glyph == "multi_line":
+            features.data = {"xs": [], "ys": []}
+            p.multi_line("xs", "ys", source=features, line_color=color, line_width=3, legend_label=label)
+        else:
+            features.data = {"xs": [], "ys": []}
+            p.patches("xs", "ys", source=features, fill_color=color, line_color="black", line_width=0.25, legend_label=label)
+        p.image_rgba(image="image", x="x", y="y", dw="dw", dh="dh", source=image, legend_label=label)
+        layers.append((name, color, geom_layer, features, image))
+
+    p.legend.location = "bottom_right"
+    p.legend.click_policy = "hide"
+
+    status = Div(width=300)
+    options = basemap_options(offline)
+    select = Select(title="Basemap", value=basemap, options=options if basemap in options else [basemap] + options, width=300)
+
+    def change_basemap(attr, old, new):
+        tiles.tile_source = _tile_source(new, offline)
+        tiles.name = new
+
+    select.on_change("value", change_basemap)
+
+    shown = {}
+
+    def update(viewport):
+        # several range updates of one interaction can arrive with the same viewport
+        if shown.get("bounds") == viewport:
+            return
+        shown["bounds"] = viewport
+        lines = []
+        with profiling.span("viewport", category="server", bounds=viewport):
+            for name, color, geom_layer, features, image in layers:
+                features.data, image.data, n_features = viewport_data(geom_layer, color, viewport, size, max_features)
+                mode = "image" if image.data["image"] else "features"
+                lines.append(f"{name}: {n_features} {mode}")
+        status.text = "<br>".join(lines)
+
+    def on_ranges_update(event):
+        update((event.x0, event.y0, event.x1, event.y1))
+
+    p.on_event(RangesUpdate, on_ranges_update)
+    update(bounds)
+
+    doc.title = title
+    doc.add_root(row(p, column(select, status)))
+
+
+def create_server(map_layer, basemap, title, port=5006, offline=False, max_features=MAX_FEATURES):
+    """Create the bokeh server of the layers, it is not started yet.
+
+    Args:
+        map_layer (DataFrame): see make_document
+        basemap (String): name of the initial basemap
+        title (String): title of the plot
+        port (Integer): port of the server, 0: any free port
+        offline (Boolean): True: load the basemap tiles from the tile cache
+        max_features (Integer): more features of a layer in the viewport are drawn as image
+
+    Returns:
+        Server: bokeh server serving the map at / and the tile cache at TILES_URL
+    """
+    from bokeh.application import Application
+    from bokeh.application.handlers.function import FunctionHandler
+    from bokeh.server.server import Server
+    from tornado.web import StaticFileHandler
+
+    # the spatial indices are built once before the first session, all sessions share them
+    for name, geom_layer in zip(map_layer["Name"], map_layer.iloc[:, -1]):
+        with profiling.span("sindex", layer=name):
+            geom_layer.sindex.size  # the index is built on the first access
+
+    handler = FunctionHandler(
+        partial(make_document, map_layer=map_layer, basemap=basemap, title=title, offline=offline, max_features=max_features)
+    )
+    # the tiles of the cache are served next to the map, see _tile_source
+    tiles = (rf"{TILES_URL}/(.*)", StaticFileHandler, {"path": str(TILE_CACHE_PATH)})
+    return Server({"/": Application(handler)}, port=port, extra_patterns=[tiles])
+
+
+def serve(map_layer, basemap, title, port=5006, offline=False, max_features=MAX_FEATURES):
+    """Serve the layers with a bokeh server until it is stopped (Ctrl+C).
+
+    Args:
+        map_layer (DataFrame): see make_document
+        basemap (String): name of the initial basemap
+        title (String): title of the plot
+        port (Integer): port of the server, 0: any free port
+        offline (Boolean): True: load the basemap tiles from the tile cache
+        max_features (Integer): more features of a layer in the viewport are drawn as image
+    """
+    server = create_server(map_layer, basemap, title, port, offline, max_features)
+    server.start()
+    logger_f.info(f"serving the map on http://localhost:{server.port}/")
+    server.io_loop.start()
@@ -1,18 +1,61 @@
 import sys
 import os
+import asyncio
+import queue
+import io
+import subprocess
 import geopandas as gpd
 from pathlib import Path
 import pandas as pd
-from ohsome_api import download_osm
-from shapely.geometry import Point
+from ohsome_api import apply_changes, download_osm, iter_features, merge_tiles, split_aoi
+import ohsome_api
+from shapely.geometry import LineString, MultiLineString, MultiPoint, MultiPolygon, Point, Polygon, box
 import json
+import matplotlib.pyplot as plt
+import PIL
+import numpy as np
+import click
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import pytest
+import requests
+from bokeh.models import GlyphRenderer
 from bokeh.plotting.figure import figure
-from mapping import change_crs, create_statistics, get_cx_providers
+from mapping import (
+    add_basemap,
+    change_crs,
+    create_statistics,
+    geometry_source,
+    get_cx_providers,
+    lod_tolerance,
+    map_bokeh,
+    map_multiple,
+    simplify_layers,
+)
+import main
+from main import download_layer
+import basemap_cache
+import batch
+import definitions
+import benchmark
+import download_cache
+import mapping
+import mapbox_vector_tile
+import mercantile
+import metrics
+import ohsome_stub
+import png_export
+import profiling
+import vector_tiles
+import rasterize
+import server
 
 # what a hacky thing to do.. nonetheless, anything else did not work out
 sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
-from definitions import DATA_PATH, logger_m
-from inputOutput import get_params, save_osm, read_file
+from definitions import DATA_PATH, INPUT_PATH, logger_m
+import inputOutput
+from inputOutput import get_params, save_osm, save_osm_stream, read_file
 
 
 DATA_PATH_TEST = Path(DATA_PATH / "test_data")
@@ -84,6 +127,41 @@ def test_save_osm():
     fpath_out.unlink()
 
 
+def test_save_read_parquet(tmp_path):
+    """Test the GeoParquet driver and its column projection."""
+    layer = gpd.GeoDataFrame(
+        {"highway": ["primary", "footway"]},
+        geometry=[LineString([(0, 0), (1, 1)]), LineString([(1, 1), (2, 0)])],
+        index=pd.Index(["way/1", "way/2"], name="@osmId"),
+        crs="EPSG:4326",
+    )
+    fpath = tmp_path / "highways.parquet"
+    save_osm(fpath, "parquet", layer)
+
+    file = read_file(fpath, "gpd")
+    assert list(file["@osmId"]) == ["way/1", "way/2"], "index should be stored as column"
+    assert file.crs == layer.crs, "crs should be kept"
+
+    file = read_file(fpath, "parquet", columns=["geometry"])
+    assert list(file.columns) == ["geometry"], "only the requested columns should be read"
+    assert file.geometry[1].equals(layer.geometry.iloc[1]), "geometry should be read correctly"
+
+
+def test_read_file_bbox(tmp_path):
+    """Test that only features inside of the bounding box are read."""
+    layer = gpd.GeoDataFrame(geometry=gpd.points_from_xy(range(10), range(10)), crs="EPSG:4326")
+    extent = main.parse_extent("1.5,1.5,4.5,4.5")
+
+    for driver in ["gpkg", "parquet"]:
+        fpath = tmp_path / f"points.{driver}"
+        save_osm(fpath, driver, layer)
+        file = read_file(fpath, "gpd", bbox=extent.to_crs(3857))
+        assert sorted(file.geometry.x) == [2, 3, 4], f"bbox should be reprojected and applied to {driver}"
+
+    with pytest.raises(click.BadParameter):
+        main.parse_extent("1,2,3")
+
+
 def test_get_params():
     """Test the conversion of input data to df."""
     fname = "input_download.json"
@@ -113,6 +191,172 @@ def test_download_osm():
     assert response is None, "response should be None"
 
 
+def test_download_cache(tmp_path, monkeypatch):
+    """Test that identical requests are served from the download cache, independent of the layer name."""
+    monkeypatch.setattr(download_cache, "CACHE_PATH", tmp_path / "cache")
+    monkeypatch.setattr(download_cache, "MANIFEST_PATH", tmp_path / "cache" / "manifest.json")
+    monkeypatch.setattr(main, "DATA_PATH", tmp_path)
+
+    filter = "amenity=bicycle_parking and geometry:point"
+    bpolys = read_file(INPUT_PATH / "input_polygon.geojson", "gpd")
+    key = download_cache.cache_key(filter=filter, time=None, bpolys=bpolys)
+
+    assert key == download_cache.cache_key(filter=f" {filter}  ", time=None, bpolys=bpolys), "whitespace changed the key"
+    assert key != download_cache.cache_key(filter="amenity=bench", time=None, bpolys=bpolys), "filter did not change the key"
+    assert download_cache.get_cached_layer(key, "GeoJSON") is None, "cache should be empty"
+
+    download_cache.add_to_cache(key, "GeoJSON", DATA_PATH_TEST / "bicycle_parking.GeoJSON", filter=filter)
+    assert download_cache.get_cached_layer(key, "GeoJSON") is not None, "layer should be cached"
+    assert download_cache.get_cached_layer(key, "gpkg") is None, "cache entries are driver specific"
+
+    # a renamed layer with the same request is served from the cache without downloading
+    row = pd.Series(["renamed_parking", filter, "None", "input_polygon.geojson"], index=["Name", "Filter", "Time", "Polygon"])
+    assert download_layer(row, driver="GeoJSON", overwrite=False), "cached layer should be reported as available"
+    assert (tmp_path / "renamed_parking.GeoJSON").is_file(), "cached layer was not linked to the data folder"
+
+    # entries expire after the ttl and are evicted if the cache gets too big
+    assert download_cache.get_cached_layer(key, "GeoJSON", ttl=0) is None, "expired entry should not be served"
+    download_cache.add_to_cache("a", "GeoJSON", DATA_PATH_TEST / "bicycle_parking.GeoJSON")
+    download_cache.add_to_cache("b", "GeoJSON", DATA_PATH_TEST / "bicycle_parking.GeoJSON", max_size=1)
+    assert download_cache.get_cached_layer("a", "GeoJSON") is None, "least recently used entry should be evicted"
+    assert download_cache.get_cached_layer("b", "GeoJSON") is not None, "latest entry should be kept"
+
+    # parallel downloads of the same request (--jobs) cache it at the same time
+    source = DATA_PATH_TEST / "bicycle_parking.GeoJSON"
+    with ThreadPoolExecutor(8) as executor:
+        paths = list(executor.map(lambda _: download_cache.add_to_cache("c", "GeoJSON", source), range(32)))
+    assert paths[0].read_bytes() == source.read_bytes(), "the cached file should be complete"
+    assert not list((tmp_path / "cache").glob("*.tmp")), "temporary files should be removed"
+
+
+def test_tiled_download(monkeypatch):
+    """Test the quadtree split of the area of interest and the merge of features crossing tile borders."""
+    bpolys = gpd.GeoDataFrame(geometry=[box(0, 0, 4, 4)], crs="EPSG:4326")
+
+    # pretend that all features are in the lower left corner of the area -> only that corner gets split again
+    density = lambda filter, time, bpolys: int(100 * bpolys.intersection(box(0, 0, 1, 1)).area.sum())
+    monkeypatch.setattr(ohsome_api, "count_features", density)
+    tiles = split_aoi(filter="building=*", time=None, bpolys=bpolys, max_features=50)
+    assert len(tiles) == 4, "only the dense quadrant should be split further, empty tiles dropped"
+    assert max(tile.unary_union.area for tile in tiles) == 0.25, "dense area should be split into small tiles"
+
+    # feature 1 crosses the border of both tiles, feature 2 is only in the first one
+    index = pd.Index(["way/1", "way/2"], name="@osmId")
+    first = gpd.GeoDataFrame(geometry=[LineString([(0, 0), (1, 0)]), Point(0.5, 0.5)], index=index, crs="EPSG:4326")
+    second = gpd.GeoDataFrame(geometry=[LineString([(1, 0), (2, 0)])], index=index[:1], crs="EPSG:4326")
+    merged = merge_tiles([first, second])
+
+    assert len(merged) == 2, "feature crossing the tile border should only be returned once"
+    assert merged.index.name == "@osmId", "index should be kept"
+    assert merged.loc["way/1"].geometry.length == 2, "parts of the feature should be merged"
+
+
+def test_streamed_download(tmp_path):
+    """Test the incremental parsing of an ohsome response and writing it to file batch by batch."""
+    features = [
+        {"type": "Feature", "geometry": {"type": "Point", "coordinates": [8.7, 49.4]}, "properties": {"@osmId": f"node/{i}"}}
+        for i in range(5)
+    ]
+    features[0]["properties"]["name"] = "Straße"  # multi byte character
+    response = json.dumps({"attribution": {"text": "OSM"}, "type": "FeatureCollection", "features": features}).encode()
+    chunks = [response[i:i + 7] for i in range(0, len(response), 7)]  # chunks split the features and characters
+
+    assert list(iter_features(chunks)) == features, "features should be parsed across chunk borders"
+
+    for driver in ["GeoJSON", "gpkg"]:
+        fpath = tmp_path / f"streamed.{driver}"
+        n_features = save_osm_stream(fpath, driver=driver, features=iter_features(chunks), batch_size=2)
+        file = read_file(fpath, "gpd")
+        assert n_features == len(file) == 5, f"all features should be written to {driver}"
+        assert file["name"][0] == "Straße", f"properties should be written to {driver}"
+
+    # keys first appearing after the first batch need a column as well
+    for i in range(3, 5):
+        features[i]["properties"]["amenity"] = "bench"
+    n_features = save_osm_stream(tmp_path / "late_keys.gpkg", driver="gpkg", features=iter(features), batch_size=2)
+    file = read_file(tmp_path / "late_keys.gpkg", "gpd")
+    assert n_features == 5 and list(file["amenity"][3:]) == ["bench", "bench"], "keys of later batches should be kept"
+    assert not list(tmp_path.glob("*.part*")), "temporary files should be removed"
+
+    empty = [b'{"type": "FeatureCollection", "features": []}']
+    assert save_osm_stream(tmp_path / "empty.GeoJSON", "GeoJSON", iter_features(empty)) == 0, "should not find features"
+    assert not (tmp_path / "empty.GeoJSON").exists(), "empty layers should not be saved"
+
+
+def test_apply_changes():
+    """Test patching a cached layer with created, modified and deleted features."""
+    layer = gpd.GeoDataFrame(
+        {"@osmId": ["node/1", "node/2", "node/3"], "@snapshotTimestamp": ["2021-01-01T00:00:00"] * 3},
+        geometry=gpd.points_from_xy([0, 1, 2], [0, 1, 2]),
+        crs="EPSG:4326",
+    )
+    changed = gpd.GeoDataFrame(
+        {"@osmId": ["node/2", "node/4"], "@timestamp": ["2021-02-01T00:00:00"] * 2, "@creation": [None, True]},
+        geometry=gpd.points_from_xy([10, 4], [10, 4]),
+        crs="EPSG:4326",
+    )
+    patched = apply_changes(layer, changed=changed, deleted={"node/3"}, timestamp="2021-02-02T00:00:00")
+
+    assert list(patched.columns) == list(layer.columns), "columns of the layer should not change"
+    assert sorted(patched["@osmId"]) == ["node/1", "node/2", "node/4"], "deleted feature should be removed, new one added"
+    assert patched.set_index("@osmId").geometry["node/2"].x == 10, "modified feature should be replaced"
+    assert patched.set_index("@osmId")["@snapshotTimestamp"]["node/4"] == "2021-02-02T00:00:00", "timestamp not updated"
+
+
+def test_request_retries(monkeypatch):
+    """Test that transient ohsome errors are retried and the shared session is used."""
+    responses = [requests.ConnectionError("connection reset"), 503, 200]
+    calls = []
+
+    class FlakySession:
+        def request(self, method, url, **kwargs):
+            calls.append(url)
+            result = responses.pop(0)
+            if isinstance(result, Exception):
+                raise result
+            response = requests.Response()
+            response.status_code = result
+            response.raw = io.BytesIO(b'{"result": [{"value": 42.0}]}')
+            return response
+
+    monkeypatch.setattr(ohsome_api, "get_session", lambda: FlakySession())
+    monkeypatch.setitem(ohsome_api._settings, "backoff", 0)
+    bpolys = gpd.GeoDataFrame(geometry=[box(0, 0, 1, 1)], crs="EPSG:4326")
+
+    assert ohsome_api.count_features("building=*", None, bpolys) == 42, "request should succeed after the retries"
+    assert len(calls) == 3, "two failed requests should have been retried"
+
+    monkeypatch.setitem(ohsome_api._settings, "retries", 0)
+    responses.append(503)
+    with pytest.raises(requests.HTTPError):
+        ohsome_api.count_features("building=*", None, bpolys)
+
+
+def test_ohsome_stub(tmp_path, monkeypatch):
+    """Test the downloads against the local ohsome stand-in with injected errors."""
+    server = ohsome_stub.start_server(2000, "line", error_rate=0.2, latency=0.01)
+    try:
+        monkeypatch.setitem(ohsome_api._settings, "url", server.url)
+        monkeypatch.setitem(ohsome_api._settings, "backoff", 0)
+        monkeypatch.setitem(ohsome_api._settings, "retries", 20)
+        bpolys = gpd.GeoDataFrame(geometry=[box(*ohsome_stub.DEFAULT_EXTENT)], crs="EPSG:4326")
+
+        layer = download_osm("highway=*", None, bpolys)
+        assert len(layer) == 2000 and (layer.geom_type == "LineString").all(), "all synthetic lines should be downloaded"
+        tiled = download_osm("highway=*", None, bpolys, max_features=300, jobs=4)
+        assert len(tiled) == 2000 and server.requests["elements/count"] > 1, "tiles should add up to the whole layer"
+
+        n_features = ohsome_api.download_osm_to_file("highway=*", None, bpolys, tmp_path / "lines.GeoJSON", "GeoJSON")
+        assert n_features == 2000, "the chunked response should be streamed to the file"
+        assert ohsome_api.get_data_timestamp(), "the stub should answer metadata requests"
+    finally:
+        server.shutdown()
+        server.server_close()
+
+    key = lambda url: download_cache.cache_key("highway=*", None, bpolys, endpoint=f"{url}/elements/geometry")
+    assert key(server.url) != key("https://api.ohsome.org/v1"), "downloads of the stub should be cached separately"
+
+
 def test_change_crs():
     """Test to change the CRS of a nested geopandas dataframe works correctly."""
     data = [["highway", "red"]]
@@ -125,6 +369,393 @@ def test_change_crs():
     assert gdf_crs["Layers"][0].crs.srs == "epsg:3857", "changing the CRS did not work"
 
 
+def test_reproject():
+    """Test that layers are reprojected with cached transformers and only if required."""
+    layer = gpd.GeoDataFrame({"name": ["a", "b"]}, geometry=[Point(8.42, 49.25), LineString([(8, 49), (9, 50)])], crs=4326)
+    reprojected = inputOutput.reproject(layer, 3857)
+    assert reprojected.geom_equals_exact(layer.to_crs(epsg=3857), 1e-6).all(), "should be reprojected like to_crs"
+    assert reprojected.crs.to_epsg() == 3857 and list(reprojected["name"]) == ["a", "b"], "crs and columns should be set"
+    assert inputOutput.reproject(reprojected, 3857) is reprojected, "layers in the target crs should not be reprojected"
+
+    hits = inputOutput.get_transformer.cache_info().hits
+    inputOutput.reproject(layer, 3857)
+    assert inputOutput.get_transformer.cache_info().hits == hits + 1, "the transformer should be reused"
+
+    bpolys = gpd.GeoDataFrame(geometry=[box(8, 49, 9, 50)], crs=4326)
+    key = download_cache.cache_key(filter="building=*", time=None, bpolys=bpolys)
+    assert key == download_cache.cache_key(filter="building=*", time=None, bpolys=bpolys, crs=4326), "default crs changed"
+    assert key != download_cache.cache_key(filter="building=*", time=None, bpolys=bpolys, crs=3857), "crs should be in the key"
+
+
+def test_simplify_layers():
+    """Test the simplification of layers to the plotted level of detail."""
+    circle = Point(500, 500).buffer(400, resolution=256)
+    layer = gpd.GeoDataFrame(geometry=[circle, Point(0, 0).buffer(0.1)], crs="EPSG:3857")
+    map_layer = pd.DataFrame({"Name": ["circles"], "Color": ["red"]}).assign(Layers=[layer])
+
+    tolerance = lod_tolerance(map_layer, pixels=100)
+    assert tolerance == 4, "tolerance should be half a pixel rounded down to a power of two"
+
+    simplified = simplify_layers(map_layer, pixels=100)
+    geometry = simplified["Layers"][0].geometry
+    assert len(geometry[0].exterior.coords) < len(circle.exterior.coords), "vertices should be removed"
+    assert geometry.is_valid.all() and not geometry.is_empty.any(), "geometries should stay valid and not collapse"
+    assert circle.hausdorff_distance(geometry[0]) <= tolerance, "simplified geometry should differ by less than the tolerance"
+    assert len(map_layer["Layers"][0].geometry[0].exterior.coords) == len(circle.exterior.coords), "input should not change"
+    assert simplify_layers(map_layer, pixels=100)["Layers"][0] is simplified["Layers"][0], "result should be cached"
+
+
+def test_draw_layer():
+    """Test drawing a layer with one collection per geometry type without modifying it."""
+    from matplotlib.collections import LineCollection, PatchCollection, PathCollection
+
+    # exterior and hole both clockwise -> the hole would be filled without fixing the orientation
+    polygon = Polygon([(0, 0), (0, 10), (10, 10), (10, 0)], [[(3, 3), (3, 7), (7, 7), (7, 3)]])
+    lines = MultiLineString([[(20, 0), (20, 10)], [(25, 0), (25, 10), (30, 10)]])
+    layer = gpd.GeoDataFrame({"name": ["a", "b", "c", "d"]}, geometry=[polygon, lines, Point(40, 5), None], crs=3857)
+    expected = layer.copy()
+
+    fig, ax = plt.subplots()
+    mapping.draw_layer(ax, layer, "red", zorder=10)
+    fig.canvas.draw()
+    image = np.asarray(fig.canvas.buffer_rgba())
+    # rgb of the pixel at the given map coordinates, the rows of the image start at the top
+    display = lambda x, y: ax.transData.transform((x, y)).astype(int)
+    pixel = lambda x, y: tuple(image[image.shape[0] - display(x, y)[1], display(x, y)[0], :3])
+    plt.close(fig)
+
+    assert layer.equals(expected) and list(layer.columns) == ["name", "geometry"], "layer should not be modified"
+    patches, line_collection, points = ax.collections
+    assert isinstance(patches, PatchCollection) and isinstance(points, PathCollection), "one collection per type"
+    assert isinstance(line_collection, LineCollection) and len(line_collection.get_segments()) == 2, "one segment per line"
+    assert all(collection.get_zorder() == 10 for collection in ax.collections), "zorder should be kept"
+
+    assert pixel(1, 5) == (255, 0, 0) and pixel(5, 5) == (255, 255, 255), "hole should stay empty"
+    assert ax.get_xlim()[0] <= 0 and ax.get_xlim()[1] >= 40, "view should contain all geometries"
+
+
+def test_rasterize_layer():
+    """Test the aggregation of layers per pixel for the raster render mode."""
+    bounds, shape = (0, 0, 100, 100), (10, 10)
+
+    points = gpd.GeoDataFrame(geometry=[Point(5, 95), Point(6, 96), MultiPoint([(55, 5), (95, 5)])])
+    grid = rasterize.rasterize_layer(points, bounds, shape)
+    assert grid[0, 0] == 2 and grid[1, 1] == 2 and grid[2, 2] == 0, "points should be counted around their pixel"
+    assert grid[9, 9] == 1 and grid[9, 5] == 1, "the first row should be the top"
+
+    lines = gpd.GeoDataFrame(geometry=[LineString([(0, 55), (100, 55)])])
+    grid = rasterize.rasterize_layer(lines, bounds, shape)
+    np.testing.assert_allclose(grid[4], 1, err_msg="line length should be spread over all crossed pixels")
+    assert grid.sum() == pytest.approx(10), "total line length in pixels should be kept"
+
+    polygons = gpd.GeoDataFrame(geometry=[box(0, 0, 50, 100), box(95, 95, 97, 97)])
+    grid = rasterize.rasterize_layer(polygons, bounds, shape)
+    assert grid[:, :5].min() == 1 and grid[:, 5:9].max() == 0, "large polygons should cover whole pixels"
+    assert grid[0, 9] == pytest.approx(0.04), "small polygons should count with their share of the pixel"
+
+    image = rasterize.to_image(grid, "red")
+    assert image.shape == (10, 10, 4) and image[0, 0, 3] == 255 and image[0, 5, 3] == 0, "opacity should show the value"
+
+    map_layer = pd.DataFrame({"Name": ["polygons"], "Color": ["red"]}).assign(Layers=[polygons.set_crs(3857)])
+    p = map_bokeh(map_layer, "OpenStreetMap.Mapnik", "raster", add_func=False, render_mode="raster")
+    glyphs = [type(renderer.glyph).__name__ for renderer in p.renderers if hasattr(renderer, "glyph")]
+    assert glyphs == ["ImageRGBA"], "layer should be drawn as one image"
+
+
+def test_vector_tiles(tmp_path):
+    """Test cutting layers into vector tiles and the map loading them."""
+    points = gpd.GeoDataFrame({"@osmId": ["node/1"]}, geometry=[Point(8.70, 49.41)], crs="EPSG:4326")
+    lines = gpd.GeoDataFrame(geometry=[LineString([(8.60, 49.41), (8.80, 49.41)])], crs="EPSG:4326")
+    map_layer = pd.DataFrame({"Name": ["points", "lines"], "Color": ["red", "#00ff00"]}).assign(Layers=[points, lines])
+
+    n_tiles = vector_tiles.create_tiles(map_layer, tmp_path, min_zoom=10, max_zoom=12)
+    assert n_tiles == len(list(tmp_path.glob("*/*/*.pbf"))) > 0, "tiles should be written to z/x/y.pbf"
+
+    tile = mercantile.tile(8.70, 49.41, 12)
+    data = mapbox_vector_tile.decode((tmp_path / "12" / str(tile.x) / f"{tile.y}.pbf").read_bytes())
+    assert set(data) == {"points", "lines"}, "every layer should be a layer of the tile"
+    assert data["points"]["features"][0]["properties"] == {"@osmId": "node/1"}, "osm id should be kept"
+    x, y = data["points"]["features"][0]["geometry"]["coordinates"]
+    assert 0 <= x <= 4096 and 0 <= y <= 4096, "coordinates should be tile coordinates"
+
+    empty = mercantile.tile(8.70, 49.45, 12)
+    assert not (tmp_path / "12" / str(empty.x) / f"{empty.y}.pbf").exists(), "empty tiles should not be written"
+
+    provider = get_cx_providers()["OpenStreetMap.Mapnik"]
+    vector_tiles.write_viewer(map_layer, tmp_path, provider, "test", min_zoom=10, max_zoom=12)
+    assert (tmp_path / "index.html").is_file() and (tmp_path / "metadata.json").is_file(), "map should be written"
+
+
+def test_basemap_cache(tmp_path, monkeypatch):
+    """Test prefetching basemap tiles and using them offline."""
+    png = io.BytesIO()
+    PIL.Image.new("RGB", (256, 256), "green").save(png, format="PNG")
+    calls = []
+
+    class TileServer:
+        def get(self, url, **kwargs):
+            calls.append(url)
+            response = requests.Response()
+            response.status_code = 200
+            response._content = png.getvalue()
+            return response
+
+    monkeypatch.setattr(basemap_cache, "TILE_CACHE_PATH", tmp_path)
+    monkeypatch.setattr(basemap_cache, "_get_session", lambda: TileServer())
+    provider = get_cx_providers()["OpenStreetMap.Mapnik"]
+
+    available = basemap_cache.prefetch(provider, (8.69, 49.40, 8.71, 49.42), min_zoom=12, max_zoom=14)
+    assert available == len(calls) == len(list(tmp_path.glob("*/*/*/*.png"))), "all tiles should be downloaded and cached"
+    basemap_cache.prefetch(provider, (8.69, 49.40, 8.71, 49.42), min_zoom=12, max_zoom=14)
+    assert available == len(calls), "cached tiles should not be downloaded again"
+
+    # zoom 16 is not cached -> the highest cached zoom level is used
+    bounds = (*mercantile.xy(8.70, 49.41), *mercantile.xy(8.701, 49.411))
+    image, extent = basemap_cache.mosaic(provider, bounds, zoom=16, offline=True)
+    assert image.shape[2] == 4 and image[0, 0, 1] == 128, "tiles should be stitched to one image"
+    assert extent[0] <= bounds[0] and extent[1] >= bounds[2] and extent[2] <= bounds[1] and extent[3] >= bounds[3]
+    assert available == len(calls), "offline mode should not download tiles"
+    assert basemap_cache.mosaic(provider, (0, 0, 1000, 1000), zoom=14, offline=True) is None, "area is not cached"
+
+    fig, ax = plt.subplots()
+    ax.axis((bounds[0], bounds[2], bounds[1], bounds[3]))
+    add_basemap(ax, provider, 3857, offline=True)
+    assert len(ax.get_images()) == 1 and ax.axis() == (bounds[0], bounds[2], bounds[1], bounds[3]), "basemap should be added"
+    plt.close(fig)
+
+    assert basemap_cache.local_provider(provider).build_url().startswith("file://"), "tiles should be loaded from the cache"
+    basemap_cache.evict(max_size=0)
+    assert not list(tmp_path.glob("*/*/*/*.png")), "least recently used tiles should be evicted"
+
+
+def test_batch(tmp_path, monkeypatch):
+    """Test rendering one map per area of interest in worker processes."""
+    monkeypatch.setattr(mapping, "OUTPUT_PATH", tmp_path)
+    monkeypatch.setattr(basemap_cache, "TILE_CACHE_PATH", tmp_path / "tiles")
+
+    aoi_file = tmp_path / "districts.geojson"
+    names = ["north/1", "south", "east"]
+    areas = [box(0, 50, 20, 100), box(0, 0, 20, 50), box(50, 0, 70, 20)]
+    districts = gpd.GeoDataFrame({"name": names}, geometry=areas, crs=3857)
+    districts.to_file(aoi_file, driver="GeoJSON")
+    aois = batch.read_aois(aoi_file)
+    assert list(aois["name"]) == ["north_1", "south", "east"], "names should be usable in file names"
+
+    lines = gpd.GeoDataFrame(geometry=[LineString([(5, 0), (5, 100)]), LineString([(15, 0), (15, 20)])], crs=3857)
+    shm = batch.share_layer(lines)
+    try:
+        assert batch.load_geometries(shm.name, 2, [1])[0].equals(lines.geometry[1]), "geometries should be shared as WKB"
+    finally:
+        shm.close()
+        shm.unlink()
+
+    map_layer = pd.DataFrame({"Name": ["lines"], "Color": ["red"], "Layers": [lines]})
+    options = dict(crs_epsg=3857, basemap="OpenStreetMap.Mapnik", title="test", render_mode="vector", offline=True, lod=False)
+    results = batch.render_batch(map_layer, aois, workers=2, **options)
+    assert sorted(results["saved"]) == ["north_1", "south"] and not results["failed"], "all maps should be rendered"
+    assert results["skipped"] == ["east"], "areas without features should be reported as skipped"
+    assert sorted(path.name for path in tmp_path.glob("*.png")) == ["test_north_1.png", "test_south.png"], "one map per area"
+
+
+def test_run_forwards_options(monkeypatch):
+    """Test that run passes its options on to run-download and run-plotting."""
+    calls = {}
+    for command in [main.run_download, main.run_plotting]:
+        monkeypatch.setattr(command, "callback", lambda name=command.name, **kwargs: calls.__setitem__(name, kwargs))
+    main.cli(["run", "-d", "parquet", "-pp", "bokeh", "-b", "OpenTopoMap", "-rm", "raster"], standalone_mode=False)
+    assert calls["run-download"]["driver"] == "parquet", "layers should be downloaded with the driver"
+    options = {"driver": "parquet", "plot_package": "bokeh", "basemap": "OpenTopoMap", "render_mode": "raster"}
+    assert options.items() <= calls["run-plotting"].items(), "layers should be plotted from the downloaded files"
+
+
+def test_lazy_imports():
+    """Test that the cli starts without loading the plotting backends and geo libraries."""
+    code = "import sys, main; print(sorted(m for m in ('bokeh', 'contextily', 'geopandas', 'matplotlib') if m in sys.modules))"
+    process = subprocess.run([sys.executable, "-c", code], cwd=Path(__file__).parent, capture_output=True, text=True)
+    assert process.stdout.strip() == "[]", f"importing main should not load {process.stdout.strip()}"
+
+    stderr = "import time:     1000 |       5000 | mapping\nimport time:      200 |       3000 |   bokeh\n"
+    assert benchmark.parse_importtime(stderr) == {"mapping": 5.0}, "only top level imports should be summed up"
+
+    # the startup benchmark imports the modules of every command
+    assert {command.split()[0] for command in benchmark.COMMAND_IMPORTS} == {"--help", *main.cli.commands}
+
+
+def test_pipeline_benchmark():
+    """Test the synthetic layers and an offline run of the pipeline benchmark."""
+    for geometry_type, geom_type in [("point", "Point"), ("line", "LineString"), ("polygon", "Polygon")]:
+        layer = benchmark.synthetic_layer(geometry_type, 50)
+        assert len(layer) == 50 and (layer.geom_type == geom_type).all(), f"50 {geom_type}s should be generated"
+        assert layer.total_bounds[0] > 8.5 and layer.total_bounds[3] < 49.5, "the layer should be in Heidelberg"
+    assert benchmark.synthetic_layer("line", 10).equals(benchmark.synthetic_layer("line", 10)), "layers should be reproducible"
+
+    stages = ["download", "save", "read", "map_gpd"]
+    results = list(benchmark.run_pipeline([100], ["point"], ["GeoJSON"], stages, repeat=1, memory=True))
+    assert [result["stage"] for result in results] == stages, "every stage should be measured once"
+    assert all(result["seconds"] > 0 and result["peak_mb"] is not None for result in results), "time and memory are missing"
+
+    old = {"benchmark": "pipeline", "results": results}
+    new = {"benchmark": "pipeline", "results": [dict(results[0], seconds=results[0]["seconds"] * 2)]}
+    rows = benchmark.compare_results(old, new, threshold=1.5)
+    assert len(rows) == 1 and rows[0][-1], "a scenario twice as slow should be a regression"
+
+
+def test_profiling(tmp_path, monkeypatch):
+    """Test the nested spans of the pipeline stages and their Chrome trace."""
+    with profiling.span("disabled") as disabled:
+        disabled.set(features=1)
+    assert not profiling.is_enabled() and not profiling.summary(), "spans should only be recorded with --profile"
+
+    monkeypatch.setattr(profiling, "_events", None)  # restored after the test -> later tests are not profiled
+    profiling.enable()
+    layer = gpd.GeoDataFrame(geometry=[LineString([(8.6, 49.4), (8.7, 49.4), (8.7, 49.5)])], crs="EPSG:4326")
+    with profiling.span("run", category="command"):
+        change_crs(pd.DataFrame({"Name": ["highway"], "Layers": [layer]}), 3857)
+
+    trace_path = tmp_path / "trace.json"
+    profiling.save_trace(trace_path, command="test")
+    with open(trace_path) as f:
+        trace = json.load(f)
+    spans = {event["name"]: event for event in trace["traceEvents"] if event["ph"] == "X"}
+    assert list(spans) == ["reproject", "change_crs", "run"], "spans should be recorded when they end, innermost first"
+    assert spans["reproject"]["args"]["features"] == 1 and spans["reproject"]["args"]["vertices"] == 3, "counts missing"
+    run, inner = spans["run"], spans["change_crs"]
+    assert run["ts"] <= inner["ts"] and inner["ts"] + inner["dur"] <= run["ts"] + run["dur"], "spans should be nested"
+    assert trace["otherData"]["command"] == "test", "metadata of the run should be saved"
+
+
+def test_metrics(tmp_path, monkeypatch):
+    """Test the counters and histograms of a run and their Prometheus and JSON files."""
+    monkeypatch.setattr(metrics, "_values", {})
+    metrics.inc("mapping_tool_layers_total", result="downloaded")
+    metrics.inc("mapping_tool_layers_total", 2, result="downloaded")
+    for seconds in [0.02, 0.3, 20]:
+        metrics.observe("mapping_tool_read_seconds", seconds, driver="gpkg")
+    with pytest.raises(KeyError):
+        metrics.inc("undefined_metric")
+
+    metrics.save(tmp_path, "run-download", duration=1.5, success=True)
+    prom = (tmp_path / "metrics.prom").read_text().splitlines()
+    assert 'mapping_tool_layers_total{result="downloaded"} 3' in prom, "counter should be summed up"
+    assert 'mapping_tool_read_seconds_bucket{driver="gpkg",le="0.5"} 2' in prom, "buckets should be cumulative"
+    assert 'mapping_tool_read_seconds_bucket{driver="gpkg",le="+Inf"} 3' in prom, "all observations should be counted"
+    assert "# TYPE mapping_tool_read_seconds histogram" in prom, "type of the metric is missing"
+
+    metrics.save(tmp_path, "run-plotting", duration=2, success=False)
+    runs = [json.loads(line) for line in (tmp_path / "metrics.jsonl").read_text().splitlines()]
+    assert [run["command"] for run in runs] == ["run-download", "run-plotting"], "every run should be appended"
+    assert runs[1]["metrics"]["mapping_tool_run_success"][-1]["value"] == 0, "failed run should be recorded"
+
+
+def test_async_logging():
+    """Test that the records of asynchronous logging are written by the listener thread with lazy formatting."""
+    records = []
+    handler = logging.Handler()
+    handler.emit = lambda record: records.append((record.getMessage(), threading.current_thread().name))
+    log = logging.getLogger("test_async")
+    log.setLevel(logging.INFO)
+    log.addHandler(handler)
+
+    definitions.start_async_logging(["test_async"])
+    try:
+        assert handler not in log.handlers, "handler should be moved to the listener"
+        for i in range(3):
+            log.info("record %d", i)
+    finally:
+        definitions.stop_async_logging()
+    assert log.handlers == [handler], "original handlers should be restored without the queue handler"
+    log.removeHandler(handler)
+
+    assert [message for message, _ in records] == ["record 0", "record 1", "record 2"], "records should be written in order"
+    assert all(thread != threading.current_thread().name for _, thread in records), "records should be written by the listener"
+
+
+def test_native_png_export(tmp_path, monkeypatch):
+    """Test exporting a bokeh map with its basemap to PNG without a browser."""
+    monkeypatch.setattr(basemap_cache, "TILE_CACHE_PATH", tmp_path / "tiles")
+    # one cached tile of zoom level 0 -> the offline basemap covers every extent
+    tile = tmp_path / "tiles" / "OpenStreetMap.Mapnik" / "0" / "0" / "0.png"
+    tile.parent.mkdir(parents=True)
+    PIL.Image.new("RGB", (256, 256), "green").save(tile)
+
+    x, y = mercantile.xy(8.69, 49.40)
+    lines = gpd.GeoDataFrame(geometry=[LineString([(x, y), (x + 1000, y + 1000)])], crs=3857)
+    polygons = gpd.GeoDataFrame(geometry=[box(x + 600, y, x + 1000, y + 400)], crs=3857)
+    map_layer = pd.DataFrame({"Name": ["lines", "polygons"], "Color": ["red", "blue"], "Layers": [lines, polygons]})
+
+    layout = map_bokeh(map_layer, "OpenStreetMap.Mapnik", "test", offline=True)
+    path = png_export.export_png(layout, tmp_path / "map.png", offline=True)
+
+    image = np.asarray(PIL.Image.open(path).convert("RGB"))
+    assert image.shape[:2] == (950, 950), "only the map of the layout should be exported in its size"
+    colors = {tuple(color) for color in image.reshape(-1, 3)}
+    assert {(255, 0, 0), (0, 0, 255), (0, 128, 0)} <= colors, "layers and basemap should be drawn"
+
+
+def test_server(tmp_path, monkeypatch):
+    """Test that the server mode only sends the features in the viewport at the level of detail of the zoom."""
+    from bokeh.document import Document
+    from bokeh.events import RangesUpdate
+    from bokeh.models import Div, Plot, Select, TileRenderer
+
+    # circles with many vertices -> simplification removes some of them
+    polygons = benchmark.synthetic_layer("point", 2000).to_crs(3857)
+    polygons.geometry = polygons.buffer(30, 32)
+    points = benchmark.synthetic_layer("point", 100).to_crs(3857)
+    minx, miny, maxx, maxy = polygons.total_bounds
+
+    data, image, n_features = server.viewport_data(polygons, "blue", (minx, miny, maxx, maxy), 950, max_features=500)
+    assert n_features == 2000 and not data["xs"] and len(image["image"]) == 1, "dense viewports should be sent as image"
+
+    viewport = (minx, miny, minx + (maxx - minx) / 4, miny + (maxy - miny) / 4)
+    data, image, n_features = server.viewport_data(polygons, "blue", viewport, 950)
+    assert 0 < n_features < 2000 and not image["image"], "only the features in the viewport should be sent"
+    detailed, _, _ = server.viewport_data(polygons, "blue", viewport, 95000)
+    assert len(data["xs"][0]) < len(detailed["xs"][0]), "features should be simplified to the zoom level"
+
+    # the tile cache holds two basemaps -> both can be selected offline
+    monkeypatch.setattr(server, "TILE_CACHE_PATH", tmp_path)
+    for name in ["OpenStreetMap.Mapnik", "OpenTopoMap"]:
+        (tmp_path / name).mkdir()
+    map_layer = pd.DataFrame({"Name": ["polygons", "points"], "Color": ["blue", "red"], "Layers": [polygons, points]})
+    doc = Document()
+    server.make_document(doc, map_layer, "OpenStreetMap.Mapnik", "test", offline=True, max_features=500)
+
+    select = doc.select_one({"type": Select})
+    assert select.options == ["OpenStreetMap.Mapnik", "OpenTopoMap"], "cached basemaps should be selectable"
+    select.value = "OpenTopoMap"
+    assert doc.select_one({"type": TileRenderer}).name == "OpenTopoMap", "basemap should be switched"
+
+    status = doc.select_one({"type": Div})
+    assert "polygons: 2000 image" in status.text, "all features are in the initial viewport"
+    plot = doc.select_one({"type": Plot})
+    plot._trigger_event(RangesUpdate(plot, x0=viewport[0], y0=viewport[1], x1=viewport[2], y1=viewport[3]))
+    assert "polygons: 2000" not in status.text and "features" in status.text, "pan or zoom should load the viewport"
+
+    # the browser can not load file urls from the page of the server -> the server serves the tile cache
+    url = doc.select_one({"type": TileRenderer}).tile_source.url
+    assert url.startswith(f"{server.TILES_URL}/OpenTopoMap/"), "tiles should be loaded from the server"
+    tile = tmp_path / "OpenTopoMap" / "1" / "0" / "0.png"
+    tile.parent.mkdir(parents=True)
+    tile.write_bytes(b"tile")
+    started = queue.Queue()
+
+    def run_server():
+        asyncio.set_event_loop(asyncio.new_event_loop())
+        bokeh_server = server.create_server(map_layer, "OpenTopoMap", "test", port=0, offline=True)
+        bokeh_server.start()
+        started.put(bokeh_server)
+        bokeh_server.io_loop.start()
+
+    threading.Thread(target=run_server, daemon=True).start()
+    bokeh_server = started.get(timeout=30)
+    try:
+        response = requests.get(f"http://localhost:{bokeh_server.port}{server.TILES_URL}/OpenTopoMap/1/0/0.png", timeout=10)
+        assert response.status_code == 200 and response.content == b"tile", "cached tiles should be served"
+    finally:
+        bokeh_server.io_loop.add_callback(bokeh_server.io_loop.stop)
+
+
 def test_get_cx_providers():
     """Test if the xyz basemap providers works correctly."""
     providers = get_cx_providers()
@@ -136,6 +767,50 @@ def test_get_cx_providers():
     assert provider_check, "no OSM provider listed"
 
 
+def test_geometry_source():
+    """Test the bokeh data source built from the coordinates of the layers."""
+    points = gpd.GeoDataFrame(geometry=[Point(1, 2), MultiPoint([(3, 4), (5, 6)])])
+    source = geometry_source(points)
+    assert list(source.data["x"]) == [1, 3, 5] and list(source.data["y"]) == [2, 4, 6], "all points should be in x and y"
+    assert isinstance(source.data["x"], np.ndarray), "coordinates should be numpy arrays -> binary encoded"
+
+    lines = gpd.GeoDataFrame(geometry=[LineString([(0, 0), (1, 1)]), MultiLineString([[(2, 2), (3, 3)], [(4, 4), (5, 5)]])])
+    xs = geometry_source(lines).data["xs"]
+    assert len(xs) == 1, "the whole layer should be one row"
+    np.testing.assert_array_equal(xs[0], [0, 1, np.nan, 2, 3, np.nan, 4, 5], "features and parts should be separated by NaN")
+
+    hole = [(0.2, 0.2), (0.4, 0.2), (0.4, 0.4)]
+    polygons = gpd.GeoDataFrame(geometry=[Polygon([(0, 0), (1, 0), (1, 1)], [hole])])
+    np.testing.assert_array_equal(geometry_source(polygons).data["ys"][0], [0, 0, 1, 0], "only the exterior ring is used")
+
+
+def test_map_bokeh_glyphs():
+    """Test that every layer is drawn with the glyph of its geometry types, whatever the index of the layer."""
+    # downloaded layers are indexed by @osmId, clipped layers miss rows
+    layers = [
+        gpd.GeoDataFrame(geometry=[MultiPoint([(0, 0), (10, 10)])], index=["node/1"], crs=3857),
+        gpd.GeoDataFrame(geometry=[MultiLineString([[(0, 0), (5, 5)], [(5, 0), (0, 5)]])], index=["way/2"], crs=3857),
+        gpd.GeoDataFrame(geometry=[MultiPolygon([box(0, 0, 1, 1), box(2, 2, 3, 3)])], index=[7], crs=3857),
+    ]
+    map_layer = pd.DataFrame({"Name": ["points", "lines", "polygons"], "Color": ["red", "green", "blue"], "Layers": layers})
+    plot = map_bokeh(map_layer, "OpenStreetMap.Mapnik", "test")
+    glyphs = {type(renderer.glyph).__name__ for renderer in plot.select({"type": GlyphRenderer})}
+    assert {"Circle", "MultiLine", "Patches"} <= glyphs, "multi geometries should get the glyph of their type"
+
+
+def test_map_multiple_shared_sources():
+    """Test that the four figures of the basemap grid share the data sources of the layers."""
+    lines = gpd.GeoDataFrame(geometry=[LineString([(0, 0), (1000, 1000)]), LineString([(0, 1000), (1000, 0)])], crs=3857)
+    points = gpd.GeoDataFrame(geometry=[Point(500, 0), Point(0, 500)], crs=3857)
+    map_layer = pd.DataFrame({"Name": ["lines", "points"], "Color": ["red", "blue"], "Layers": [lines, points]})
+
+    for render_mode in ["vector", "raster"]:
+        grid = map_multiple(map_layer, "OpenStreetMap.Mapnik", "test", render_mode=render_mode)
+        renderers = list(grid.select({"type": GlyphRenderer}))
+        assert len(renderers) == 8, "every figure should draw both layers"
+        assert len({id(renderer.data_source) for renderer in renderers}) == 2, f"{render_mode} sources should be shared"
+
+
 def test_create_statistics():
     """Test the provision of statistics."""
     map_layer = pd.DataFrame({"Name": ["first"], "Layers": [[1, 2, 3, 4, 5]], "Color": "grey"})
@@ -0,0 +1,227 @@
+"""Cuts layers into a pyramid of Mapbox Vector Tiles and creates a map that loads them on demand."""
+import json
+import math
+import shutil
+from datetime import datetime
+import mapbox_vector_tile
+import mercantile
+from definitions import logger_f
+from shapely.affinity import affine_transform
+from shapely.geometry import box
+from shapely.ops import clip_by_rect
+
+# resolution of the tiles, 4096 is the default of the vector tile specification
+TILE_EXTENT = 4096
+# features are clipped a bit outside of the tiles so that lines and outlines do not end at the tile borders
+TILE_BUFFER = 64
+
+# circumference of the earth in web mercator (EPSG:3857)
+WORLD_SIZE = 2 * math.pi * 6378137
+
+MAPLIBRE_VERSION = "2.4.0"
+
+
+def create_tiles(map_layer, out_dir, min_zoom=10, max_zoom=14):
+    """Write all layers as vector tiles to out_dir/z/x/y.pbf.
+
+    Every tile holds one vector tile layer per map layer. Lines and polygons are simplified to the resolution of the
+    zoom level. Empty tiles are not written.
+
+    Args:
+        map_layer (DataFrame): with the column Name and last column GeoDataFrames
+        out_dir (Path): directory of the tile pyramid
+        min_zoom (Integer): lowest zoom level of the pyramid
+        max_zoom (Integer): highest zoom level of the pyramid, the map shows the tiles of this level when zooming in further
+
+    Returns:
+        Integer: number of written tiles
+    """
+    logger_f.info("start creating vector tiles")
+    start_time = datetime.now()
+
+    layers = [(name, lay.to_crs(epsg=3857)) for name, lay in zip(map_layer["Name"], map_layer.iloc[:, -1]) if not lay.empty]
+    if not layers:
+        logger_f.warning("no features to create vector tiles from")
+        return 0
+    west, south, east, north = _bounds_4326(layers)
+
+    n_tiles = 0
+    for zoom in range(min_zoom, max_zoom + 1):
+        # one unit of the tile grid in meters, finer details are not visible on this level
+        unit = WORLD_SIZE / 2 ** zoom / TILE_EXTENT
+        simplified = [(name, _simplify(lay, unit)) for name, lay in layers]
+
+        for tile in mercantile.tiles(west, south, east, north, zooms=[zoom]):
+            data = encode_tile(simplified, tile)
+            if data is None:
+                continue
+            tile_path = out_dir / str(tile.z) / str(tile.x) / f"{tile.y}.pbf"
+            tile_path.parent.mkdir(parents=True, exist_ok=True)
+            with open(tile_path, "wb") as f:
+                f.write(data)
+            n_tiles += 1
+        logger_f.info("created zoom level %d, %d tiles in total", zoom, n_tiles)
+
+    end_time = datetime.now() - start_time
+    logger_f.info(f"creating {n_tiles} vector tiles finished, Time elapsed: {end_time}")
+    return n_tiles
+
+
+def encode_tile(layers, tile):
+    """Encode the features of all layers within a tile.
+
+    Args:
+        layers (list): tuples of layer name and GeoDataFrame in EPSG:3857
+        tile (mercantile.Tile): tile to be encoded
+
+    Returns:
+        bytes: protobuf encoded vector tile, None if no layer has features in the tile
+    """
+    left, bottom, right, top = mercantile.xy_bounds(tile)
+    scale = TILE_EXTENT / (right - left)
+    buffer = TILE_BUFFER / scale
+    clip_box = (left - buffer, bottom - buffer, right + buffer, top + buffer)
+
+    tile_layers = []
+    for name, lay in layers:
+        features = []
+        for position in lay.sindex.query(box(*clip_box)):
+            geometry = clip_by_rect(lay.geometry.iloc[position], *clip_box)
+            if geometry.is_empty:
+                continue
+            # tile coordinates with the origin in the lower left corner, the encoder flips the y axis
+            geometry = affine_transform(geometry, [scale, 0, 0, scale, -left * scale, -bottom * scale])
+            properties = {"@osmId": str(lay["@osmId"].iloc[position])} if "@osmId" in lay.columns else {}
+            features.append({"geometry": geometry, "properties": properties})
+        if features:
+            tile_layers.append({"name": name, "features": features})
+
+    if not tile_layers:
+        return None
+    return mapbox_vector_tile.encode(tile_layers)
+
+
+def _simplify(lay, tolerance):
+    """Simplify the lines and polygons of a layer and drop those smaller than the tolerance, points are kept."""
+    if lay.geom_type.isin(["Point", "MultiPoint"]).all():
+        return lay
+    bounds = lay.bounds
+    visible = (bounds["maxx"] - bounds["minx"] >= tolerance) | (bounds["maxy"] - bounds["miny"] >= tolerance)
+    simplified = lay[visible].copy()
+    simplified.geometry = simplified.geometry.simplify(tolerance, preserve_topology=True)
+    return simplified[~simplified.is_empty]
+
+
+def _bounds_4326(layers):
+    """Bounding box of all layers in EPSG:4326, limited to the extent of web mercator."""
+    bounds = [lay.to_crs(epsg=4326).total_bounds for name, lay in layers]
+    west = max(min(b[0] for b in bounds), -180)
+    south = max(min(b[1] for b in bounds), -85.051129)
+    east = min(max(b[2] for b in bounds), 180)
+    north = min(max(b[3] for b in bounds), 85.051129)
+    return west, south, east, north
+
+
+def write_viewer(map_layer, out_dir, provider, title, min_zoom=10, max_zoom=14):
+    """Write a TileJSON description and a MapLibre map of the tile pyramid to out_dir.
+
+    The map (index.html) loads the tiles on demand, it has to be opened via http, e.g. after
+    `python -m http.server --directory <out_dir>`.
+
+    Args:
+        map_layer (DataFrame): with the columns Name, Color and last column GeoDataFrames
+        out_dir (Path): directory of the tile pyramid
+        provider (TileProvider): xyzservices provider of the basemap
+        title (String): title of the map
+        min_zoom (Integer): lowest zoom level of the pyramid
+        max_zoom (Integer): highest zoom level of the pyramid
+    """
+    layers = [(name, lay.to_crs(epsg=3857)) for name, lay in zip(map_layer["Name"], map_layer.iloc[:, -1]) if not lay.empty]
+    west, south, east, north = _bounds_4326(layers)
+
+    tilejson = {
+        "tilejson": "2.2.0",
+        "name": title,
+        "tiles": ["{z}/{x}/{y}.pbf"],
+        "minzoom": min_zoom,
+        "maxzoom": max_zoom,
+        "bounds": [west, south, east, north],
+        "vector_layers": [{"id": name, "fields": {}} for name, lay in layers],
+    }
+    with open(out_dir / "metadata.json", "w") as f:
+        json.dump(tilejson, f, indent=2)
+
+    style = {
+        "version": 8,
+        "sources": {
+            "basemap": {
+                "type": "raster",
+                "tiles": [provider.build_url()],
+                "tileSize": 256,
+                "attribution": provider.html_attribution,
+            },
+            "osm": {"type": "vector", "minzoom": min_zoom, "maxzoom": max_zoom, "tiles": ["{z}/{x}/{y}.pbf"]},
+        },
+        "layers": [{"id": "basemap", "type": "raster", "source": "basemap"}],
+    }
+    # the first layer of the input is drawn on top like in the other plots
+    for name, color, lay in list(zip(map_layer["Name"], map_layer["Color"], map_layer.iloc[:, -1]))[::-1]:
+        style["layers"].append(_style_layer(name, color, lay))
+
+    html = VIEWER_TEMPLATE.format(
+        title=title,
+        version=MAPLIBRE_VERSION,
+        style=json.dumps(style, indent=2),
+        bounds=json.dumps([[west, south], [east, north]]),
+    )
+    with open(out_dir / "index.html", "w") as f:
+        f.write(html)
+
+
+def _style_layer(name, color, lay):
+    """Style of a layer in the MapLibre map based on its geometry type."""
+    layer = {"id": name, "source": "osm", "source-layer": name}
+    geom_type = lay.geom_type.iloc[0] if not lay.empty else "Polygon"
+    if geom_type in ("Point", "MultiPoint"):
+        layer.update(type="circle", paint={"circle-color": color, "circle-radius": 5})
+    elif geom_type in ("LineString", "LinearRing", "MultiLineString"):
+        layer.update(type="line", paint={"line-color": color, "line-width": 2})
+    else:
+        layer.update(type="fill", paint={"fill-color": color, "fill-outline-color": "black"})
+    return layer
+
+
+def clear_tiles(out_dir):
+    """Delete an existing tile pyramid so that no outdated tiles remain."""
+    if out_dir.is_dir():
+        shutil.rmtree(out_dir)
+    out_dir.mkdir(parents=True)
+
+
+VIEWER_TEMPLATE = """<!DOCTYPE html>
+<html>
+<head>
+    <meta charset="utf-8">
+    <title>{title}</title>
+    <link href="https://unpkg.com/maplibre-gl@{version}/dist/maplibre-gl.css" rel="stylesheet">
+    <script src="https://unpkg.com/maplibre-gl@{version}/dist/maplibre-gl.js"></script>
+    <style>
+        body {{ margin: 0; }}
+        #map {{ position: absolute; top: 0; bottom: 0; width: 100%; }}
+    </style>
+</head>
+<body>
+<div id="map"></div>
+<script>
+    // tile urls are relative to this page
+    const base = window.location.href.replace(/[^/]*$/, "");
+    const style = {style};
+    style.sources.osm.tiles = style.sources.osm.tiles.map((url) => base + url);
+
+    const map = new maplibregl.Map({{container: "map", style: style, bounds: {bounds}}});
+    map.addControl(new maplibregl.NavigationControl());
+    map.addControl(new maplibregl.ScaleControl());
+</script>
+</body>
+</html>
+"""